@@ -15,7 +15,8 @@ Source0: http://github.com/xenserver/planex/archive/v%{version}/%{pkgname}-%{ver
 License: LGPLv2.1
 BuildArch: noarch
 BuildRequires: python-setuptools
-Requires: git
+## planex-clone --worktrees also needs git 2.5 or later, and checks for it
+Requires: git >= 1.8.3
 %if 0%{?fedora} >= 27
 Requires: python2-GitPython
 Requires: python2-argcomplete
@@ -70,6 +71,8 @@ sed -i "s/\(version='\)[^'\"]\+/\1%{version}-%{release}/g" setup.py
 %{_bindir}/planex-fetch
 %{_bindir}/planex-init
 %{_bindir}/planex-make-srpm
+%{_bindir}/planex-mirror
+%{_bindir}/planex-patchqueue-check
 %{_bindir}/planex-pin
 %{python_sitelib}/planex
 %{python_sitelib}/planex-*.egg-info
@@ -0,0 +1,147 @@
+"""
+Client for the REST API of Bitbucket Server
+"""
+
+import logging
+import threading
+
+import pkg_resources
+import requests
+from six.moves.urllib.parse import quote
+
+from planex.util import add_custom_headers_for_url
+
+
+# Number of results requested from each page of a paged API
+PAGE_LIMIT = 100
+
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def request_headers(netloc):
+    """
+    Return the HTTP headers for making requests to the specified location
+    """
+    useragent = ("planex-repository/%s" %
+                 pkg_resources.require("planex")[0].version)
+    headers = requests.utils.default_headers()
+    headers.update({
+        "user-agent": useragent,
+    })
+    add_custom_headers_for_url(netloc, headers)
+    return headers
+
+
+def session_for(netloc):
+    """
+    Return the keep-alive session shared by all requests to netloc
+    """
+    with _SESSIONS_LOCK:
+        if netloc not in _SESSIONS:
+            session = requests.Session()
+            session.headers.update(request_headers(netloc))
+            _SESSIONS[netloc] = session
+        return _SESSIONS[netloc]
+
+
+class BitbucketRepo(object):
+    """
+    A repository on a Bitbucket Server.   Branches are looked up with
+    filtered, paged queries which stop as soon as the branch is found,
+    tags and commits with their direct endpoints.
+    """
+
+    def __init__(self, netloc, project, repo):
+        self.netloc = netloc
+        self.base_url = "https://%s/rest/api/1.0/projects/%s/repos/%s" % \
+            (netloc, project, repo)
+
+    def _get(self, path, params=None):
+        """
+        Return the decoded JSON response to a GET of path, or None if
+        the resource does not exist
+        """
+        url = self.base_url + path
+        logging.debug("Fetching %s %s", url, params or "")
+        response = session_for(self.netloc).get(url, params=params)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def _pages(self, path, params=None):
+        """
+        Generate the values from successive pages of a paged API.
+        Stopping the iteration stops further pages being requested.
+        """
+        params = dict(params or {}, limit=PAGE_LIMIT, start=0)
+        while True:
+            page = self._get(path, params)
+            if page is None:
+                return
+            for value in page['values']:
+                yield value
+            if page.get('isLastPage', True):
+                return
+            params['start'] = page['nextPageStart']
+
+    def commit(self, commitish):
+        """Return the full SHA1 of commitish"""
+        data = self._get("/commits/%s" % quote(commitish, safe=''))
+        return data['id'] if data else None
+
+    def tag(self, name):
+        """Return the full SHA1 of the commit tagged name"""
+        data = self._get("/tags/%s" % quote(name, safe='/'))
+        return data['latestCommit'] if data else None
+
+    def branch(self, name):
+        """Return the full SHA1 of the latest commit on branch name"""
+        return self.branches([name]).get(name)
+
+    def branches(self, names):
+        """
+        Return a dictionary mapping each of the named branches to the
+        full SHA1 of its latest commit.   Missing branches are omitted.
+        """
+        wanted = set(names)
+        params = {}
+        if len(wanted) == 1:
+            params['filterText'] = next(iter(wanted))
+
+        found = {}
+        for value in self._pages("/branches", params):
+            name = value['displayId']
+            if name in wanted and value['id'] == 'refs/heads/' + name:
+                found[name] = value['latestCommit']
+                if len(found) == len(wanted):
+                    break
+        return found
+
+    def resolve(self, refs):
+        """
+        Return a dictionary mapping each of refs to the full SHA1 it
+        points to.   Refs may be qualified tag or branch names
+        (refs/tags/NAME or refs/heads/NAME) or any other commitish.
+        All the branches are looked up in a single scan of the branch
+        list.   Refs which cannot be resolved are omitted.
+        """
+        resolved = {}
+        branches = {}
+        for ref in set(refs):
+            if ref.startswith('refs/heads/'):
+                branches[ref[len('refs/heads/'):]] = ref
+            elif ref.startswith('refs/tags/'):
+                sha1 = self.tag(ref[len('refs/tags/'):])
+                if sha1:
+                    resolved[ref] = sha1
+            else:
+                sha1 = self.commit(ref)
+                if sha1:
+                    resolved[ref] = sha1
+
+        if branches:
+            for name, sha1 in self.branches(branches).items():
+                resolved[branches[name]] = sha1
+        return resolved
@@ -18,11 +18,13 @@ class Blob(object):
     as an opaque blob - the tools will not look inside it.
     """
 
-    def __init__(self, spec, url, defined_by):
+    def __init__(self, spec, url, defined_by, sha256=None):
         with rpm_macros(spec.macros, nevra(spec.spec.sourceHeader)):
             self._spec = spec
             self._url = rpm.expandMacro(url)
             self._defined_by = defined_by
+            self._sha256 = sha256
+        self._sparse = None
 
     def __eq__(self, other):
         return self.__dict__ == other.__dict__
@@ -56,6 +58,22 @@ class Blob(object):
         """Return the name of file which defined this resource"""
         return self._defined_by
 
+    @property
+    def sha256(self):
+        """
+        Return the expected SHA256 of the contents of this resource,
+        or None if it is not known
+        """
+        return self._sha256
+
+    @property
+    def sparse(self):
+        """
+        Return the directories of this resource's repository which are
+        needed to build the package, or None if all of them may be
+        """
+        return self._sparse
+
     @property
     @expandmacros
     def path(self):
@@ -118,13 +136,15 @@ class GitBlob(Blob):
     """
 
     # pylint: disable=too-many-arguments
-    def __init__(self, spec, url, defined_by, spec_path, prefix, commitish):
+    def __init__(self, spec, url, defined_by, spec_path, prefix, commitish,
+                 sparse=None):
         self.spec_path = spec_path
         with rpm_macros(spec.macros, nevra(spec.spec.sourceHeader)):
             super(GitBlob, self).__init__(spec, url, defined_by)
             self._prefix = rpm.expandMacro(prefix) if prefix is not None \
                 else rpm.expandMacro("%{name}-%{version}")
             self._commitish = rpm.expandMacro(commitish)
+        self._sparse = sparse
 
     @property
     def is_repo(self):
@@ -163,9 +183,10 @@ class GitBlob(Blob):
 class Archive(Blob):
     """A tarball archive which will be unpacked into the SRPM"""
 
-    def __init__(self, spec, url, defined_by, prefix):
+    # pylint: disable=too-many-arguments
+    def __init__(self, spec, url, defined_by, prefix, sha256=None):
         with rpm_macros(spec.macros, nevra(spec.spec.sourceHeader)):
-            super(Archive, self).__init__(spec, url, defined_by)
+            super(Archive, self).__init__(spec, url, defined_by, sha256)
             self._prefix = rpm.expandMacro(prefix)
         self._names = None
 
@@ -175,7 +196,8 @@ class Archive(Blob):
         # object
         if self._names is None:
             with Tarball(self.path) as tarball:
-                self._names = [os.path.basename(n) for n in tarball.getnames()]
+                self._names = set(os.path.basename(n)
+                                  for n in tarball.getnames())
         return name in self._names
 
     @property
@@ -229,11 +251,13 @@ class GitArchive(Archive):
     """
 
     # pylint: disable=too-many-arguments
-    def __init__(self, spec, url, defined_by, prefix, commitish):
+    def __init__(self, spec, url, defined_by, prefix, commitish,
+                 sparse=None):
         with rpm_macros(spec.macros, nevra(spec.spec.sourceHeader)):
             super(GitArchive, self).__init__(spec, url, defined_by, prefix)
             self._prefix = rpm.expandMacro(prefix)
             self._commitish = rpm.expandMacro(commitish)
+        self._sparse = sparse
 
     @property
     def is_repo(self):
@@ -274,15 +298,19 @@ class Patchqueue(Archive):
     """A patchqueue archive which will be unpacked into the SRPM"""
 
     # pylint: disable=too-many-arguments
-    def __init__(self, spec, url, defined_by, prefix):
+    def __init__(self, spec, url, defined_by, prefix, sha256=None):
         with rpm_macros(spec.macros, nevra(spec.spec.sourceHeader)):
-            super(Patchqueue, self).__init__(spec, url, defined_by, prefix)
+            super(Patchqueue, self).__init__(spec, url, defined_by, prefix,
+                                             sha256)
         self._series = None
+        self._series_names = None
 
     def __contains__(self, patch):
         # As for the Archive class, this should never be called
         # before the archive has been fetched
-        if patch in self.series():
+        if self._series_names is None:
+            self._series_names = set(self.series())
+        if patch in self._series_names:
             return True
         # files not in the patchqueue
         return super(Patchqueue, self).__contains__(patch)
@@ -301,16 +329,18 @@ class Patchqueue(Archive):
         Extract all the source [names] to [destdir].   Raises [KeyError]
         for the first requested source that cannot be found.
         """
+        names = set(names)
+        series = set(self.series())
         with Tarball(self.path) as tarball:
             # patches within the patchqueue
             target_paths = [
                 os.path.normpath(os.path.join(self.prefix, name))
-                for name in set(names) & set(self.series())
+                for name in names & series
             ]
             # files not in the patchqueue
             target_paths += [
                 os.path.normpath(name)
-                for name in set(names) - set(self.series())
+                for name in names - series
             ]
             tarball.extract(target_paths, destdir)
 
@@ -322,11 +352,13 @@ class GitPatchqueue(Patchqueue):
     """
 
     # pylint: disable=too-many-arguments
-    def __init__(self, spec, url, defined_by, prefix, commitish):
+    def __init__(self, spec, url, defined_by, prefix, commitish,
+                 sparse=None):
         with rpm_macros(spec.macros, nevra(spec.spec.sourceHeader)):
             super(GitPatchqueue, self).__init__(spec, url, defined_by, prefix)
             self._prefix = rpm.expandMacro(prefix)
             self._commitish = rpm.expandMacro(commitish)
+        self._sparse = sparse
 
     @property
     def is_repo(self):
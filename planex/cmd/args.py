@@ -61,6 +61,23 @@ def keeptmp_parser():
     return parser
 
 
+def ref_cache_parser():
+    """
+    Returns a parser which handles the "--no-ref-cache" option.
+
+    This parser can then be used as a 'parent' to other parsers
+    which will inherit these options.
+
+    See https://docs.python.org/2.7/library/argparse.html#parents
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--no-ref-cache", dest="ref_cache",
+                        action="store_false", default=True,
+                        help="Resolve refs against the remote repository "
+                             "instead of trusting the ref cache")
+    return parser
+
+
 def rpm_macro(string):
     """
     Argparse type handler for RPM macro command line arguments of the form:
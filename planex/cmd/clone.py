@@ -4,10 +4,12 @@ planex-clone: Checkout sources referred to by a pin file
 from __future__ import print_function
 
 import argparse
+from collections import defaultdict
 import json
 import logging
-from os import getcwd, rename, walk
-from os.path import abspath, exists, join, relpath
+from multiprocessing.pool import ThreadPool
+from os import getcwd, rename
+from os.path import exists, isfile, join, relpath
 import re
 from string import Template
 import shutil
@@ -15,6 +17,7 @@ import subprocess
 import sys
 import tempfile
 import tarfile
+import threading
 
 import git
 
@@ -31,7 +34,13 @@ from planex.cmd.fetch import fetch_url
 from planex.config import Configuration
 from planex.link import Link
 from planex.util import setup_logging
+import planex.git
+import planex.mirror
+import planex.patchqueue
+import planex.prepcache
+import planex.sparse
 import planex.spec
+import planex.worktree
 
 
 SUPPORTED_URL_SCHEMES = ["http", "https"]
@@ -56,9 +65,89 @@ def parse_args_or_exit(argv=None):
     parser.add_argument("pins", metavar="PINS", nargs="*", help="pin file")
     parser.add_argument("--credentials", metavar="CREDS", default=None,
                         help="Credentials")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+                        help="Clone up to N repositories at once")
+    parser.add_argument("--depth", metavar="N", type=int, default=None,
+                        help="Only fetch the last N commits of the "
+                             "commitish being checked out")
+    parser.add_argument("--filter", metavar="SPEC", dest="filter_spec",
+                        default=None,
+                        help="Partial clone filter, such as blob:none, "
+                             "applied to the commitish being checked out")
+    parser.add_argument("--single-branch", action="store_true",
+                        help="Only fetch the commitish being checked out")
+    parser.add_argument("--sparse", action="store_true",
+                        help="Only check out the directories of patchqueue "
+                             "and patch repositories named by their prefix, "
+                             "unless the link gives sparse paths")
+    parser.add_argument("--worktrees", action="store_true",
+                        help="Check repositories out as worktrees of one "
+                             "shared store each, fetching their objects "
+                             "once.   Needs git 2.5 or later.")
+    parser.add_argument("--patch-engine", choices=PATCH_ENGINES,
+                        default=PatchEngine.default,
+                        help="Apply patchqueues with guilt push, or with "
+                             "a single git am")
     return parser.parse_args(argv)
 
 
+# Tools which can apply a patchqueue
+PATCH_ENGINES = ('guilt', 'am')
+
+
+class PatchEngine(object):
+    """The tool used to apply patchqueues"""
+
+    # pylint: disable=R0903
+
+    default = 'guilt'
+
+
+class CloneSlots(object):
+    """
+    Limits the number of clones and extractions running at once, across
+    all the packages being cloned
+    """
+
+    # pylint: disable=R0903
+
+    semaphore = threading.BoundedSemaphore(1)
+
+    @classmethod
+    def set_limit(cls, jobs):
+        """Allow up to jobs clones to run at once"""
+        cls.semaphore = threading.BoundedSemaphore(max(jobs, 1))
+
+
+_DESTINATION_LOCKS = defaultdict(threading.RLock)
+_DESTINATION_LOCKS_LOCK = threading.Lock()
+
+
+def destination_lock(destination):
+    """
+    Return the lock serialising work on the repository at destination.
+    Packages sharing a repository take turns to clone and patch it.
+    """
+    with _DESTINATION_LOCKS_LOCK:
+        return _DESTINATION_LOCKS[str(Path(destination).absolute())]
+
+
+def in_parallel(func, items):
+    """
+    Return [func(item) for item in items], running the calls on
+    concurrent threads.   CloneSlots bounds the number of clones which
+    actually run at once.
+    """
+    if len(items) < 2:
+        return [func(item) for item in items]
+    pool = ThreadPool(len(items))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def find_link_pin(package):
     """
     From a package name locate the link or pin file
@@ -151,49 +240,232 @@ def clone_jenkins_groovy(package, destination, credentials, url, commitish):
                                        credentials=credentials))
 
 
-def clone(url, destination, commitish):
+class LocalChangesError(Exception):
+    """An existing clone has uncommitted work or commits which would be lost"""
+    pass
+
+
+def reset_branch(repo, branch_name, commit):
     """
-    Clone git repository and checkout at commitish
+    Check out branch_name of repo, creating it or resetting it to commit.
+    Raises LocalChangesError rather than dropping local commits which
+    are not reachable from commit.
     """
+    if branch_name in repo.heads:
+        local = int(repo.git.rev_list(
+            '--count', '%s..%s' % (commit.hexsha, branch_name)))
+        if local:
+            raise LocalChangesError(
+                "%s has %d local commits on %s which are not in %s: push "
+                "or rebase them first" % (repo.working_dir, local,
+                                          branch_name, commit.hexsha))
+    # This refuses to overwrite local changes
+    args = ['-B', branch_name, commit.hexsha]
+    if isfile(join(repo.working_dir, '.git')):
+        # Worktrees of the same store may have the same branch
+        args.insert(0, '--ignore-other-worktrees')
+    repo.git.checkout(*args)
 
-    if not destination.parent.exists():
-        destination.parent.mkdir(parents=True)
-    if destination.exists():
-        # Take a fresh clone if we are re-cloning
+
+def reusable_clone(url, destination):
+    """
+    Return the existing clone of url at destination if it can be updated
+    in place.   Unusable clones, and clones of other URLs, are removed.
+    Raises LocalChangesError rather than removing uncommitted work.
+    """
+    try:
+        repo = git.Repo(str(destination))
+        origin_url = repo.remotes.origin.url
+        dirty = repo.is_dirty(untracked_files=False)
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError,
+            git.GitCommandError, AttributeError, IndexError):
+        # Not a repository, or no origin remote: replace whatever is there
+        logging.warning("%s is not a usable clone, cloning again",
+                        destination)
         shutil.rmtree(str(destination))
+        return None
 
-    repo = git.Repo.clone_from(url, str(destination))
-    if commitish in repo.remotes['origin'].refs:
-        branch_name = commitish
-        commit = repo.remotes['origin'].refs[commitish]
+    if dirty:
+        raise LocalChangesError(
+            "%s has uncommitted changes: commit or stash them first" %
+            destination)
 
-    elif commitish in repo.tags:
-        branch_name = "planex/%s" % commitish
-        commit = repo.refs[commitish]
+    if origin_url != url:
+        logging.info("%s is a clone of %s, not %s: cloning again",
+                     destination, origin_url, url)
+        shutil.rmtree(str(destination))
+        return None
 
-    else:
-        branch_name = "planex/%s" % commitish[:8]
-        commit = repo.rev_parse(commitish)
+    return repo
 
-    local_branch = repo.create_head(branch_name, commit)
-    local_branch.checkout()
 
-    return repo
+class FetchMode(object):
+    """
+    How much of a repository clone fetches: the full history of every
+    branch by default, or only the commitish being checked out, limited
+    to depth commits of history and omitting blobs matched by
+    filter_spec until they are needed
+    """
+
+    # pylint: disable=R0903
+
+    # The mode used by clone when none is given; set by --depth, --filter
+    # and --single-branch
+    default = None
+
+    def __init__(self, depth=None, filter_spec=None, single_branch=False):
+        self.depth = depth
+        self.filter_spec = filter_spec
+        self.single_branch = single_branch
+
+    @property
+    def partial(self):
+        """True if only the commitish being checked out is fetched"""
+        return bool(self.depth or self.filter_spec or self.single_branch)
+
+    def fetch_args(self):
+        """Return the git fetch options for this mode"""
+        args = []
+        if self.depth:
+            args.append('--depth=%d' % self.depth)
+        if self.filter_spec:
+            args.append('--filter=%s' % self.filter_spec)
+        return args
 
 
-def find_all_files(path):
+FetchMode.default = FetchMode()
+
+# Archives only need the tree of the pinned commit
+ARCHIVE_FETCH_MODE = FetchMode(depth=1)
+
+
+def fetch_commitish(repo, commitish, fetch_args=None):
     """
-    Find all the files in a path (excluding .git contents)
-    Git repo.untracked will skip ignores (which we need to
-    add on first expansion of a tarball)
+    Fetch only what is needed to check out commitish: the branch or tag
+    of that name, or the commit itself
     """
-    results = []
-    for root, _, files in walk(path):
-        if '.git' in root:
+    fetch_args = fetch_args or []
+    try:
+        # Commits already present do not need to be fetched again
+        if re.match(r'^[0-9a-f]{7,40}$', commitish):
+            repo.rev_parse(commitish + '^{commit}')
+            return
+    except (git.BadName, ValueError):
+        pass
+
+    refspecs = ['+refs/heads/%s:refs/remotes/origin/%s' % (commitish,
+                                                           commitish),
+                '+refs/tags/%s:refs/tags/%s' % (commitish, commitish),
+                commitish]
+    for refspec in refspecs:
+        try:
+            repo.git.fetch('origin', refspec, *fetch_args)
+            return
+        except git.GitCommandError:
             continue
-        results.extend([abspath(join(root, filename)) for filename in files])
+    # The server would not fetch the commit by itself
+    repo.git.fetch('origin', '--tags', *fetch_args)
 
-    return results
+
+def fetch_clone(url, path, commitish, mode, bare=True):
+    """
+    Create or update the clone of url at path with what mode says is
+    needed to check out commitish.   New clones borrow objects from the
+    local mirror of url.   Returns the clone.
+    """
+    # pylint: disable=no-member
+    if path.exists():
+        repo = git.Repo(str(path))
+        # Never make a full clone shallow
+        shallow = planex.git.is_shallow(str(path))
+        partial = mode.partial and shallow
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        repo = git.Repo.init(str(path), bare=bare)
+        repo.create_remote('origin', url)
+        mirror = planex.mirror.find_mirror(url)
+        if mirror is not None:
+            # The equivalent of git clone --reference
+            logging.debug("Using mirror %s for %s", mirror, url)
+            alternates = Path(repo.git_dir, 'objects', 'info', 'alternates')
+            with alternates.open('w') as fileh:
+                fileh.write(u'%s\n' % join(mirror, 'objects'))
+        partial = mode.partial
+
+    if partial:
+        fetch_commitish(repo, commitish, mode.fetch_args())
+    else:
+        repo.git.fetch('origin', '--tags', '--prune',
+                       '+refs/heads/*:refs/remotes/origin/*')
+    return repo
+
+
+def clone(url, destination, commitish, mode=None, sparse=None):
+    """
+    Check out commitish of the git repository at url into destination.
+    An existing clone of the same repository is updated in place.   If
+    SharedStores are enabled, new checkouts are worktrees of a bare store
+    of the repository in the same directory as destination, shared by
+    all its checkouts; otherwise they are separate clones.   mode
+    defaults to FetchMode.default.   If sparse is a list of directories,
+    a new checkout only checks out those directories.
+    """
+    mode = mode or FetchMode.default
+    # pylint: disable=no-member
+    destination.parent.mkdir(parents=True, exist_ok=True)
+
+    repo = None
+    if destination.exists():
+        repo = reusable_clone(url, destination)
+    new_clone = repo is None
+
+    # Existing worktrees fetch into the store shared with new checkouts
+    path = planex.worktree.store_path(destination.parent, url)
+    if repo is not None:
+        logging.debug("Updating existing clone %s", destination)
+        source = repo
+        with destination_lock(path):
+            size_before = planex.git.object_store_size(repo.git_dir)
+            # Only deepen shallow clones as far as the mode asks; never
+            # make a full clone shallow
+            shallow = planex.git.is_shallow(repo.git_dir)
+            fetch_commitish(repo, commitish,
+                            mode.fetch_args() if shallow else None)
+    elif planex.worktree.SharedStores.enabled:
+        with destination_lock(path):
+            size_before = planex.git.object_store_size(str(path)) \
+                if path.exists() else 0
+            source = fetch_clone(url, path, commitish, mode)
+    else:
+        size_before = 0
+        repo = source = fetch_clone(url, destination, commitish, mode,
+                                    bare=False)
+    logging.info("Fetched %d KiB for %s#%s", planex.git.object_store_size(
+        source.git_dir) - size_before, url, commitish)
+
+    if commitish in source.remotes['origin'].refs:
+        branch_name = commitish
+        commit = source.remotes['origin'].refs[commitish].commit
+
+    elif commitish in source.tags:
+        branch_name = "planex/%s" % commitish
+        commit = source.tags[commitish].commit
+
+    else:
+        branch_name = "planex/%s" % commitish[:8]
+        commit = source.rev_parse(commitish + '^{commit}')
+
+    if repo is None:
+        logging.debug("Adding worktree %s of %s", destination,
+                      source.git_dir)
+        with destination_lock(path):
+            planex.worktree.add_worktree(source, destination, commit)
+        repo = git.Repo(str(destination))
+
+    planex.sparse.set_sparse_checkout(repo, sparse, new_clone)
+    reset_branch(repo, branch_name, commit)
+
+    return repo
 
 
 def extract(url_str, destination):
@@ -229,11 +501,14 @@ def extract(url_str, destination):
     # extract the archive
     if tarfile.is_tarfile(archive_path):
         logging.info("Fetch and extract %s into %s", url_str, destination)
-        with tarfile.open(archive_path) as tara:
-            tara.extractall(str(destination))
-        index = repo.index
-        index.add(find_all_files(str(destination)))
-        index.commit("Repo generated by planex-clone")
+        author = git.Actor.author(repo.config_reader())
+        committer = git.Actor.committer(repo.config_reader())
+        planex.git.import_tarball(
+            repo.working_dir, archive_path, repo.head.ref.path,
+            "Repo generated by planex-clone",
+            "%s <%s>" % (author.name, author.email),
+            "%s <%s>" % (committer.name, committer.email))
+        repo.git.checkout('--force', '--quiet')
 
     if archive_file:
         # delete temp file
@@ -246,12 +521,14 @@ def clone_resource(resource, destination):
     """
     Clone a resource as a git repository
     """
-    if resource.is_repo:
-        logging.info("Clone and checkout %s@%s into %s", resource.url,
-                     resource.commitish, destination)
-        repo = clone(resource.url, destination, resource.commitish)
-    else:
-        repo = extract(resource.url, destination)
+    with destination_lock(destination), CloneSlots.semaphore:
+        if resource.is_repo:
+            logging.info("Clone and checkout %s@%s into %s", resource.url,
+                         resource.commitish, destination)
+            repo = clone(resource.url, destination, resource.commitish,
+                         sparse=planex.sparse.sparse_paths(resource))
+        else:
+            repo = extract(resource.url, destination)
 
     return repo
 
@@ -281,25 +558,30 @@ def clone_all_git(args, spec):
     """
     Clone all git repositories for a package
     """
+    clones = []
     for resource in spec.resources():
         if resource.is_repo:
             # remove trailing '.git'
-            destination = Path(args.repos, resource.basename[:-4])
-            clone_resource(resource, destination)
+            destination = planex.worktree.Destinations.path_of(
+                args.repos, resource)
+            clones.append((resource, destination))
+    in_parallel(lambda clone_args: clone_resource(*clone_args), clones)
 
 
 def clone_all_fetchable(args, package, spec):
     """
     Clone all remote resources for a package
     """
+    clones = []
     for resource in spec.resources():
         if resource.is_fetchable:
             if resource.is_repo:
-                # remove trailing '.git'
-                destination = Path(args.repos, resource.basename[:-4])
+                destination = planex.worktree.Destinations.path_of(
+                    args.repos, resource)
             else:
                 destination = Path(args.repos, package)
-            clone_resource(resource, destination)
+            clones.append((resource, destination))
+    in_parallel(lambda clone_args: clone_resource(*clone_args), clones)
 
 
 def apply_patchqueue(base_repo, pq_repo, prefix):
@@ -312,9 +594,12 @@ def apply_patchqueue(base_repo, pq_repo, prefix):
 
     # make the directory tree for the patches within the base repo
     # pylint: disable=no-member
-    patches_link.parent.mkdir(parents=True)
+    patches_link.parent.mkdir(parents=True, exist_ok=True)
 
-    # link the patchqueue directory for the base repo branch
+    # link the patchqueue directory for the base repo branch, replacing
+    # the link made by an earlier run
+    if patches_link.is_symlink():
+        patches_link.unlink()
     rel_path = relpath(str(status_path.parent), str(patches_link.parent))
     patches_link.symlink_to(rel_path)
 
@@ -322,40 +607,156 @@ def apply_patchqueue(base_repo, pq_repo, prefix):
     with status_path.open('w'):
         pass
 
-    patches = subprocess.check_output(['guilt', 'series'],
-                                      cwd=base_repo.working_dir)
+    series_path = status_path.parent / 'series'
+    if series_path.exists():
+        with series_path.open() as series:
+            patches = list(planex.patchqueue.parse_patchseries(series))
+    else:
+        patches = []
     if patches:
-        subprocess.check_call(['guilt', 'push', '--all'],
-                              cwd=base_repo.working_dir)
+        planex.sparse.widen_for_patches(base_repo, str(status_path.parent),
+                                        patches)
+        push_all = planex.patchqueue.git_am_all \
+            if PatchEngine.default == 'am' \
+            else planex.patchqueue.guilt_push_all
+        # Collect the output so that concurrent clones do not interleave
+        try:
+            output = push_all(base_repo, str(status_path.parent))
+        except subprocess.CalledProcessError as exn:
+            if not planex.git.is_shallow(base_repo.git_dir):
+                logging.error("Applying patchqueue to %s failed:\n%s",
+                              base_repo.working_dir, exn.output)
+                raise
+            # Patches may need history which a shallow clone lacks
+            logging.info("Fetching history of %s to apply patchqueue",
+                         base_repo.working_dir)
+            planex.git.ensure_history(base_repo.working_dir)
+            output = push_all(base_repo, str(status_path.parent))
+        logging.debug("Applied patchqueue to %s:\n%s",
+                      base_repo.working_dir, output)
 
 
 def clone_with_patchq(repos, base_dest, base_res, pq_res):
     """
     Given a source and patchqueue resource clone repos and apply the patchqueue
     """
-    base_repo = clone_resource(base_res, base_dest)
-
-    pq_dest = Path(repos, re.sub(r'\.git$', '', pq_res.basename))
-    pq_repo = clone_resource(pq_res, pq_dest)
-    apply_patchqueue(base_repo, pq_repo, pq_res.prefix)
-
-
-def archive_resource(resource, destination):
-    """
-    Write an archive of a resource
+    pq_dest = planex.worktree.Destinations.path_of(repos, pq_res)
+    with destination_lock(base_dest):
+        # Clone the patchqueue in the background while cloning the base,
+        # then apply it as soon as both are ready
+        pool = ThreadPool(1)
+        try:
+            pq_clone = pool.apply_async(clone_resource, (pq_res, pq_dest))
+            base_repo = clone_resource(base_res, base_dest)
+            pq_repo = pq_clone.get()
+        finally:
+            pool.close()
+            pool.join()
+        apply_patchqueue(base_repo, pq_repo, pq_res.prefix)
+
+
+class TransientClones(object):
+    """
+    Bare repositories fetched only to make archives of git resources
+    which have no local copy.   Resources from the same repository,
+    archived at the same time or one after another, share one clone,
+    which is removed by cleanup() at the end of the run.
+    """
+
+    _clones = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def archive(cls, url, commitish, output, prefix=None):
+        """
+        Write a tar archive of commitish from url to output, fetching
+        the commitish into the shared clone of url if necessary
+        """
+        with cls._lock:
+            if url not in cls._clones:
+                path = tempfile.mkdtemp(prefix='clone-')
+                repo = git.Repo.init(path, bare=True)
+                repo.create_remote('origin', url)
+                cls._clones[url] = (repo, threading.Lock())
+            repo, lock = cls._clones[url]
+
+        with lock:
+            # Branches are fetched as remote-tracking refs
+            names = [commitish, 'refs/remotes/origin/' + commitish]
+            present = [name for name in names
+                       if planex.git.has_commit(repo.git_dir, name)]
+            if not present:
+                fetch_commitish(repo, commitish,
+                                ARCHIVE_FETCH_MODE.fetch_args())
+                present = [name for name in names
+                           if planex.git.has_commit(repo.git_dir, name)]
+            planex.git.archive_commitish(repo.git_dir, present[0], output,
+                                         prefix)
+
+    @classmethod
+    def cleanup(cls):
+        """Remove all the transient clones"""
+        with cls._lock:
+            for repo, _ in cls._clones.values():
+                shutil.rmtree(repo.git_dir, ignore_errors=True)
+            cls._clones.clear()
+
+
+def archive_local_repo(resource, repos, output):
+    """
+    Write an archive of a git resource from its checkout in repos to
+    output, returning False if there is no suitable checkout.   Only
+    tags and SHA1s are archived from the checkout: it is not fetched,
+    so its branches may be out of date or hold unpushed commits.
+    """
+    if repos is None:
+        return False
+    local = planex.worktree.Destinations.find(repos, resource)
+    if local is None:
+        return False
+    try:
+        repo = git.Repo(str(local))
+        if repo.remotes.origin.url != resource.url:
+            return False
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError,
+            AttributeError, IndexError):
+        return False
+    commitish = str(resource.commitish)
+    if not planex.git.is_immutable(repo.git_dir, commitish) or \
+            not planex.git.has_commit(repo.git_dir, commitish):
+        return False
+    logging.debug("Archiving %s@%s from %s", resource.url,
+                  resource.commitish, local)
+    planex.git.archive_commitish(repo.git_dir, commitish, output,
+                                 resource.prefix)
+    return True
+
+
+def archive_resource(resource, destination, repos=None):
+    """
+    Write an archive of a resource.   Git tags and SHA1s are archived
+    from their checkout in repos or their local mirror if possible.
+    Otherwise git resources are archived with git archive --remote, and
+    only then from a transient clone.
     """
     archive_path = Path(destination, resource.basename)
     if resource.is_repo:
-        temp_dir = tempfile.mkdtemp(prefix='clone-')
-        try:
-            repo = clone(resource.url, temp_dir, resource.commitish)
+        commitish = str(resource.commitish)
+        with archive_path.open("wb") as output:
+            if archive_local_repo(resource, repos, output):
+                return archive_path
+            if planex.mirror.archive(resource.url, commitish, output,
+                                     prefix=resource.prefix):
+                return archive_path
+            if planex.git.archive_remote(resource.url, commitish, output,
+                                         resource.prefix):
+                logging.debug("Archived %s@%s from the server",
+                              resource.url, commitish)
+                return archive_path
             logging.debug("Archiving %s@%s to %s", resource.url,
-                          resource.commitish, archive_path)
-            with archive_path.open("wb") as output:
-                repo.archive(output, treeish=str(resource.commitish),
-                             prefix=resource.prefix)
-        finally:
-            shutil.rmtree(temp_dir, ignore_errors=True)
+                          commitish, archive_path)
+            TransientClones.archive(resource.url, commitish, output,
+                                    resource.prefix)
     else:
         url = urlparse(resource.url)
         if url.scheme in SUPPORTED_URL_SCHEMES:
@@ -381,11 +782,20 @@ def unpack_patches(tarball, destination):
         tara.close()
 
 
-def create_repo_from_spec(spec_path, top_path, repo_path):
+def create_repo_from_spec(spec_path, top_path, repo_path, resources):
     """
     Invoke the prep phase of rpmbuild to generate a source directory then
-    create a git repo from it
+    create a git repo from it.   Trees prepared before from the same spec
+    file, sources and patches, found in the resources_dict of the spec,
+    are cloned from the prep cache instead.
     """
+    key = None
+    if planex.prepcache.cache_root():
+        key = planex.prepcache.cache_key(str(spec_path), str(top_path),
+                                         resources)
+        if planex.prepcache.restore(key, str(repo_path)):
+            return git.Repo(str(repo_path))
+
     top_dir = top_path.resolve()
     cmd = ['rpmbuild', '-bp', '--nodeps',
            '--define', '_topdir '+str(top_dir), str(spec_path)]
@@ -406,6 +816,8 @@ def create_repo_from_spec(spec_path, top_path, repo_path):
         index.add(repo.untracked_files)
         index.commit("Repo generated by planex-clone")
 
+    if key:
+        planex.prepcache.store(key, str(repo_path))
     return repo
 
 
@@ -419,16 +831,23 @@ def clone_with_patches(spec_path, base_dest, base_res, patches_res, pq_res):
     source_path = Path(work_path, "SOURCES")
     source_path.mkdir(parents=True)
 
+    repos = base_dest.parent
     try:
-        archive_resource(base_res, source_path)
-        patches_tarball = archive_resource(patches_res, source_path)
+        with CloneSlots.semaphore:
+            _, patches_tarball = in_parallel(
+                lambda res: archive_resource(res, source_path, repos),
+                [base_res, patches_res])
         unpack_patches(patches_tarball, work_path)
-        base_repo = create_repo_from_spec(spec_path, work_path, base_dest)
+        with destination_lock(base_dest):
+            with CloneSlots.semaphore:
+                base_repo = create_repo_from_spec(
+                    spec_path, work_path, base_dest,
+                    base_res.spec.resources_dict())
 
-        if pq_res:
-            pq_dest = Path(str(base_dest)+'.pg')
-            pq_repo = clone_resource(pq_res, pq_dest)
-            apply_patchqueue(base_repo, pq_repo, pq_res.prefix)
+            if pq_res:
+                pq_dest = Path(str(base_dest)+'.pg')
+                pq_repo = clone_resource(pq_res, pq_dest)
+                apply_patchqueue(base_repo, pq_repo, pq_res.prefix)
 
     finally:
         shutil.rmtree(str(work_path), ignore_errors=True)
@@ -448,14 +867,107 @@ def get_non_repo_name(source, package):
     return package
 
 
-# pylint: disable=too-many-branches
+def clone_package(args, package, spec_path, spec):
+    """
+    Clone the sources of a package and apply its patches
+    """
+    if args.clone:
+        # just clone git resources
+        clone_all_git(args, spec)
+        return
+
+    resources = spec.resources_dict()
+    src_res = resources['Source0']
+    if src_res.is_repo:
+        repo_path = planex.worktree.Destinations.path_of(args.repos, src_res)
+    else:
+        repo_path = Path(args.repos,
+                         get_non_repo_name(src_res.url, package))
+    # pylint: disable=no-member
+    repo_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if "PatchQueue0" in resources:
+        if "Archive0" in resources:
+            # component with patches and patchqueue
+            clone_with_patches(spec_path, repo_path,
+                               resources['Source0'],
+                               resources['Archive0'],
+                               resources['PatchQueue0'])
+        else:
+            # component with patchqueue
+            clone_with_patchq(args.repos, repo_path,
+                              resources['Source0'],
+                              resources['PatchQueue0'])
+    elif "Archive0" in resources:
+        # component with patches
+        clone_with_patches(spec_path, repo_path, resources['Source0'],
+                           resources['Archive0'], None)
+    else:
+        # clone all fetchable resources
+        clone_all_fetchable(args, package, spec)
+
+
+def clone_packages(args, packages):
+    """
+    Clone a list of (package, spec_path, spec) tuples, working on up to
+    args.jobs packages at once
+    """
+    CloneSlots.set_limit(args.jobs)
+    planex.worktree.Destinations.assign(
+        resource for _, _, spec in packages for resource in spec.resources())
+    total = len(packages)
+    progress = {'done': 0}
+    progress_lock = threading.Lock()
+
+    def clone_one(package_args):
+        """Clone one package and report progress"""
+        package = package_args[0]
+        logging.debug("Cloning %s", package)
+        try:
+            clone_package(args, *package_args)
+        except Exception:
+            logging.error("Cloning %s failed", package)
+            raise
+        with progress_lock:
+            progress['done'] += 1
+            logging.info("[%d/%d] Cloned %s", progress['done'], total,
+                         package)
+
+    if not packages:
+        return
+    pool = ThreadPool(max(min(args.jobs, total), 1))
+    try:
+        for _ in pool.imap_unordered(clone_one, packages):
+            pass
+    except Exception:
+        # Do not start any more packages, but let running clones finish
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
 def main(argv=None):
     """
     Entry point
     """
     args = parse_args_or_exit(argv)
     setup_logging(args)
-
+    FetchMode.default = FetchMode(args.depth, args.filter_spec,
+                                  args.single_branch)
+    PatchEngine.default = args.patch_engine
+    planex.sparse.SparseCheckout.use_prefix = args.sparse
+    if args.worktrees and not planex.worktree.worktrees_supported():
+        sys.exit("%s: --worktrees needs git %s or later" %
+                 (sys.argv[0], ".".join(
+                     str(part)
+                     for part in planex.worktree.WORKTREE_GIT_VERSION)))
+    planex.worktree.SharedStores.enabled = args.worktrees
+
+    # Specs are loaded up front: RPM macro state is not thread safe
+    packages = []
     for pin in args.pins:
         package, spec_path, link_pin_path = definitions_for(pin)
 
@@ -467,41 +979,15 @@ def main(argv=None):
         spec = planex.spec.load(str(spec_path), link=link_pin,
                                 check_package_name=False)
 
-        if args.clone:
-            # just clone git resources
-            clone_all_git(args, spec)
-        elif args.jenkins:
+        if args.jenkins:
             # generate Jenkins information
             clone_jenkins(args, spec)
         else:
-            resources = spec.resources_dict()
-            src_res = resources['Source0']
-            if src_res.is_repo:
-                # remove trailing '.git'
-                repo_path = Path(args.repos,
-                                 src_res.basename.rsplit(".git")[0])
-            else:
-                repo_path = Path(args.repos,
-                                 get_non_repo_name(src_res.url, package))
-            if not repo_path.parent.exists():
-                repo_path.parent.mkdir(parents=True)
-
-            if "PatchQueue0" in resources:
-                if "Archive0" in resources:
-                    # component with patches and patchqueue
-                    clone_with_patches(spec_path, repo_path,
-                                       resources['Source0'],
-                                       resources['Archive0'],
-                                       resources['PatchQueue0'])
-                else:
-                    # component with patchqueue
-                    clone_with_patchq(args.repos, repo_path,
-                                      resources['Source0'],
-                                      resources['PatchQueue0'])
-            elif "Archive0" in resources:
-                # component with patches
-                clone_with_patches(spec_path, repo_path, resources['Source0'],
-                                   resources['Archive0'], None)
-            else:
-                # clone all fetchable resources
-                clone_all_fetchable(args, package, spec)
+            packages.append((package, spec_path, spec))
+
+    try:
+        clone_packages(args, packages)
+    except LocalChangesError as exn:
+        sys.exit("%s: %s" % (sys.argv[0], exn))
+    finally:
+        TransientClones.cleanup()
@@ -3,29 +3,46 @@ planex-fetch: Download sources referred to by a spec file
 """
 
 import argparse
+import errno
+import hashlib
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import re
 import shutil
+import subprocess
 import sys
+import tarfile
+import time
 
 import argcomplete
 import git
 import pkg_resources
 import requests
 from requests.adapters import HTTPAdapter
+from requests.adapters import ProtocolError, ReadTimeoutError
 from requests.adapters import Retry
 
 # pylint: disable=relative-import
 from six.moves.urllib.parse import urlparse, urlunparse
 
 from planex.link import Link
-from planex.cmd.args import common_base_parser, rpm_define_parser
+from planex.cmd.args import common_base_parser, rpm_define_parser, \
+    ref_cache_parser
+from planex.config import Configuration
+from planex.pgzip import compress_stream
+from planex.refcache import RefCache
 from planex.repository import Repository
 from planex.util import add_custom_headers_for_url
-from planex.util import run
+from planex.util import makedirs
+from planex.util import mirrors_for_url
 from planex.util import setup_logging
 from planex.util import setup_sigint_handler
+import planex.git
+import planex.mirror
 import planex.spec
+import planex.tarball
+import planex.worktree
 
 
 # This should include all of the extensions in the Makefile.rules for fetch
@@ -33,7 +50,8 @@ SUPPORTED_EXT_TO_MIME = {
     '.tar': 'application/x-tar',
     '.gz': 'application/x-gzip',
     '.tgz': 'application/x-gzip',
-    '.txz': 'application/x-gzip',
+    '.txz': 'application/x-xz',
+    '.xz': 'application/x-xz',
     '.bz2': 'application/x-bzip2',
     '.tbz': 'application/x-bzip2',
     '.zip': 'application/zip',
@@ -41,8 +59,42 @@ SUPPORTED_EXT_TO_MIME = {
     '.patch': 'text/x-diff'
 }
 
+# Magic numbers identifying the formats in SUPPORTED_EXT_TO_MIME,
+# as (offset, magic, mime-type)
+MAGIC_TO_MIME = [
+    (0, b'\x1f\x8b', 'application/x-gzip'),
+    (0, b'BZh', 'application/x-bzip2'),
+    (0, b'\xfd7zXZ\x00', 'application/x-xz'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'PK\x05\x06', 'application/zip'),
+    (0, b'%PDF-', 'application/pdf'),
+    (257, b'ustar', 'application/x-tar')
+]
+
+# Lines which only occur in diffs
+DIFF_LINE_PREFIXES = (b'diff ', b'--- ', b'+++ ', b'Index: ', b'@@ ')
+
+# The first line of a patch mailed by git format-patch
+FORMAT_PATCH_FROM = re.compile(br'^From [0-9a-f]{40} ')
+
+# Headers of a mailed patch, whose diff follows a '---' line
+MAIL_HEADER_PREFIXES = (b'From: ', b'Subject: ', b'Date: ')
+
+# Number of bytes at the start of a file used to identify its format
+SNIFF_SIZE = 512
+
+# Number of bytes searched for the start of a diff, which may follow
+# a long description
+DIFF_SNIFF_SIZE = 64 * 1024
+
 SUPPORTED_URL_SCHEMES = ["http", "https"]
 
+# Size of the chunks read from the network while streaming a download
+CHUNK_SIZE = 64 * 1024
+
+# Time allowed for a mirror to send the first byte of a file
+PROBE_TIMEOUT = 5
+
 
 def requests_retry_session(retries):
     """Return a requests session that will try the download [retries] times"""
@@ -58,38 +110,100 @@ def requests_retry_session(retries):
     return session
 
 
+class IncompleteDownload(Exception):
+    """Exception thrown when a download ends before all data is received"""
+    pass
+
+
 class FetchVerifyError(Exception):
     """Exception thrown by the best_effort_file_verify function"""
     pass
 
 
-def best_effort_file_verify(path):
+def sniff_mime_type(head):
+    """
+    Return the mime-type of a file, identified from the first bytes
+    of its contents, [head].
+    """
+    for offset, magic, mime_type in MAGIC_TO_MIME:
+        if head[offset:offset + len(magic)] == magic:
+            return mime_type
+
+    # A diff may add or change HTML files, so look for diffs first
+    lines = head.splitlines()
+    if any(line.startswith(DIFF_LINE_PREFIXES) for line in lines):
+        return 'text/x-diff'
+
+    if (lines and FORMAT_PATCH_FROM.match(lines[0])) or \
+            (any(line.startswith(MAIL_HEADER_PREFIXES) for line in lines) and
+             b'---' in lines):
+        return 'text/x-diff'
+
+    if b'<html' in head.lower() or \
+            head.lstrip().lower().startswith(b'<!doctype html'):
+        return 'text/html'
+
+    return 'application/octet-stream'
+
+
+def best_effort_file_verify(path, head):
     """
-    Given a path, check if the file at that path has a sensible format.
+    Given a path and the first bytes of the file at that path, check if
+    the file has a sensible format.
     If the file has an extension then it checks that the mime-type of this file
     matches that of the file extension as defined by the IANA:
         http://www.iana.org/assignments/media-types/media-types.xhtml
     """
     _, ext = os.path.splitext(path)
     if ext and ext in SUPPORTED_EXT_TO_MIME:
-        # output of `file` is of form: "<path>: <mime-type>"
-        cmd = ["file", "--mime-type", path]
-        stdout = run(cmd, check=False)['stdout'].strip()
-        _, _, mime_type = stdout.partition(': ')
-
+        mime_type = sniff_mime_type(head)
         if SUPPORTED_EXT_TO_MIME[ext] != mime_type:
             raise FetchVerifyError(
                 "%s: Fetched file format looks incorrect: %s: %s" %
                 (sys.argv[0], path, mime_type))
 
 
+class FormatVerifier(object):
+    """
+    Verifies the format of a file while it is being downloaded, as soon
+    as its first SNIFF_SIZE bytes have been received, or DIFF_SNIFF_SIZE
+    bytes for patches.   Raises FetchVerifyError so that downloads of
+    error pages can be abandoned early.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.head = b''
+        self.verified = False
+        _, ext = os.path.splitext(path)
+        if SUPPORTED_EXT_TO_MIME.get(ext) == 'text/x-diff':
+            self.size = DIFF_SNIFF_SIZE
+        else:
+            self.size = SNIFF_SIZE
+
+    def update(self, data):
+        """Feed the next chunk of data in the file to the verifier"""
+        if self.verified:
+            return
+        self.head += data[:self.size - len(self.head)]
+        if len(self.head) >= self.size:
+            self.finish()
+
+    def finish(self):
+        """Verify the file, if it was too short to be verified already"""
+        if not self.verified:
+            self.verified = True
+            best_effort_file_verify(self.path, self.head)
+
+
 def parse_args_or_exit(argv=None):
     """
     Parse command line options
     """
     parser = argparse.ArgumentParser(description='Download package sources',
                                      parents=[common_base_parser(),
-                                              rpm_define_parser()])
+                                              rpm_define_parser(),
+                                              ref_cache_parser()])
     parser.add_argument('spec', help='RPM Spec')
     parser.add_argument('link', help='Link file', nargs="?")
     parser.add_argument("source", metavar="SOURCE",
@@ -105,25 +219,299 @@ def parse_args_or_exit(argv=None):
     return parser.parse_args(argv)
 
 
-def write_originfile(name, url, sha=None):
+def write_originfile(name, url, sha=None, validators=None):
     """
-    Write "[url]\n[sha]\n" in [name].origin for tracking
+    Write "[url]\n[sha]\n" in [name].origin for tracking, followed by
+    one "[key]: [value]" line for each of the cache [validators]
+    (ETag, Last-Modified, size and content hash) of the file.
     """
     if sha is None:
         sha = ""
     content = "{}\n{}\n".format(url, sha)
+    if validators:
+        content += "".join("{}: {}\n".format(key, value)
+                           for key, value in sorted(validators.items())
+                           if value is not None)
     with open('{0}.origin'.format(name), 'w') as origin_file:
         origin_file.write(content)
 
 
-def fetch_http(url, filename, retries):
+def read_originfile(name):
     """
-    Download the file at url and store it as filename
+    Read [name].origin and return a (url, sha, validators) tuple.
+    Returns (None, None, {}) if there is no origin file.
     """
+    try:
+        with open('{0}.origin'.format(name)) as origin_file:
+            lines = origin_file.read().splitlines()
+    except IOError as exn:
+        if exn.errno != errno.ENOENT:
+            raise
+        return (None, None, {})
 
-    url_string = urlunparse(url)
-    logging.debug("Fetching %s to %s", url_string, filename)
+    url = lines[0] if lines else None
+    sha = lines[1] if len(lines) > 1 else None
+    validators = {}
+    for line in lines[2:]:
+        key, sep, value = line.partition(': ')
+        if sep:
+            validators[key] = value
+    return (url, sha, validators)
+
+
+def conditional_headers(url_string, filename, mirror=None):
+    """
+    Return the headers needed to make a conditional request for
+    [url_string], or its copy on [mirror], which will succeed with
+    304 Not Modified if [filename] is still an up to date copy of it.
+    """
+    url, _, validators = read_originfile(filename)
+    if url != url_string or not os.path.isfile(filename):
+        return {}
+
+    # Validators issued by one mirror mean nothing to the others
+    if validators.get('mirror') != mirror:
+        return {}
+
+    # Do not trust the validators if the file has been changed since
+    # it was downloaded
+    if validators.get('size') != str(os.path.getsize(filename)):
+        return {}
+
+    headers = {}
+    if 'etag' in validators:
+        headers['If-None-Match'] = validators['etag']
+    if 'last-modified' in validators:
+        headers['If-Modified-Since'] = validators['last-modified']
+    return headers
+
+
+def copy_stream(src, dst, *digests):
+    """
+    Copy the contents of file-like object [src] to [dst], if it is not None,
+    passing the data to the update() method of each of [digests] on the way.
+    Returns the number of bytes copied.
+    """
+    size = 0
+    for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+        for digest in digests:
+            digest.update(chunk)
+        size += len(chunk)
+        if dst is not None:
+            dst.write(chunk)
+    return size
+
+
+def resume_headers(url_string, partname):
+    """
+    Return an (offset, headers) tuple describing how to resume the
+    partial download of [url_string] held in [partname].   The headers
+    make the server send the rest of the file if it has not changed
+    since the partial download started, or the whole file otherwise.
+    Returns (0, {}) if the download cannot be resumed.
+    """
+    url, _, validators = read_originfile(partname)
+    if url != url_string or not os.path.isfile(partname):
+        return (0, {})
+
+    offset = os.path.getsize(partname)
+    validator = validators.get('etag', validators.get('last-modified'))
+    if not offset or validator is None:
+        return (0, {})
+
+    return (offset, {'Range': 'bytes=%d-' % offset, 'If-Range': validator})
+
+
+def expected_size(req, offset):
+    """
+    Return the total size of the file being downloaded by [req], which
+    starts at [offset], or None if the server did not say.
+    """
+    if req.status_code == 206:
+        # Content-Range: bytes <start>-<end>/<total>
+        _, _, total = req.headers.get('Content-Range', '').partition('/')
+        return int(total) if total.isdigit() else None
+    if 'Content-Encoding' in req.headers:
+        return None
+    length = req.headers.get('Content-Length')
+    return offset + int(length) if length and length.isdigit() else None
+
+
+# pylint: disable=too-many-locals
+def download_part(session, url_string, headers, filename, condition):
+    """
+    Download [url_string] into the partial file [filename].part, resuming
+    an earlier partial download if the server supports range requests.
+    Unless a download is resumed, the [condition] headers are added to
+    the request.   Returns the validators of the completed download, or
+    None if the server says that [filename] is up to date.
+    """
+    partname = filename + ".part"
+    offset, extra_headers = resume_headers(url_string, partname)
+    if offset:
+        logging.debug("Resuming download of %s at byte %d", url_string,
+                      offset)
+    else:
+        extra_headers = condition
+
+    # Once we use requests >= 2.18.0, we should change this into
+    # with requests.get ... as r:
+    req = session.get(url_string, headers=dict(headers, **extra_headers),
+                      timeout=30, stream=True)
+
+    # 416 Range Not Satisfiable: the partial file is no good, start again
+    if offset and req.status_code == 416:
+        req.close()
+        os.remove(partname)
+        return download_part(session, url_string, headers, filename,
+                             condition)
+
+    req.raise_for_status()
+
+    # 304 Not Modified
+    if req.status_code == 304:
+        logging.debug("%s has not changed, keeping %s", url_string, filename)
+        req.close()
+        return None
 
+    content_hash = hashlib.sha256()
+    verifier = FormatVerifier(filename)
+    try:
+        if req.status_code == 206:
+            _, _, validators = read_originfile(partname)
+            with open(partname, 'rb') as part:
+                copy_stream(part, None, content_hash, verifier)
+        else:
+            # The server sent the whole file
+            offset = 0
+            validators = {
+                'etag': req.headers.get('ETag'),
+                'last-modified': req.headers.get('Last-Modified')
+            }
+            write_originfile(partname, url_string, None, validators)
+
+        with open(partname, 'ab' if offset else 'wb') as out:
+            size = offset + copy_stream(req.raw, out, content_hash, verifier)
+        verifier.finish()
+
+    except FetchVerifyError:
+        # Abandon the download without reading the rest of the body
+        req.close()
+        os.remove(partname)
+        os.remove('{0}.origin'.format(partname))
+        raise
+
+    if size < (expected_size(req, offset) or size):
+        raise IncompleteDownload("received %d of %d bytes" %
+                                 (size, expected_size(req, offset)))
+
+    validators['size'] = size
+    validators['sha256'] = content_hash.hexdigest()
+    return validators
+
+
+def download_cache_path(sha256):
+    """
+    Return the path at which content with the given SHA256 is kept in
+    the download cache, or None if the download cache is disabled.
+    """
+    cache_dir = Configuration.get('fetch', 'cache-dir',
+                                  os.path.expanduser('~/.planex/cache'))
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, 'sha256', sha256)
+
+
+def copy_verified(src, dst, sha256):
+    """
+    Atomically replace dst with a copy of src, if the content of src has
+    the given SHA256.   Returns False, leaving dst unchanged, if not.
+    The files are never linked, so that a tool which changes one of them
+    in place cannot change the other.
+    """
+    tmp = dst + ".part"
+    content_hash = hashlib.sha256()
+    with open(src, 'rb') as srch:
+        with open(tmp, 'wb') as tmph:
+            copy_stream(srch, tmph, content_hash)
+    if content_hash.hexdigest() != sha256:
+        os.remove(tmp)
+        return False
+    shutil.copymode(src, tmp)
+    os.rename(tmp, dst)
+    return True
+
+
+def file_sha256(filename):
+    """
+    Return the SHA256 of the content of filename
+    """
+    content_hash = hashlib.sha256()
+    with open(filename, 'rb') as fileh:
+        copy_stream(fileh, None, content_hash)
+    return content_hash.hexdigest()
+
+
+def fetch_from_cache(url_string, filename, sha256):
+    """
+    Make filename hold the content of url_string, whose SHA256 is known,
+    without going to the network.   Returns False if neither filename
+    nor the download cache already hold content with that hash.
+    """
+    # The origin file only records what was downloaded: the file itself
+    # may have been changed since, so check its content too
+    url, sha, validators = read_originfile(filename)
+    if validators.get('sha256') == sha256 and os.path.isfile(filename) and \
+            validators.get('size') == str(os.path.getsize(filename)) and \
+            file_sha256(filename) == sha256:
+        logging.debug("%s already holds %s", filename, url_string)
+        if url != url_string:
+            write_originfile(filename, url_string, None, validators)
+        return True
+
+    cache_path = download_cache_path(sha256)
+    if cache_path is None or not os.path.isfile(cache_path):
+        return False
+
+    logging.debug("Copying %s from the download cache %s", url_string,
+                  cache_path)
+    if not copy_verified(cache_path, filename, sha256):
+        logging.warning("Removing corrupt %s from the download cache",
+                        cache_path)
+        os.remove(cache_path)
+        return False
+    url, sha, validators = read_originfile(cache_path)
+    write_originfile(filename, url_string, sha if url == url_string else None,
+                     validators)
+    return True
+
+
+def store_in_cache(filename, sha256):
+    """
+    Add filename, whose content has the given SHA256, and its origin
+    file to the download cache
+    """
+    cache_path = download_cache_path(sha256)
+    if cache_path is None:
+        return
+
+    try:
+        makedirs(os.path.dirname(cache_path))
+        if not copy_verified(filename, cache_path, sha256):
+            logging.warning("Not adding %s to the download cache: it does "
+                            "not match its checksum", filename)
+            return
+        shutil.copyfile('{0}.origin'.format(filename),
+                        '{0}.origin'.format(cache_path))
+    except (IOError, OSError) as exn:
+        logging.warning("Could not add %s to the download cache: %s",
+                        filename, exn)
+
+
+def request_headers(netloc):
+    """
+    Return the headers to send with requests to netloc
+    """
     useragent = "planex-fetch/%s" % pkg_resources.require("planex")[0].version
 
     # We need this because centos ships requests 2.8.0
@@ -134,17 +522,136 @@ def fetch_http(url, filename, retries):
     })
 
     # See if we have any additional custom headers
-    add_custom_headers_for_url(url[1], headers)
+    add_custom_headers_for_url(netloc, headers)
+    return headers
 
-    # Once we use requests >= 2.18.0, we should change this into
-    # with requests.get ... as r:
-    req = requests_retry_session(retries).get(
-        url_string, headers=headers, timeout=30, stream=True)
-    req.raise_for_status()
 
-    with open(filename, 'wb') as out:
-        shutil.copyfileobj(req.raw, out)
-    best_effort_file_verify(filename)
+def probe(url_string):
+    """
+    Return the time taken to receive the first byte of url_string, or
+    None if it cannot be fetched.
+    """
+    headers = request_headers(urlparse(url_string).netloc)
+    headers['Range'] = 'bytes=0-0'
+    start = time.time()
+    try:
+        req = requests.get(url_string, headers=headers,
+                           timeout=PROBE_TIMEOUT, stream=True)
+        try:
+            if req.status_code not in (200, 206):
+                return None
+            req.raw.read(1)
+        finally:
+            req.close()
+    except (requests.RequestException, ProtocolError, ReadTimeoutError):
+        return None
+    return time.time() - start
+
+
+def rank_mirrors(candidates):
+    """
+    Race a probe of each of the candidate urls for a file and return them
+    ordered by preference: the healthy ones, fastest first, followed by
+    the others in their original order.
+    """
+    if len(candidates) < 2:
+        return candidates
+
+    pool = ThreadPool(len(candidates))
+    try:
+        latencies = pool.map(probe, candidates)
+    finally:
+        pool.close()
+
+    healthy = sorted((latency, url) for (latency, url)
+                     in zip(latencies, candidates) if latency is not None)
+    for (latency, url) in healthy:
+        logging.debug("Mirror %s responded in %.3fs", url, latency)
+    ranked = [url for (_, url) in healthy]
+    return ranked + [url for url in candidates if url not in ranked]
+
+
+# pylint: disable=too-many-arguments
+def download(session, candidate, url_string, filename, retries, sha256):
+    """
+    Download url_string from candidate, which is either url_string itself
+    or its location on a mirror, into filename.part.   Returns the
+    validators of the completed download, or None if filename is up to
+    date.
+    """
+    headers = request_headers(urlparse(candidate).netloc)
+    mirror = candidate if candidate != url_string else None
+    condition = conditional_headers(url_string, filename, mirror) \
+        if sha256 is None else {}
+
+    # The retry session only retries establishing the connection and
+    # receiving the response headers.   Errors while streaming the body
+    # are retried here, resuming from the end of the partial file.
+    attempt = 1
+    while True:
+        try:
+            validators = download_part(session, candidate, headers,
+                                       filename, condition)
+            break
+        except (ProtocolError, ReadTimeoutError, IncompleteDownload) as exn:
+            if attempt >= retries:
+                raise requests.ConnectionError(exn)
+            logging.warning("Download of %s interrupted: %s", candidate, exn)
+            attempt += 1
+
+    if validators is None:
+        return None
+
+    partname = filename + ".part"
+    if sha256 is not None and validators['sha256'] != sha256:
+        os.remove(partname)
+        os.remove('{0}.origin'.format(partname))
+        raise FetchVerifyError(
+            "%s: Fetched file checksum is incorrect: %s: expected %s, got %s"
+            % (sys.argv[0], filename, sha256, validators['sha256']))
+
+    validators['mirror'] = mirror
+    return validators
+
+
+def fetch_http(url, filename, retries, sha256=None):
+    """
+    Download the file at url and store it as filename.
+    If filename already holds an up to date copy of the file, it is
+    left untouched so that its modification time is preserved.
+    The file is downloaded to filename.part and renamed once complete;
+    interrupted downloads are resumed by later retries or invocations.
+    If the SHA256 of the file is given, the download is checked against
+    it and the network is not used at all if filename or the download
+    cache already hold the expected content.
+    If mirrors are configured for the host, the file is fetched from the
+    fastest one to respond, falling back to the others on failure.
+    """
+
+    url_string = urlunparse(url)
+    logging.debug("Fetching %s to %s", url_string, filename)
+
+    if sha256 is not None and fetch_from_cache(url_string, filename, sha256):
+        return
+
+    session = requests_retry_session(retries)
+    candidates = rank_mirrors(mirrors_for_url(url_string))
+    for candidate in candidates:
+        try:
+            validators = download(session, candidate, url_string, filename,
+                                  retries, sha256)
+            break
+        except (requests.RequestException, FetchVerifyError) as exn:
+            if candidate == candidates[-1]:
+                raise
+            logging.warning("Failed to fetch %s: %s", candidate, exn)
+
+    if validators is None:
+        return
+
+    partname = filename + ".part"
+    os.rename(partname, filename)
+    os.remove('{0}.origin'.format(partname))
 
     # pylint: disable=W0703
     # best-effort get git commitish
@@ -154,13 +661,15 @@ def fetch_http(url, filename, retries):
     except Exception:
         sha = None
 
-    write_originfile(filename, url_string, sha)
+    write_originfile(filename, url_string, sha, validators)
+    if sha256 is not None:
+        store_in_cache(filename, sha256)
 
 
-def fetch_url(url, source, retries):
+def fetch_url(url, source, retries, sha256=None):
     """Fetch from specified URL"""
     try:
-        fetch_http(url, source, retries)
+        fetch_http(url, source, retries, sha256)
 
     except requests.RequestException as exn:
         # Download failed
@@ -173,37 +682,73 @@ def fetch_url(url, source, retries):
                  (sys.argv[0], exn.strerror, exn.filename))
 
     except FetchVerifyError as exn:
-        # MIME type mismatch
+        # MIME type or checksum mismatch
         sys.exit(exn.message)
 
 
 def fetch_repo(url, resource):
-    """Git archive from local git repo"""
+    """
+    Git archive from local git repo.   The archive is left untouched if
+    it was made from the same tree, with the same prefix, as recorded in
+    its .origin file, unless the tree uses export-subst.
+    """
     reponame = os.path.basename(url.path).rsplit(".git")[0]
-    repo = git.Repo(os.path.join("repos", reponame))
-    with open(resource.path, "wb") as output:
-        if resource.prefix is not None:
-            prefix = str(resource.prefix)
-            logging.debug("Archiving %s#%s to %s, prefix %s", repo.working_dir,
-                          resource.commitish, resource.path, prefix)
-        else:
-            prefix = None
-            logging.debug("Archiving %s#%s to %s", repo.working_dir,
-                          resource.commitish, resource.path)
-        arc_format = 'tar'
-        if resource.path.endswith('tar.gz'):
-            arc_format = 'tar.gz'
-
-        repo.archive(output, treeish=str(resource.commitish),
-                     prefix=prefix, format=arc_format)
-
+    # planex-clone may have checked the commitish out as a worktree
+    # named after it
+    checkout = planex.worktree.Destinations.find("repos", resource)
+    repo_path = str(checkout or os.path.join("repos", reponame))
+    commitish = str(resource.commitish)
+    if not os.path.isdir(repo_path):
+        # Without a local checkout, archive tags and SHA1s from the
+        # local mirror
+        mirror = planex.mirror.find_mirror(urlunparse(url))
+        if mirror is not None and planex.git.is_immutable(mirror, commitish):
+            repo_path = mirror
+    repo = git.Repo(repo_path)
+    prefix = str(resource.prefix) if resource.prefix is not None else None
+    tree = repo.commit(commitish).tree.hexsha
     try:
-        ref = repo.refs[str(resource.commitish)]
+        ref = repo.refs[commitish]
         sha = ref.object.hexsha
     except (IndexError, AttributeError):
         sha = None
+    origin = repo.remotes.origin.url if repo.remotes else urlunparse(url)
+
+    # Archives of trees with export-subst attributes contain details of
+    # the commit, so they can only be reused for the same commit
+    origin_url, recorded_sha, recorded = read_originfile(resource.path)
+    if os.path.isfile(resource.path) and recorded.get('tree') == tree \
+            and recorded.get('prefix') == prefix and \
+            not planex.git.uses_export_subst(repo_path, commitish):
+        logging.debug("%s is up to date with %s#%s (tree %s)",
+                      resource.path, repo.working_dir, commitish, tree)
+        if (origin_url, recorded_sha or None) != (origin, sha):
+            write_originfile(resource.path, origin, sha, recorded)
+        return
+
+    partname = resource.path + ".part"
+    with open(partname, "wb") as output:
+        if prefix is not None:
+            logging.debug("Archiving %s#%s to %s, prefix %s", repo.working_dir,
+                          commitish, resource.path, prefix)
+        else:
+            logging.debug("Archiving %s#%s to %s", repo.working_dir,
+                          commitish, resource.path)
+        cmd = ['git', 'archive', '--format=tar', commitish]
+        if prefix is not None:
+            cmd.insert(3, '--prefix=%s' % prefix)
 
-    write_originfile(resource.path, repo.remotes.origin.url, sha)
+        if resource.path.endswith('tar.gz'):
+            proc = subprocess.Popen(cmd, cwd=repo.working_dir,
+                                    stdout=subprocess.PIPE)
+            compress_stream(proc.stdout, output)
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+        else:
+            subprocess.check_call(cmd, cwd=repo.working_dir, stdout=output)
+    os.rename(partname, resource.path)
+    write_originfile(resource.path, origin, sha,
+                     {'tree': tree, 'prefix': prefix})
 
 
 class UnsupportedScheme(Exception):
@@ -217,7 +762,7 @@ def fetch_source_dispatch(resource, retries):
     """
     url = urlparse(resource.url)
     if url.scheme in SUPPORTED_URL_SCHEMES:
-        fetch_url(url, resource.path, retries + 1)
+        fetch_url(url, resource.path, retries + 1, resource.sha256)
 
     elif url.scheme == 'ssh':
         fetch_repo(url, resource)
@@ -252,6 +797,20 @@ def fetch_source(args):
     except UnsupportedScheme as exn:
         sys.exit("%s: Unsupported url scheme %s" %
                  (sys.argv[0], exn))
+    index_tarball(resource.path)
+
+
+def index_tarball(path):
+    """
+    Write the member index of the tarball at path, if it is one, so that
+    later commands need not read all of it to list its members
+    """
+    if not tarfile.is_tarfile(path):
+        return
+    try:
+        planex.tarball.load_index(path)
+    except tarfile.TarError as exn:
+        logging.warning("Could not index %s: %s", path, exn)
 
 
 def main(argv=None):
@@ -261,5 +820,6 @@ def main(argv=None):
     setup_sigint_handler()
     args = parse_args_or_exit(argv)
     setup_logging(args)
+    RefCache.bypass = not args.ref_cache
 
     fetch_source(args)
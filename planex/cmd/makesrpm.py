@@ -16,7 +16,7 @@ import argcomplete
 import planex.cmd.args
 from planex.spec import load
 from planex.link import Link
-from planex.tarball import Tarball
+from planex.tarball import Tarball, TarballCache
 
 
 def parse_args_or_exit(argv=None):
@@ -160,8 +160,11 @@ def main(argv=None):
     tmpdir = tempfile.mkdtemp(prefix="px-srpm-")
 
     try:
-        spec = load(args.spec, args.link, defines=args.define)
-        specfile = populate_working_directory(args.metadata, tmpdir, spec)
+        # Each tarball is listed once, however many resources it serves
+        with TarballCache():
+            spec = load(args.spec, args.link, defines=args.define)
+            specfile = populate_working_directory(args.metadata, tmpdir,
+                                                  spec)
         sys.exit(rpmbuild(args, tmpdir, specfile))
 
     except (tarfile.TarError, tarfile.ReadError) as exc:
@@ -0,0 +1,94 @@
+"""
+planex-mirror: Create and update local bare mirrors of the git
+repositories referred to by spec, link and pin files
+"""
+
+import argparse
+import glob
+import logging
+from multiprocessing.pool import ThreadPool
+import os.path
+import sys
+
+import argcomplete
+from planex.cmd.args import common_base_parser
+from planex.cmd.clone import definitions_for
+from planex.link import Link
+import planex.mirror
+from planex.util import setup_logging
+import planex.spec
+
+
+def parse_args_or_exit(argv=None):
+    """
+    Parse command line options
+    """
+    parser = argparse.ArgumentParser(
+        description='Create and update local mirrors of the git '
+                    'repositories used by packages.   The mirrors are '
+                    'used by planex-clone, planex-fetch and planex-pin.',
+        parents=[common_base_parser()])
+    parser.add_argument("pins", metavar="PACKAGE", nargs="*",
+                        help="package name, or link or pin file "
+                             "(default: every spec in SPECS)")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=4,
+                        help="Update up to N mirrors at once")
+    argcomplete.autocomplete(parser)
+    return parser.parse_args(argv)
+
+
+def repository_urls(packages):
+    """
+    Return the sorted URLs of the git repositories used by packages
+    """
+    urls = set()
+    for pin in packages:
+        _, spec_path, link_pin_path = definitions_for(pin)
+        link_pin = Link(str(link_pin_path)) if link_pin_path else None
+        spec = planex.spec.load(str(spec_path), link=link_pin,
+                                check_package_name=False)
+        urls.update(resource.url for resource in spec.resources()
+                    if resource.is_repo)
+    return sorted(urls)
+
+
+def update(url):
+    """
+    Update the mirror of url, returning the error message on failure
+    """
+    try:
+        planex.mirror.update_mirror(url)
+    # pylint: disable=broad-except
+    except Exception as exn:
+        logging.error("Could not update mirror of %s: %s", url, exn)
+        return str(exn)
+    return None
+
+
+def main(argv=None):
+    """
+    Entry point
+    """
+    args = parse_args_or_exit(argv)
+    setup_logging(args)
+
+    if planex.mirror.mirror_root() is None:
+        sys.exit("Mirrors are disabled in the [mirror] section")
+
+    packages = args.pins or sorted(glob.glob("SPECS/*.spec"))
+    packages = [os.path.splitext(os.path.basename(pkg))[0]
+                if pkg.endswith(".spec") else pkg for pkg in packages]
+    urls = repository_urls(packages)
+    logging.info("Updating %d mirrors in %s", len(urls),
+                 planex.mirror.mirror_root())
+
+    pool = ThreadPool(max(min(args.jobs, len(urls)), 1))
+    try:
+        errors = [error for error in pool.map(update, urls) if error]
+    finally:
+        pool.close()
+        pool.join()
+
+    if errors:
+        sys.exit("%d of %d mirrors could not be updated" %
+                 (len(errors), len(urls)))
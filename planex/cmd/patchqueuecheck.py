@@ -0,0 +1,304 @@
+"""
+planex-patchqueue-check: Check that the patches of packages apply to
+their sources, without building them
+"""
+from __future__ import print_function
+
+import argparse
+import getopt
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+import argcomplete
+import planex.cmd.args
+from planex.link import Link
+from planex.spec import load
+from planex.tarball import Tarball
+from planex.util import setup_logging
+
+# Directory backed by memory, where the sources are unpacked if it exists
+SHM_DIR = "/dev/shm"
+
+# Sections which end %prep
+SECTION_RE = re.compile(r"^%(build|install|check|clean|files|changelog|"
+                        r"description|package|pre|post|preun|postun|"
+                        r"pretrans|posttrans|trigger\w*|verifyscript)\b")
+
+# Options of the macros which apply patches in %prep
+MACRO_OPTIONS = {
+    "autosetup": "a:b:cDn:NqTS:p:v",
+    "autopatch": "p:vqm:M:",
+    "patch": "P:p:b:z:ERF:d:o:Zs",
+}
+
+
+def parse_args_or_exit(argv=None):
+    """
+    Parse command line options
+    """
+    parser = argparse.ArgumentParser(
+        description="Check that the patches and patchqueues of packages "
+                    "apply to their sources.   The sources must already "
+                    "have been fetched.",
+        parents=[planex.cmd.args.common_base_parser(),
+                 planex.cmd.args.rpm_define_parser(),
+                 planex.cmd.args.keeptmp_parser()])
+    parser.add_argument("specs", metavar="SPEC/LINK/SOURCE", nargs="+",
+                        help="Spec files, with the link or pin files which "
+                             "override them.   Other files are ignored, "
+                             "so the prerequisites of a source RPM can "
+                             "be passed.")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=4,
+                        help="Check up to N packages at once")
+    argcomplete.autocomplete(parser)
+    return parser.parse_args(argv)
+
+
+def pkgname(path):
+    """
+    Return the name of the package at path
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def specs_and_links(paths):
+    """
+    Return a list of (spec path, link path or None) pairs for the spec
+    files in paths.   A pin file overrides a link file for the same
+    package.
+    """
+    links = {}
+    for path in paths:
+        if path.endswith(".lnk"):
+            links.setdefault(pkgname(path), path)
+    for path in paths:
+        if path.endswith(".pin"):
+            links[pkgname(path)] = path
+    return [(path, links.get(pkgname(path)))
+            for path in paths if path.endswith(".spec")]
+
+
+def prep_lines(spec):
+    """
+    Return the lines of the %prep section of spec
+    """
+    lines = []
+    in_prep = False
+    for line in spec.spectext:
+        line = line.strip()
+        if re.match(r"^%prep\b", line):
+            in_prep = True
+        elif in_prep and SECTION_RE.match(line):
+            break
+        elif in_prep:
+            lines.append(line)
+    return lines
+
+
+def applied_patches(lines):
+    """
+    Generate a description of each application of patches by the %prep
+    section lines, in order, as (numbers, minimum, maximum, strip, fuzz)
+    tuples.   numbers lists the numbers of the Patch lines applied, or
+    is None if all of those between minimum and maximum, which may also
+    be None, are applied.   strip is the -p level, or None for patch's
+    default.
+    """
+    for line in lines:
+        match = re.match(r"^%(autosetup|autopatch|patch)(\d*)(\s.*)?$", line)
+        if match is None:
+            continue
+        macro, number, args = match.groups()
+        try:
+            opts, args = getopt.gnu_getopt(shlex.split(args or ""),
+                                           MACRO_OPTIONS[macro])
+        except (getopt.GetoptError, ValueError) as exn:
+            logging.warning("Cannot tell which patches '%s' applies: %s",
+                            line, exn)
+            continue
+        opts = dict(opts)
+        strip = int(opts["-p"]) if "-p" in opts else None
+        fuzz = int(opts.get("-F", 0))
+
+        if macro == "autosetup":
+            if "-N" not in opts:
+                yield (None, None, None, strip, fuzz)
+        elif macro == "autopatch":
+            yield ([int(arg) for arg in args] or None,
+                   int(opts.get("-m", 0)),
+                   int(opts["-M"]) if "-M" in opts else None, strip, fuzz)
+        else:
+            numbers = [number] if number else args
+            if "-P" in opts:
+                numbers = numbers + [opts["-P"]]
+            # %patch on its own applies Patch0, with -p0
+            yield ([int(num) for num in numbers or ["0"]], None, None,
+                   strip or 0, fuzz)
+
+
+def patches_of(spec):
+    """
+    Return the patches of spec which its %prep section applies, in
+    order, as (name, strip, fuzz) tuples.   The patches of patchqueues
+    come after the Patch lines, and are applied by %autosetup and
+    %autopatch.
+    """
+    resources = spec.resources_dict()
+
+    def indices(kind):
+        """Return the sorted indices of the resources of kind"""
+        return sorted(int(name[len(kind):]) for name in resources
+                      if re.match(r"^%s\d+$" % kind, name))
+
+    series = []
+    for index in indices("PatchQueue"):
+        series += resources["PatchQueue%d" % index].series()
+
+    patches = []
+    for numbers, minimum, maximum, strip, fuzz in \
+            applied_patches(prep_lines(spec)):
+        applies_all = numbers is None and maximum is None
+        if numbers is None:
+            numbers = [index for index in indices("Patch")
+                       if index >= (minimum or 0) and
+                       (maximum is None or index <= maximum)]
+        patches += [(os.path.basename(resources["Patch%d" % index].path),
+                     strip, fuzz)
+                    for index in numbers if "Patch%d" % index in resources]
+        # Patchqueues are added to the spec after its Patch lines
+        if applies_all:
+            patches += [(patch, strip, fuzz) for patch in series]
+    return patches
+
+
+def unpack(tarball_path, destdir):
+    """
+    Unpack the tarball at tarball_path into destdir, returning the
+    directory holding its contents, as %autosetup would enter
+    """
+    with Tarball(tarball_path) as tarball:
+        tarball.tarfile.extractall(destdir)
+        return os.path.join(destdir, tarball.archive_root)
+
+
+def apply_patches(tree, patch_dir, patches):
+    """
+    Apply patches, (name, strip, fuzz) tuples as returned by patches_of,
+    in patch_dir, to the source tree in order, as rpmbuild would.
+    Stops at the first patch which does not apply.   Returns None if all
+    of them apply, or the name of the patch which does not and the
+    output of patch.
+    """
+    for patch, strip, fuzz in patches:
+        # Patches are extracted without the directories in their names
+        cmd = ["patch", "--fuzz=%d" % fuzz, "--force", "--batch",
+               "--no-backup-if-mismatch", "-i",
+               os.path.abspath(os.path.join(patch_dir,
+                                            os.path.basename(patch)))]
+        if strip is not None:
+            cmd.insert(1, "-p%d" % strip)
+        proc = subprocess.Popen(cmd, cwd=tree, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            return patch, output.decode("utf-8", "replace")
+        logging.debug("Applied %s", patch)
+    return None
+
+
+class PackageCheck(object):
+    """
+    The check of a package's patches against its sources.   The
+    patches are extracted when the check is prepared, as that reads
+    the spec; applying them does not, so checks can run concurrently.
+    """
+
+    # pylint: disable=R0903
+
+    def __init__(self, spec, workdir):
+        self.name = spec.name()
+        self.workdir = workdir
+        self.patch_dir = os.path.join(workdir, "patches")
+        os.mkdir(self.patch_dir)
+        self.patches = patches_of(spec)
+        source = spec.resources_dict().get("Source0")
+        self.source = source.path if source else None
+        if self.patches:
+            spec.extract_sources(sorted(set(patch for patch, _, _
+                                            in self.patches)),
+                                 self.patch_dir)
+
+    def run(self):
+        """
+        Unpack the sources and apply the patches to them.   Returns None
+        if they all apply, or a message describing the first which does
+        not.
+        """
+        if not self.patches:
+            logging.debug("%s has no patches", self.name)
+            return None
+        if self.source is None or not tarfile.is_tarfile(self.source):
+            logging.warning("%s: cannot check patches: %s is not a tarball",
+                            self.name, self.source)
+            return None
+
+        tree = unpack(self.source, os.path.join(self.workdir, "sources"))
+        failure = apply_patches(tree, self.patch_dir, self.patches)
+        if failure is None:
+            logging.info("%s: all %d patches apply", self.name,
+                         len(self.patches))
+            return None
+        patch, output = failure
+        position = [name for name, _, _ in self.patches].index(patch) + 1
+        return "%s: patch %s (%d of %d) does not apply:\n%s" % (
+            self.name, patch, position, len(self.patches), output)
+
+
+def main(argv=None):
+    """
+    Entry point
+    """
+    args = parse_args_or_exit(argv)
+    setup_logging(args)
+
+    tmp_root = SHM_DIR if os.access(SHM_DIR, os.W_OK) else None
+    tmpdir = tempfile.mkdtemp(prefix="px-pqcheck-", dir=tmp_root)
+    try:
+        # Specs are read one at a time: RPM macro state is not thread safe
+        checks = []
+        for spec_path, link_path in specs_and_links(args.specs):
+            link = Link(link_path) if link_path else None
+            spec = load(spec_path, link, defines=args.define)
+            workdir = os.path.join(tmpdir, spec.name())
+            os.mkdir(workdir)
+            checks.append(PackageCheck(spec, workdir))
+
+        failures = []
+        if checks:
+            pool = ThreadPool(max(min(args.jobs, len(checks)), 1))
+            try:
+                failures = [failure for failure in
+                            pool.map(lambda check: check.run(), checks)
+                            if failure is not None]
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        # Clean temporary area (unless debugging)
+        if args.keeptmp:
+            print("Working directory retained at %s" % tmpdir)
+        else:
+            shutil.rmtree(tmpdir)
+
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
@@ -5,17 +5,29 @@ in xenserver-specs/repos/ to override the spec/lnk
 from __future__ import print_function
 
 import argparse
+from glob import glob
 import json
+import logging
+from multiprocessing.pool import ThreadPool
 import os
 import sys
 import errno
 
 from planex.blobs import Archive
-from planex.cmd.args import common_base_parser
+from planex.cmd.args import common_base_parser, ref_cache_parser
 from planex.link import Link
+from planex.refcache import RefCache
 from planex.repository import Repository
-from planex.util import makedirs
+from planex.util import makedirs, setup_logging
+import planex.git
 import planex.spec
+from planex.worktree import Destinations
+
+# Number of local repositories read concurrently by --all
+HEAD_JOBS = 8
+
+# The resources a pin file overrides, the final one first
+PINNED_RESOURCES = ("PatchQueue0", "Archive0", "Source0")
 
 RPM_DEFINES = [("dist", "pinned"),
                ("_topdir", "."),
@@ -43,28 +55,46 @@ def load_spec_and_lnk(repo_path, package_name):
     return spec
 
 
-def populate_pinfile(pinfile, resources):
+def populate_pinfile(pinfile, resources, heads=None):
     """
-    Update [pinfile] in place with content of resources.
+    Update [pinfile] in place with content of resources.   If heads is
+    given, it maps the names of repository resources to the commitishes
+    checked out locally, which replace theirs, and the other sources are
+    pinned to their URLs without querying any remote.
     """
+    # Exclude secondary resources
+    resources = {name: source for name, source in resources.items()
+                 if name in PINNED_RESOURCES}
+
+    # Resolve all the non-repository sources together, so that each
+    # remote is only queried once
+    urls = [source.url for source in resources.values()
+            if not source.is_repo]
+    if heads is None:
+        repos = dict(zip(urls, Repository.resolve_all(urls)))
+
     for name, source in resources.items():
-        # Exclude secondary resources
-        if name not in ("Archive0", "PatchQueue0", "Source0"):
-            continue
 
         pinfile[name] = {}
         if source.is_repo:
             url = source.url
-            commitish = source.commitish
+            commitish = (heads or {}).get(name, source.commitish)
             prefix = source.prefix
+        elif heads is not None:
+            url = source.url
+            commitish = None
+            prefix = None
         else:
-            repo = Repository(source.url)
+            repo = repos[source.url]
             commitish = repo.commitish_tag_or_branch()
             url = repo.repository_url()
             prefix = None
 
         if commitish is None:
             pinfile[name] = {"URL": source.url}
+            # The pin fetches the same file, so keep its checksum
+            if source.sha256 is not None:
+                pinfile[name]["sha256"] = source.sha256
         else:
             pinfile[name] = {
                 "URL": url,
@@ -75,6 +105,8 @@ def populate_pinfile(pinfile, resources):
             pinfile[name]["prefix"] = prefix
         if isinstance(source, Archive):
             pinfile[name]["prefix"] = source.prefix
+        if source.sparse:
+            pinfile[name]["sparse"] = source.sparse
 
 
 def get_pin_content(args, spec):
@@ -87,7 +119,7 @@ def get_pin_content(args, spec):
     populate_pinfile(pinfile, resources)
 
     # Apply changes to the URL or commitish to the final resource
-    for resource in ("PatchQueue0", "Archive0", "Source0"):
+    for resource in PINNED_RESOURCES:
         if resource in resources:
             if args.url:
                 pinfile[resource]["URL"] = args.url
@@ -98,6 +130,85 @@ def get_pin_content(args, spec):
     return pinfile
 
 
+def local_commitish(repo_path):
+    """
+    Return the commitish to pin to the checkout at repo_path: the branch
+    checked out, or the commit HEAD points to if HEAD is detached or on
+    one of the branches planex-clone creates for tags and commits
+    """
+    branch, sha1 = planex.git.head(repo_path)
+    if branch is None or branch.startswith("planex/"):
+        return sha1
+    return branch
+
+
+def find_checkouts(specs, repos_dir):
+    """
+    Return a dictionary mapping (package, resource name) to the checkout
+    in repos_dir of each repository resource of the (package, spec)
+    pairs in specs which has one: a clone of its URL, preferably the one
+    planex-clone named after its commitish
+    """
+    checkouts = {}
+    for package, spec in specs:
+        for name, source in spec.resources_dict().items():
+            if name not in PINNED_RESOURCES or not source.is_repo:
+                continue
+            path = Destinations.find(repos_dir, source)
+            if path is not None:
+                checkouts[(package, name)] = str(path)
+    return checkouts
+
+
+def local_commitishes(paths):
+    """
+    Return a dictionary mapping each of the checkouts in paths to its
+    local_commitish, reading several at once
+    """
+    paths = sorted(set(paths))
+    if not paths:
+        return {}
+    pool = ThreadPool(min(HEAD_JOBS, len(paths)))
+    try:
+        return dict(zip(paths, pool.map(local_commitish, paths)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def pin_all(repos_dir):
+    """
+    Write a pin file for each package in SPECS whose repositories are
+    checked out in repos_dir, pinning them to the commitishes checked
+    out there.   Only the local repositories are read.   Returns the
+    paths of the pin files written.
+    """
+    # Specs are loaded one at a time: RPM macro state is not thread safe
+    specs = []
+    for specname in sorted(glob("SPECS/*.spec")):
+        package = os.path.basename(specname)[:-len(".spec")]
+        logging.debug("Reading spec file %s", specname)
+        specs.append((package, load_spec_and_lnk(os.getcwd(), package)))
+
+    checkouts = find_checkouts(specs, repos_dir)
+    commitishes = local_commitishes(checkouts.values())
+
+    written = []
+    for package, spec in specs:
+        heads = {name: commitishes[path]
+                 for (pkg, name), path in checkouts.items() if pkg == package}
+        if not heads:
+            continue
+        pinfile = {"SchemaVersion": "3"}
+        populate_pinfile(pinfile, spec.resources_dict(), heads)
+        output = "PINS/{}.pin".format(package)
+        makedirs(os.path.dirname(output))
+        with open(output, "w") as out:
+            json.dump(pinfile, out, indent=2, sort_keys=True)
+        written.append(output)
+    return written
+
+
 def parse_args_or_exit(argv=None):
     """
     Parse command line options
@@ -109,8 +220,16 @@ def parse_args_or_exit(argv=None):
                     "Note that when URL is an ssh url to a git repository, "
                     "planex will first look for a repository with the "
                     "same name cloned in the $CWD/repos folder.",
-        parents=[common_base_parser()])
-    parser.add_argument("package", metavar="PACKAGE", help="package name")
+        parents=[common_base_parser(), ref_cache_parser()])
+    parser.add_argument("package", metavar="PACKAGE", nargs="?",
+                        help="package name")
+    parser.add_argument("--all", action="store_true",
+                        help="Write a pin file in PINS for every package "
+                             "whose repositories are checked out in "
+                             "--repos, pinning them to the branch or "
+                             "commit checked out.   No remote is queried.")
+    parser.add_argument("-r", "--repos", metavar="DIR", default="repos",
+                        help="Local path to the repositories read by --all")
 
     write = parser.add_mutually_exclusive_group()
     write.add_argument("-w", "--write", action="store_true",
@@ -132,7 +251,15 @@ def parse_args_or_exit(argv=None):
     parser.add_argument("--commitish",
                         help="Replace the commitish of the final resource")
 
-    return parser.parse_args(argv)
+    args = parser.parse_args(argv)
+    if args.all:
+        if any([args.package, args.output, args.show, args.unpin,
+                args.url, args.commitish]):
+            parser.error("--all cannot be used with PACKAGE, --output, "
+                         "--show, --unpin, --url or --commitish")
+    elif args.package is None:
+        parser.error("PACKAGE is required unless --all is given")
+    return args
 
 
 def main(argv=None):
@@ -141,6 +268,14 @@ def main(argv=None):
     """
 
     args = parse_args_or_exit(argv)
+    RefCache.bypass = not args.ref_cache
+
+    if args.all:
+        setup_logging(args)
+        for output in pin_all(args.repos):
+            if not args.quiet:
+                print("Wrote {}".format(output))
+        return
 
     package_name = args.package
     xs_path = os.getcwd()
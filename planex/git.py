@@ -5,6 +5,7 @@ Wrappers and utility functions for dealing with git repositories
 import os
 import re
 import subprocess
+import tarfile
 
 from planex.util import run
 
@@ -25,6 +26,15 @@ def dotgitdir_of_path(repo):
     possibilities = [os.path.join(repo, ".git"),
                      repo,
                      repo + ".git"]
+
+    # The .git of a worktree is a file pointing to its git dir
+    dotgit = os.path.join(repo, ".git")
+    if os.path.isfile(dotgit):
+        with open(dotgit) as fileh:
+            content = fileh.read().strip()
+        if content.startswith("gitdir: "):
+            possibilities[0] = os.path.join(repo, content[len("gitdir: "):])
+
     matches = [x for x in possibilities if
                os.path.exists(os.path.join(x, "HEAD"))]
     if matches:
@@ -33,6 +43,28 @@ def dotgitdir_of_path(repo):
         raise Exception("Not a git repository: '%s'" % repo)
 
 
+def common_dir(repo):
+    """
+    Return the path to the git dir holding the objects and configuration
+    of the repository, which for a worktree is that of the repository
+    it belongs to
+    """
+    dotgitdir = dotgitdir_of_path(repo)
+    commondir = os.path.join(dotgitdir, "commondir")
+    if os.path.exists(commondir):
+        with open(commondir) as fileh:
+            return os.path.normpath(os.path.join(dotgitdir,
+                                                 fileh.read().strip()))
+    return dotgitdir
+
+
+def is_shallow(repo):
+    """
+    Return True if the repository is a shallow clone
+    """
+    return os.path.exists(os.path.join(common_dir(repo), "shallow"))
+
+
 def archive(repo, commit_hash, output, prefix=None):
     """
     Archive a git repo at a given commit with a specified version prefix.
@@ -47,6 +79,236 @@ def archive(repo, commit_hash, output, prefix=None):
     subprocess.check_call(cmd, stdout=output)
 
 
+def version():
+    """
+    Return the version of the installed git as a tuple of integers
+    """
+    output = run(["git", "--version"])['stdout'].decode()
+    return tuple(int(part) for part in re.findall(r'\d+', output)[:3])
+
+
+def has_commit(repo, commitish):
+    """
+    Return True if commitish names a commit present in repo
+    """
+    dotgitdir = dotgitdir_of_path(repo)
+    return run(["git", "--git-dir=%s" % dotgitdir, "rev-parse", "--verify",
+                "--quiet", "%s^{commit}" % commitish], check=False)['rc'] == 0
+
+
+def is_immutable(repo, commitish):
+    """
+    Return True if commitish names the same commit in every copy of
+    repo: a full SHA1 or a tag, rather than a branch which may have
+    moved on since repo was last fetched
+    """
+    if re.match(r'^[0-9a-f]{40}$', commitish):
+        return True
+    if not commitish.startswith('refs/tags/'):
+        commitish = 'refs/tags/' + commitish
+    return has_commit(repo, commitish)
+
+
+def uses_export_subst(repo, commitish):
+    """
+    Return True if any .gitattributes file in commitish, or the
+    attributes of repo itself, set export-subst, so that archives of
+    commitish depend on the commit and not only on its tree
+    """
+    attributes = os.path.join(common_dir(repo), "info", "attributes")
+    if os.path.exists(attributes):
+        with open(attributes) as fileh:
+            if "export-subst" in fileh.read():
+                return True
+    dotgitdir = dotgitdir_of_path(repo)
+    return run(["git", "--git-dir=%s" % dotgitdir, "grep", "-q", "-F",
+                "export-subst", commitish, "--", ".gitattributes",
+                "*/.gitattributes"], check=False)['rc'] == 0
+
+
+def archive_commitish(repo, commitish, output, prefix=None):
+    """
+    Write a tar archive of commitish in repo to the file object output,
+    with prefix prepended to every path
+    """
+    dotgitdir = dotgitdir_of_path(repo)
+
+    cmd = ["git", "--git-dir=%s" % dotgitdir, "archive", "--format=tar"]
+    if prefix is not None:
+        cmd.append("--prefix=%s" % prefix)
+    cmd.append(commitish)
+    output.flush()
+    subprocess.check_call(cmd, stdout=output)
+
+
+def archive_remote(url, commitish, output, prefix=None):
+    """
+    Write a tar archive of commitish from the repository at url to the
+    file object output with git archive --remote, with prefix prepended
+    to every path.   Returns False, leaving output empty, if the server
+    does not allow it.
+    """
+    cmd = ['git', 'archive', '--remote=%s' % url, '--format=tar']
+    if prefix is not None:
+        cmd.append('--prefix=%s' % prefix)
+    cmd.append(commitish)
+    # Fail rather than prompt for credentials
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    with open(os.devnull, 'w') as quiet:
+        output.flush()
+        if subprocess.call(cmd, stdout=output, stderr=quiet, env=env) == 0:
+            return True
+    # Discard anything written before the failure
+    output.seek(0)
+    output.truncate()
+    return False
+
+
+def _to_bytes(text):
+    """Return text encoded as UTF-8, if it is not already bytes"""
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8', 'surrogateescape')
+
+
+def _fast_import_path(name):
+    """
+    Return name, a path in the form used in tar archives, as a path for
+    a git fast-import stream, or None if it cannot be stored in git
+    """
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or '.git' in parts:
+        return None
+    path = _to_bytes('/'.join(parts))
+    if path.startswith(b'"') or b'\n' in path:
+        path = b'"' + path.replace(b'\\', b'\\\\').replace(b'"', b'\\"') \
+            .replace(b'\n', b'\\n') + b'"'
+    return path
+
+
+def _fast_import_data(stream, length, chunks):
+    """Write a data command of length bytes, read from chunks"""
+    stream.write(b'data %d\n' % length)
+    for chunk in chunks:
+        stream.write(chunk)
+    stream.write(b'\n')
+
+
+def _read_chunks(fileobj, size=1024 * 1024):
+    """Generate the contents of fileobj in chunks of size bytes"""
+    while True:
+        chunk = fileobj.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _fast_import_members(stream, tar):
+    """
+    Write a blob to the git fast-import stream for each file and symlink
+    in tar, in the order they are stored.   Returns a dictionary mapping
+    each path to the mode and mark of its blob.
+    """
+    # Blobs are referred to by mark in the commit, so that hard links
+    # can refer to blobs already written
+    files = {}
+    marks = 0
+    for member in tar:
+        path = _fast_import_path(member.name)
+        if path is None:
+            continue
+        if member.isreg():
+            marks += 1
+            stream.write(b'blob\nmark :%d\n' % marks)
+            _fast_import_data(stream, member.size,
+                              _read_chunks(tar.extractfile(member)))
+            mode = b'100755' if member.mode & 0o100 else b'100644'
+            files[path] = (mode, marks)
+        elif member.issym():
+            target = _to_bytes(member.linkname)
+            marks += 1
+            stream.write(b'blob\nmark :%d\n' % marks)
+            _fast_import_data(stream, len(target), [target])
+            files[path] = (b'120000', marks)
+        elif member.islnk():
+            target = _fast_import_path(member.linkname)
+            if target in files:
+                files[path] = files[target]
+        elif path in files:
+            # Replaced by a directory
+            del files[path]
+    return files
+
+
+# Decompressors, by magic number, run beside git fast-import so that
+# decompression is not done by the tarfile module
+DECOMPRESSORS = [
+    (b'\x1f\x8b', ["gzip", "-dc"]),
+    (b'BZh', ["bzip2", "-dc"]),
+    (b'\xfd7zXZ\x00', ["xz", "-dc"]),
+]
+
+
+def _open_decompressed(archive_path):
+    """
+    Return a process writing the decompressed contents of the file at
+    archive_path to its standard output, or None if it is not compressed
+    """
+    with open(archive_path, 'rb') as archive_file:
+        magic = archive_file.read(6)
+    for prefix, cmd in DECOMPRESSORS:
+        if magic.startswith(prefix):
+            return subprocess.Popen(cmd + [archive_path],
+                                    stdout=subprocess.PIPE, bufsize=-1)
+    return None
+
+
+def import_tarball(repo, archive_path, ref, message, author, committer):
+    """
+    Commit the contents of the tarball at archive_path to ref in the new
+    repository repo.   Members are read in the order they are stored and
+    written straight into the object store by git fast-import, without
+    being extracted first.   Paths inside .git directories are ignored.
+    Author and committer are identities of the form 'Name <email>'.
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    proc = subprocess.Popen(["git", "fast-import", "--quiet", "--done",
+                             "--date-format=now"],
+                            cwd=repo, stdin=subprocess.PIPE,
+                            bufsize=-1)
+    stream = proc.stdin
+    decompressor = _open_decompressed(archive_path)
+    try:
+        if decompressor is None:
+            tar = tarfile.open(archive_path, 'r|')
+        else:
+            tar = tarfile.open(fileobj=decompressor.stdout, mode='r|')
+        with tar:
+            files = _fast_import_members(stream, tar)
+
+        stream.write(b'commit %s\n' % _to_bytes(ref))
+        stream.write(b'author %s now\n' % _to_bytes(author))
+        stream.write(b'committer %s now\n' % _to_bytes(committer))
+        message = _to_bytes(message)
+        _fast_import_data(stream, len(message), [message])
+        for path in sorted(files):
+            mode, mark = files[path]
+            stream.write(b'M %s :%d %s\n' % (mode, mark, path))
+        stream.write(b'\ndone\n')
+        if decompressor is not None:
+            # Read to the end, so that the exit status can be checked
+            for _ in _read_chunks(decompressor.stdout):
+                pass
+    finally:
+        stream.close()
+        status = [proc.wait()]
+        if decompressor is not None:
+            decompressor.stdout.close()
+            status.append(decompressor.wait())
+    if any(status):
+        raise Exception("git fast-import of %s failed" % archive_path)
+
+
 def tags(repo):
     """
     Return a list of all tags defined on repo.
@@ -62,6 +324,7 @@ def format_patch(repo, startref, endref, target_dir):
     series file.
     """
     dotgitdir = dotgitdir_of_path(repo)
+    ensure_history(repo)
 
     commit_range = "%s..%s" % (startref, endref)
     res = run(["git", "--git-dir=%s" % dotgitdir, "format-patch",
@@ -69,6 +332,27 @@ def format_patch(repo, startref, endref, target_dir):
     return res['stdout'].split()
 
 
+def ensure_history(repo):
+    """
+    Fetch the full history of repo if it is a shallow clone
+    """
+    dotgitdir = dotgitdir_of_path(repo)
+    if is_shallow(repo):
+        run(["git", "--git-dir=%s" % dotgitdir, "fetch", "--unshallow",
+             "--tags", "origin"])
+
+
+def object_store_size(repo):
+    """
+    Return the size in KiB of the objects, packed and loose, in repo
+    """
+    dotgitdir = dotgitdir_of_path(repo)
+    res = run(["git", "--git-dir=%s" % dotgitdir, "count-objects", "-v"])
+    counts = dict(line.split(": ", 1)
+                  for line in res['stdout'].splitlines() if ": " in line)
+    return int(counts.get("size", 0)) + int(counts.get("size-pack", 0))
+
+
 def origin_url(repo):
     """
     Return the remote url for origin
@@ -82,13 +366,31 @@ def origin_url(repo):
     return match.group(1).strip()
 
 
+def head(repo):
+    """
+    Return the name of the branch checked out in repo, or None if HEAD
+    is detached, and the SHA1 of the commit HEAD points to.   Only the
+    local repository is read.
+    """
+    dotgitdir = dotgitdir_of_path(repo)
+    sha1 = run(['git', '--git-dir=%s' % dotgitdir, 'rev-parse', '--verify',
+                'HEAD'])['stdout'].strip()
+    res = run(['git', '--git-dir=%s' % dotgitdir, 'symbolic-ref', '--quiet',
+               '--short', 'HEAD'], check=False)
+    branch = res['stdout'].strip() if res['rc'] == 0 else None
+    return branch, sha1
+
+
 def ls_remote(url, ref=None, *options):
     """
-    Run 'git ls-remote' command.
+    Run 'git ls-remote' command.   [ref] may be a single pattern or a
+    list of patterns.
     """
     cmd = ['git', 'ls-remote'] + list(options) + [url]
 
-    if ref is not None:
+    if isinstance(ref, (list, tuple)):
+        cmd += ref
+    elif ref is not None:
         cmd.append(ref)
 
     proc = subprocess.Popen(
@@ -99,7 +401,22 @@ def ls_remote(url, ref=None, *options):
 
     stdout, stderr = proc.communicate()
 
-    if stderr:
+    # git prints warnings, such as host key notices, on stderr even
+    # when it succeeds
+    if proc.returncode != 0:
         raise RuntimeError(stderr)
 
     return stdout
+
+
+def parse_ls_remote(output):
+    """
+    Parse the output of 'git ls-remote' into a dictionary mapping ref
+    names to SHA1s
+    """
+    refs = {}
+    for line in output.splitlines():
+        sha, _, ref = line.partition('\t')
+        if ref:
+            refs[ref] = sha
+    return refs
@@ -0,0 +1,146 @@
+"""
+Local store of bare mirrors of remote git repositories.
+
+Mirrors are kept under the directory set by the 'path' option of the
+[mirror] section of the rc files (default ~/.planex/mirrors), in
+<host>/<path>.git, so the same repository reached over ssh, https or
+git shares one mirror.   They are created and updated by planex-mirror,
+and used, if present, by planex-clone, planex-fetch and ref resolution.
+
+Mirrors are only updated by planex-mirror, so only tags and full SHA1s
+are taken from them; branches are always fetched from the remote.
+Clones may borrow objects from a mirror, so refs deleted upstream are
+not pruned from it and it never drops unreachable objects.
+"""
+
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+
+# pylint: disable=relative-import
+from six.moves.urllib.parse import urlparse
+
+from planex.config import Configuration
+from planex.git import archive_commitish, has_commit, is_immutable
+from planex.util import makedirs, run
+
+
+def mirror_root():
+    """
+    Return the directory holding the mirrors, or None if mirrors are
+    disabled
+    """
+    root = Configuration.get('mirror', 'path',
+                             os.path.expanduser('~/.planex/mirrors'))
+    return root or None
+
+
+def mirror_path(url):
+    """
+    Return the path of the mirror of the repository at url, whether or
+    not it exists, or None if mirrors are disabled
+    """
+    root = mirror_root()
+    if root is None:
+        return None
+    return os.path.join(root, url_path(url))
+
+
+def url_path(url):
+    """
+    Return the relative path <host>/<path>.git under which the
+    repository at url is kept
+    """
+    parsed = urlparse(url)
+    path = parsed.path.strip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    return os.path.join(parsed.hostname or 'localhost', path + '.git')
+
+
+def find_mirror(url):
+    """
+    Return the path of the mirror of the repository at url, or None if
+    there is no mirror
+    """
+    path = mirror_path(url)
+    if path is not None and os.path.exists(os.path.join(path, 'HEAD')):
+        return path
+    return None
+
+
+def update_mirror(url):
+    """
+    Create or incrementally update the mirror of the repository at url.
+    Returns the path of the mirror.
+    """
+    path = mirror_path(url)
+    if path is None:
+        raise Exception("Mirrors are disabled in the [mirror] section")
+
+    makedirs(os.path.dirname(path))
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(os.path.join(path, 'HEAD')):
+            logging.info("Updating mirror of %s", url)
+            fetch_branches_and_tags(path, url)
+        else:
+            logging.info("Creating mirror of %s in %s", url, path)
+            # Fetch beside the final location, so that an interrupted
+            # fetch is never mistaken for a mirror
+            tmpdir = tempfile.mkdtemp(dir=os.path.dirname(path),
+                                      prefix='.mirror-')
+            try:
+                run(['git', 'init', '--bare', '--quiet', tmpdir])
+                fetch_branches_and_tags(tmpdir, url)
+                os.rename(tmpdir, path)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+    return path
+
+
+def fetch_branches_and_tags(path, url):
+    """
+    Fetch all the branches and tags of the repository at url into the
+    bare repository at path.   Deleted refs are kept, as clones may
+    still borrow their objects.   Other refs, such as GitHub pull
+    requests, are not mirrored.
+    """
+    # Objects borrowed by clones must outlive the refs which reach them,
+    # including those of mirrors created before this was set
+    run(['git', '--git-dir=%s' % path, 'config', 'gc.pruneExpire', 'never'])
+    run(['git', '--git-dir=%s' % path, 'fetch', '--quiet', url,
+         '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*'])
+
+
+def resolve(url, ref):
+    """
+    Return the full SHA1 of the commit ref points to in the mirror of the
+    repository at url, or None if there is no mirror or it lacks ref
+    """
+    path = find_mirror(url)
+    if path is None:
+        return None
+    res = run(['git', '--git-dir=%s' % path, 'rev-parse', '--verify',
+               '--quiet', '%s^{commit}' % ref], check=False)
+    if res['rc'] != 0:
+        return None
+    return res['stdout'].strip()
+
+
+def archive(url, treeish, output, prefix=None):
+    """
+    Write a tar archive of treeish from the mirror of the repository at
+    url to the file object output.   Returns False, without writing
+    anything, if there is no mirror, it lacks treeish or treeish is not
+    a tag or SHA1, as the mirror may be out of date.
+    """
+    path = find_mirror(url)
+    if path is None or not is_immutable(path, treeish) or \
+            not has_commit(path, treeish):
+        return False
+    logging.debug("Archiving %s#%s from mirror %s", url, treeish, path)
+    archive_commitish(path, treeish, output, prefix)
+    return True
@@ -2,7 +2,13 @@
 Utilities for handling patchqueues
 """
 
+import logging
+import os
 import re
+import shutil
+import subprocess
+import tempfile
+import time
 
 import planex.tarball
 
@@ -76,6 +82,160 @@ def parse_patchseries(series, guard=None):
         yield match.group(1)
 
 
+def _encode(text):
+    """Return text encoded as UTF-8, if it is not already bytes"""
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+# Lines which start the diff in a patch, ending its description
+DIFF_START_RE = re.compile(br'^(diff |--- |Index: )')
+
+
+def as_mail(patch, name, author):
+    """
+    Return the contents of the patch file name as an e-mail which git am
+    can apply.   Patches made by git format-patch are returned unchanged.
+    Others are given the first line of their description, or the patch
+    name if they have none, as the subject and author as the author.
+    """
+    if patch.startswith(b'From ') or patch.startswith(b'From: '):
+        return patch
+
+    lines = patch.splitlines(True)
+    diff = next((i for i, line in enumerate(lines)
+                 if DIFF_START_RE.match(line)), len(lines))
+    description = b''.join(lines[:diff]).strip()
+    subject, _, body = description.partition(b'\n')
+    if not subject:
+        subject = b'patch ' + _encode(name)
+
+    mail = [b'From: ', _encode(author), b'\n',
+            b'Subject: ', subject.strip(), b'\n\n']
+    if body.strip():
+        mail += [body.strip(), b'\n']
+    mail += [b'---\n'] + lines[diff:]
+    return b''.join(mail)
+
+
+# Lines naming the files a patch changes
+PATCHED_FILE_RE = re.compile(br'^(?:---|\+\+\+) ([^\t\n]+)')
+
+
+def patched_directories(patch_dir, patches):
+    """
+    Return the sorted list of the directories holding the files which
+    patches, in patch_dir, change.   Paths in the patches have their
+    first component stripped, as by patch -p1.
+    """
+    directories = set()
+    for patch in patches:
+        with open(os.path.join(patch_dir, patch), 'rb') as fileh:
+            for line in fileh:
+                match = PATCHED_FILE_RE.match(line)
+                if not match or match.group(1) == b'/dev/null':
+                    continue
+                path = match.group(1).decode('utf-8').split('/', 1)[-1]
+                if os.path.dirname(path):
+                    directories.add(os.path.dirname(path))
+    return sorted(directories)
+
+
+def run_patch_command(cmd, repo, patches, marker):
+    """
+    Run cmd, which applies patches to repo in order, logging the time
+    taken by each.   The command must write a line starting with marker
+    as it starts each patch.   Returns the command's output.
+    """
+    # git writes its progress in blocks when it is not on a terminal,
+    # which would make every patch seem to be applied at the end
+    if any(os.access(os.path.join(path, 'stdbuf'), os.X_OK)
+           for path in os.environ.get('PATH', '').split(os.pathsep)):
+        cmd = ['stdbuf', '-oL'] + cmd
+    proc = subprocess.Popen(cmd, cwd=repo.working_dir,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = []
+    started = []
+    for line in iter(proc.stdout.readline, b''):
+        output.append(line)
+        if line.startswith(marker):
+            started.append(time.time())
+    started.append(time.time())
+    output = b''.join(output)
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+
+    for patch, start, end in zip(patches, started, started[1:]):
+        logging.debug("Applied %s in %.3fs", patch, end - start)
+    if started[1:]:
+        logging.info("Applied %d patches to %s in %.1fs", len(started) - 1,
+                     repo.working_dir, started[-1] - started[0])
+    return output
+
+
+def guilt_push_all(repo, patch_dir):
+    """
+    Apply all the unapplied patches in repo's patchqueue, in patch_dir,
+    with guilt, returning guilt's output
+    """
+    with open(os.path.join(patch_dir, 'series')) as series:
+        patches = list(parse_patchseries(series))
+    # The applied patches are always the start of the series
+    with open(os.path.join(patch_dir, 'status')) as status:
+        applied = len(status.readlines())
+    return run_patch_command(['guilt', 'push', '--all'], repo,
+                             patches[applied:], b'Applying patch..')
+
+
+def write_mails(repo, patch_dir, patches, mail_dir):
+    """
+    Write each of patches, in patch_dir, to mail_dir as an e-mail for
+    git am, returning the paths of the e-mails
+    """
+    # Drop the timestamp from 'Name <email> timestamp timezone'
+    author = repo.git.var('GIT_AUTHOR_IDENT').rsplit(' ', 2)[0]
+    mails = []
+    for i, patch in enumerate(patches):
+        with open(os.path.join(patch_dir, patch), 'rb') as fileh:
+            mail = as_mail(fileh.read(), patch, author)
+        mails.append(os.path.join(mail_dir, '%04d' % i))
+        with open(mails[-1], 'wb') as fileh:
+            fileh.write(mail)
+    return mails
+
+
+def git_am_all(repo, patch_dir):
+    """
+    Apply the patches in the series file in patch_dir to repo with a
+    single git am, then record them in the status file as guilt would,
+    so that guilt can be used on the result.   Patches which are not
+    e-mails are given headers so that git am accepts them.   Returns
+    git am's output.
+    """
+    with open(os.path.join(patch_dir, 'series')) as series:
+        patches = list(parse_patchseries(series))
+    base = repo.head.commit.hexsha
+
+    tmpdir = tempfile.mkdtemp(prefix='am-')
+    try:
+        mails = write_mails(repo, patch_dir, patches, tmpdir)
+        # Like guilt, allow patches whose context has drifted by a line
+        try:
+            output = run_patch_command(
+                ['git', 'am', '--keep-cr', '-C1'] + mails, repo, patches,
+                b'Applying: ')
+        except subprocess.CalledProcessError:
+            repo.git.am('--abort')
+            raise
+    finally:
+        shutil.rmtree(tmpdir)
+
+    applied = repo.git.rev_list('--reverse', '%s..HEAD' % base).split()
+    with open(os.path.join(patch_dir, 'status'), 'w') as status:
+        for sha, patch in zip(applied, patches):
+            status.write('%s:%s\n' % (sha, patch))
+    return output
+
+
 def check_spec_supports_patchqueues(spec):
     """
     Create a list of patches from a patchqueue and update the spec file
@@ -0,0 +1,126 @@
+"""
+Parallel gzip compression.
+
+The input is split into blocks which are deflated independently on a
+pool of threads.   Each block but the last ends with a sync flush, which
+byte-aligns the output without ending the deflate stream, so the blocks
+can be concatenated into a single standard gzip member, as pigz does.
+"""
+
+from collections import deque
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import struct
+import zlib
+
+from planex.config import Configuration
+
+
+BLOCK_SIZE = 128 * 1024
+DEFAULT_LEVEL = 6
+
+# Fixed gzip header: no file name and a zero timestamp, so that archives
+# of the same content are identical.   The operating system is 'unknown'.
+GZIP_HEADER = b'\x1f\x8b\x08\x00' + struct.pack('<IBB', 0, 0, 255)
+
+
+def compression_level():
+    """Return the compression level set in the [gzip] config section"""
+    return int(Configuration.get('gzip', 'level', DEFAULT_LEVEL))
+
+
+def compression_threads():
+    """Return the number of threads set in the [gzip] config section"""
+    return int(Configuration.get('gzip', 'threads',
+                                 multiprocessing.cpu_count()))
+
+
+def deflate_block(block, level, last):
+    """
+    Return block compressed as part of a raw deflate stream.   The
+    stream is only finished if this is the last block.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + \
+        compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+    """
+    Write-only file object which gzip compresses everything written to
+    it onto fileobj, using several threads.   Closing the writer does not
+    close fileobj.
+    """
+
+    # pylint: disable=R0902
+
+    def __init__(self, fileobj, level=None, threads=None):
+        self.fileobj = fileobj
+        self.level = compression_level() if level is None else level
+        threads = compression_threads() if threads is None else threads
+        self.pool = ThreadPool(max(threads, 1))
+        # Bound the number of blocks in flight, and so the memory used
+        self.window = 2 * max(threads, 1)
+        self.pending = deque()
+        self.buf = []
+        self.buflen = 0
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        self.fileobj.write(GZIP_HEADER)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
+
+    def write(self, data):
+        """Compress data onto the underlying file"""
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= BLOCK_SIZE:
+            block = b''.join(self.buf)
+            for start in range(0, len(block) - BLOCK_SIZE + 1, BLOCK_SIZE):
+                self._submit(block[start:start + BLOCK_SIZE], False)
+            rest = block[len(block) - len(block) % BLOCK_SIZE:]
+            self.buf = [rest]
+            self.buflen = len(rest)
+
+    def _submit(self, block, last):
+        """Queue block for compression, writing out finished blocks"""
+        self.pending.append(
+            self.pool.apply_async(deflate_block, (block, self.level, last)))
+        while len(self.pending) > self.window:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        """Finish the deflate stream and write the gzip trailer"""
+        if self.closed:
+            return
+        self.closed = True
+        self._submit(b''.join(self.buf), True)
+        self.buf = []
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+        self.pool.close()
+        self.pool.join()
+        self.fileobj.write(struct.pack('<II', self.crc & 0xffffffff,
+                                       self.size & 0xffffffff))
+
+
+def compress_stream(src, dst, level=None, threads=None):
+    """
+    Gzip compress everything read from src onto dst
+    """
+    with ParallelGzipWriter(dst, level, threads) as writer:
+        while True:
+            block = src.read(BLOCK_SIZE)
+            if not block:
+                break
+            writer.write(block)
@@ -1,3 +1,3 @@
-for m in planex-{build-mock,clone-sources,depend,fetch,init,make-srpm,manifest,patchqueue}; do
+for m in planex-{build-mock,clone-sources,depend,fetch,init,make-srpm,manifest,mirror,patchqueue,patchqueue-check}; do
   eval "$(register-python-argcomplete $m)"
 done
@@ -0,0 +1,124 @@
+"""
+Cache of source trees prepared by the %prep section of spec files.
+
+Each prepared tree is kept as a bare git repository, named after a hash
+of the spec file and of the Source and Patch files it lists, under the
+directory set by the 'prep-cache' option of the [clone] section of the
+rc files (default ~/.planex/prep).   An empty value disables the cache.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+from planex.config import Configuration
+from planex.util import makedirs, run
+
+# Files written beside downloads, which %prep never reads
+IGNORED_SUFFIXES = ('.origin', '.part', '.index')
+
+
+def cache_root():
+    """
+    Return the directory holding the cache, or None if it is disabled
+    """
+    root = Configuration.get('clone', 'prep-cache',
+                             os.path.expanduser('~/.planex/prep'))
+    return root or None
+
+
+def _hash_file(digest, path):
+    """Add the contents of the file at path to digest"""
+    with open(path, 'rb') as fileh:
+        for block in iter(lambda: fileh.read(1024 * 1024), b''):
+            digest.update(block)
+
+
+def cache_key(spec_path, top_dir, resources):
+    """
+    Return the key of the tree prepared from the spec file at spec_path
+    with the sources and patches under the rpmbuild top directory
+    top_dir.   Only the Source and Patch files among resources, the
+    resources_dict of the spec, are hashed, so the key changes if any
+    of those files does but not when other files, such as the .origin
+    files written beside downloads, do.
+    """
+    names = set(os.path.basename(resource.path)
+                for name, resource in resources.items()
+                if re.match(r'^(Source|Patch)\d+$', name))
+    digest = hashlib.sha256()
+    _hash_file(digest, spec_path)
+    for root, dirs, files in os.walk(top_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name not in names or name.endswith(IGNORED_SUFFIXES) or \
+                    os.path.islink(path) or not os.path.isfile(path):
+                continue
+            relpath = os.path.relpath(path, top_dir).encode('utf-8')
+            digest.update(b'\0' + relpath + b'\0')
+            _hash_file(digest, path)
+    return digest.hexdigest()
+
+
+def _entry_path(key):
+    """Return the path of the cache entry for key, or None"""
+    root = cache_root()
+    if root is None:
+        return None
+    return os.path.join(root, key[:2], key + '.git')
+
+
+def restore(key, repo_path):
+    """
+    Clone the tree cached under key into a new repository at repo_path.
+    Returns False, without creating anything, if there is no such tree.
+    """
+    path = _entry_path(key)
+    if path is None or not os.path.exists(os.path.join(path, 'HEAD')):
+        return False
+
+    logging.info("Using prepared sources from %s", path)
+    # A local clone hard links the objects instead of copying them
+    run(['git', 'clone', '--local', '--quiet', path, repo_path])
+    run(['git', '--git-dir=%s' % os.path.join(repo_path, '.git'),
+         'remote', 'remove', 'origin'])
+    return True
+
+
+def store(key, repo_path):
+    """
+    Add the prepared tree committed in the repository at repo_path to
+    the cache under key.   Trees which hold files ignored by git are not
+    cached, as a clone of them would lack those files.
+    """
+    path = _entry_path(key)
+    if path is None or os.path.exists(os.path.join(path, 'HEAD')):
+        return
+
+    res = run(['git', '--git-dir=%s' % os.path.join(repo_path, '.git'),
+               '--work-tree=%s' % repo_path, 'status', '--porcelain',
+               '--ignored', '--untracked-files=all'])
+    if res['stdout'].strip():
+        logging.debug("Not caching prepared sources in %s: not all files "
+                      "are committed", repo_path)
+        return
+
+    makedirs(os.path.dirname(path))
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(os.path.join(path, 'HEAD')):
+            return
+        # Clone beside the final location, so that an interrupted clone
+        # is never mistaken for a cache entry
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.prep-')
+        try:
+            run(['git', 'clone', '--bare', '--quiet', repo_path, tmpdir])
+            os.rename(tmpdir, path)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    logging.debug("Cached prepared sources of %s in %s", repo_path, path)
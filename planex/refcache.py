@@ -0,0 +1,115 @@
+"""
+Persistent cache of the SHA1s which refs in remote repositories point to
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import os.path
+import re
+import tempfile
+import time
+
+from planex.config import Configuration
+from planex.util import makedirs
+
+
+FULL_SHA1 = re.compile(r'^[0-9a-f]{40}$')
+
+# Default number of seconds for which a branch resolution is trusted
+DEFAULT_TTL = 300
+
+
+class RefCache(object):
+    """
+    Maps (netloc, repository, ref) to the SHA1 the ref was last resolved
+    to.   The cache is kept in a JSON file shared by all planex commands.
+    Entries for branches expire after the number of seconds set by the
+    'ref-cache-ttl' option of the [repository] section of the rc files;
+    tags and full SHA1s cannot move, so their entries never expire.
+    Setting 'bypass' ignores the cached entries but still records new
+    resolutions.
+    """
+
+    bypass = False
+
+    @classmethod
+    def get(cls, netloc, repo, ref):
+        """
+        Return the cached SHA1 of ref in repo on netloc, or None if it is
+        not cached or has expired
+        """
+        path = cls._path()
+        if cls.bypass or not path:
+            return None
+
+        entry = cls._load(path).get(cls._key(netloc, repo, ref))
+        if entry is None:
+            return None
+        sha, expires = entry
+        if expires is not None and expires < time.time():
+            return None
+        logging.debug("Using cached SHA1 %s for %s %s", sha, repo, ref)
+        return sha
+
+    @classmethod
+    def set(cls, netloc, repo, ref, sha, immutable=False):
+        # pylint: disable=too-many-arguments
+        """
+        Record that ref in repo on netloc points to sha.   The entry does
+        not expire if the ref is immutable or is itself a full SHA1.
+        """
+        path = cls._path()
+        if not path or not sha:
+            return
+
+        if immutable or FULL_SHA1.match(ref):
+            expires = None
+        else:
+            ttl = int(Configuration.get('repository', 'ref-cache-ttl',
+                                        DEFAULT_TTL))
+            if ttl <= 0:
+                return
+            expires = time.time() + ttl
+
+        try:
+            makedirs(os.path.dirname(path))
+            with open(path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                now = time.time()
+                cache = {key: entry
+                         for key, entry in cls._load(path).items()
+                         if entry[1] is None or entry[1] >= now}
+                cache[cls._key(netloc, repo, ref)] = [sha, expires]
+                with tempfile.NamedTemporaryFile('w', delete=False,
+                                                 dir=os.path.dirname(path)) \
+                        as out:
+                    json.dump(cache, out, separators=(',', ':'))
+                os.rename(out.name, path)
+        except (IOError, OSError) as exn:
+            logging.warning("Could not update ref cache %s: %s", path, exn)
+
+    @staticmethod
+    def _key(netloc, repo, ref):
+        """Return the key of a cache entry"""
+        return " ".join((netloc, repo, ref))
+
+    @staticmethod
+    def _path():
+        """Return the path of the cache file, or None if it is disabled"""
+        return Configuration.get('repository', 'ref-cache',
+                                 os.path.expanduser('~/.planex/refs.json'))
+
+    @staticmethod
+    def _load(path):
+        """Return the contents of the cache file"""
+        try:
+            with open(path) as cache_file:
+                return json.load(cache_file)
+        except IOError as exn:
+            if exn.errno != errno.ENOENT:
+                logging.warning("Could not read ref cache %s: %s", path, exn)
+        except ValueError:
+            logging.warning("Ignoring corrupt ref cache %s", path)
+        return {}
@@ -2,26 +2,29 @@
 
 
 import logging
+from multiprocessing.pool import ThreadPool
 import os.path
 import subprocess
-import requests
-
-import pkg_resources
 
+import planex.bitbucket as bitbucket
 import planex.git as git
-from planex.util import add_custom_headers_for_url
+import planex.mirror
 from planex.config import Configuration
+from planex.refcache import RefCache
 
 # pylint: disable=relative-import
 from six.moves.urllib.parse import parse_qs, urlparse, urlunparse
 
+# Number of remotes queried concurrently by Repository.resolve_all
+LS_REMOTE_JOBS = 8
+
 
 class Repository(object):
     """Represents a specific branch or tag of a repository"""
 
     # pylint: disable=R0902
 
-    def __init__(self, url):
+    def __init__(self, url, resolve=True):
         self.url = urlparse(url)
         self.clone_url = None
         self._query_url = None
@@ -31,21 +34,151 @@ class Repository(object):
         self.commitish = None
         self.sha1 = None
         self.archive_at = None
+        self._advertised_refs = None
+        self._api_refs = None
+        self._api = None
+        self._unclassified_ref = None
         self.repomgr = self.repomanager_from_netloc()
         if self.repomgr in self.parsers:
             self.parsers[self.repomgr](self)
-            self._populate_sha1()
+            if resolve:
+                self.resolve()
+
+    def resolve(self):
+        """
+        Classify the ref named by the URL as a tag or branch if the URL
+        does not say which it is, then populate 'sha1'.   This queries
+        the remote repository unless the answers are cached.
+        """
+        if self._unclassified_ref is not None:
+            name = self._unclassified_ref
+            self._unclassified_ref = None
+            # Tags cannot move, so a cached or mirrored tag saves the query,
+            # and so does a branch which is still cached
+            if RefCache.get(self.url.netloc, self._query_url,
+                            'refs/tags/' + name) or \
+                    planex.mirror.resolve(self.clone_url, 'refs/tags/' + name):
+                self.tag = name
+            elif RefCache.get(self.url.netloc, self._query_url,
+                              'refs/heads/' + name):
+                self.branch = name
+            elif 'refs/tags/' + name in self._remote_refs(name):
+                self.tag = name
+            else:
+                self.branch = name
+        self._populate_sha1()
+
+    def server_refs(self):
+        """
+        Return the URL of the remote repository and the refs which
+        resolving it would look up on its server, as git ls-remote
+        patterns or as refs for the REST API, or an empty list of refs if
+        it would not need to
+        """
+        if self.repomgr in self.ls_remote_managers:
+            # The same lookups which let resolve classify the ref without
+            # querying the server
+            name = self._unclassified_ref or self.tag or self.branch
+            if name is None or any(
+                    RefCache.get(self.url.netloc, self._query_url, ref)
+                    for ref in ('refs/tags/' + name, 'refs/heads/' + name)) \
+                    or planex.mirror.resolve(self.clone_url,
+                                             'refs/tags/' + name):
+                return self._query_url, []
+            return self._query_url, ['refs/tags/' + name,
+                                     'refs/tags/%s^{}' % name,
+                                     'refs/heads/' + name]
+        if self._api is not None:
+            ref = self._ref_name()
+            if ref is None or \
+                    RefCache.get(self.url.netloc, self._query_url, ref) or \
+                    (self.branch is None and
+                     planex.mirror.resolve(self.clone_url, ref)):
+                return self._query_url, []
+            return self._query_url, [ref]
+        return self._query_url, []
+
+    def query_server(self, refs):
+        """
+        Look up refs, as returned by server_refs, on the server in a
+        single query, returning the answers
+        """
+        if self.repomgr in self.ls_remote_managers:
+            return git.parse_ls_remote(git.ls_remote(self._query_url,
+                                                     sorted(refs)))
+        return self._api.resolve(refs)
+
+    def use_server_refs(self, answers):
+        """Use answers from query_server to resolve this repository"""
+        if self.repomgr in self.ls_remote_managers:
+            self._advertised_refs = answers
+        else:
+            self._api_refs = answers
 
-    def clone(self, topdir, dirname=None):
-        """Clone repository to a directory"""
+    @classmethod
+    def resolve_all(cls, urls, jobs=LS_REMOTE_JOBS):
+        """
+        Return a list of resolved Repositories, one for each of urls.
+        Repositories whose refs are all cached are resolved from the
+        cache.   The refs needed from each distinct remote are looked up
+        in a single query, concurrently with the other remotes: git
+        ls-remote filtered to those refs, or one pass of the Bitbucket
+        REST API.   Every repository of a queried remote is resolved from
+        its answers, so no remote is queried twice.
+        """
+        repos = [cls(url, resolve=False) for url in urls]
+        queries = [repo.server_refs() for repo in repos]
+        wanted = {}
+        for repo, (url, refs) in zip(repos, queries):
+            if refs:
+                wanted.setdefault(url, (repo, set()))[1].update(refs)
+
+        if wanted:
+            logging.debug("Looking up refs of %d remotes", len(wanted))
+            remotes = list(wanted)
+            pool = ThreadPool(min(jobs, len(remotes)))
+            try:
+                answers = pool.map(
+                    lambda url: wanted[url][0].query_server(wanted[url][1]),
+                    remotes)
+            finally:
+                pool.close()
+                pool.join()
+            answers = dict(zip(remotes, answers))
+            for repo, (url, _) in zip(repos, queries):
+                if url in answers:
+                    repo.use_server_refs(answers[url])
+
+        for repo in repos:
+            repo.resolve()
+        return repos
+
+    def clone(self, topdir, dirname=None, reference=None, depth=None,
+              filter_spec=None):
+        """
+        Clone repository to a directory.   Objects are borrowed from the
+        reference repository, which defaults to the local mirror of this
+        repository if there is one.   If depth or filter_spec is given,
+        only the history of the tag or branch is fetched, limited to
+        depth commits and omitting the objects matched by filter_spec.
+        """
+        # pylint: disable=too-many-arguments
         if dirname:
             out_dir = os.path.join(topdir, dirname)
         else:
             out_dir = os.path.join(topdir, self.dir_name)
+        if reference is None:
+            reference = planex.mirror.find_mirror(self.clone_url)
         branch_or_tag = self.tag or self.branch or self.commitish
         cmd = ['git', 'clone']
+        if reference is not None:
+            cmd += ['--reference', reference]
         if branch_or_tag:
             cmd += ['--branch', branch_or_tag]
+        if depth is not None:
+            cmd += ['--depth', str(depth)]
+        if filter_spec is not None:
+            cmd += ['--filter=%s' % filter_spec, '--single-branch']
         cmd.append(self.clone_url)
         if dirname:
             cmd.append(dirname)
@@ -67,6 +200,17 @@ class Repository(object):
             ret += "&id=" + self.commitish
         return ret
 
+    def _ref_name(self):
+        """
+        Return the fully qualified name of the tag or branch, or the
+        commitish, this repository points to
+        """
+        if self.tag is not None:
+            return 'refs/tags/' + self.tag
+        if self.branch is not None:
+            return 'refs/heads/' + self.branch
+        return self.commitish
+
     def _populate_sha1(self):
         """Populate 'sha1' with the hash of the last commit.
 
@@ -74,8 +218,23 @@ class Repository(object):
         SHA1 of the latest commit.
         If the url is pointing to a tag, this will be the
         SHA1 of the commit tag is pointing to.
+
+        Resolutions are looked up in, and added to, the shared RefCache.
         """
-        if self.repomgr in self.tag_to_sha1s:
+        ref = self._ref_name()
+        if ref is not None:
+            self.sha1 = RefCache.get(self.url.netloc, self._query_url, ref)
+            if self.sha1:
+                return
+            # Branches move, so only tags and commits are taken from the
+            # local mirror, which may be out of date
+            if self.branch is None:
+                self.sha1 = planex.mirror.resolve(self.clone_url, ref)
+            # Looked up by resolve_all
+            if not self.sha1 and self._api_refs is not None:
+                self.sha1 = self._api_refs.get(ref)
+
+        if not self.sha1 and self.repomgr in self.tag_to_sha1s:
             to_sha1 = self.tag_to_sha1s[self.repomgr]
             self.sha1 = to_sha1(self, self.archive_at)
 
@@ -89,6 +248,36 @@ class Repository(object):
 
         if not self.sha1:
             self.sha1 = ''
+        elif ref is not None:
+            RefCache.set(self.url.netloc, self._query_url, ref, self.sha1,
+                         immutable=self.tag is not None)
+
+    def _remote_refs(self, name):
+        """
+        Return a dictionary of the refs advertised by the remote
+        repository for the tag or branch called name, querying the
+        remote at most once, or not at all if resolve_all already has
+        """
+        if self._advertised_refs is None:
+            self._advertised_refs = git.parse_ls_remote(git.ls_remote(
+                self._query_url, ['refs/tags/' + name,
+                                  'refs/tags/%s^{}' % name,
+                                  'refs/heads/' + name]))
+        return self._advertised_refs
+
+    def ls_remote_to_sha1(self, _):
+        """Convert the tag or branch to the full SHA1 of its commit using
+        git ls-remote
+        """
+        name = self.tag or self.branch
+        if name is None:
+            return None
+        refs = self._remote_refs(name)
+        if self.tag is not None:
+            # Annotated tags are followed by the commit they point to
+            return refs.get('refs/tags/%s^{}' % name,
+                            refs.get('refs/tags/' + name))
+        return refs.get('refs/heads/' + name)
 
     def parse_github(self):
         """Parse GitHub source URL"""
@@ -104,12 +293,8 @@ class Repository(object):
             path[2]
         )
 
-        remote_ref = git.ls_remote(self._query_url, path[4])
-
-        if remote_ref and remote_ref.split('/', 2)[1] == 'tags':
-            self.tag = path[4]
-        else:
-            self.branch = path[4]
+        # The URL does not say whether this is a tag or a branch
+        self._unclassified_ref = path[4]
 
     def parse_bitbucket(self):
         """Parse BitBucket source URL"""
@@ -125,6 +310,7 @@ class Repository(object):
         )
 
         self.dir_name = path[7]
+        self._api = bitbucket.BitbucketRepo(self.url.netloc, path[5], path[7])
         query_dict = parse_qs(self.url.query)
         if 'at' in query_dict:
             query = query_dict['at'][0]
@@ -147,59 +333,29 @@ class Repository(object):
         """
         Gets the HTTP headers for making requests to the specified location
         """
-        useragent = ("planex-repository/%s" %
-                     pkg_resources.require("planex")[0].version)
-        headers = requests.utils.default_headers()
-        headers.update({
-            "user-agent": useragent,
-        })
-        add_custom_headers_for_url(netloc, headers)
-        return headers
-
-    def commitish_to_sha1_bitbucket(self, commitish):
+        return bitbucket.request_headers(netloc)
+
+    def commitish_to_sha1_bitbucket(self, _):
         """Convert a commitish to a full SHA1 using the BitBucket API"""
-        path = self.url.path.split('/')
-        url = "https://%s/rest/api/1.0/projects/%s/repos/%s/commits/%s" % \
-            (self.url.netloc, path[5], path[7], commitish)
-        logging.debug("Fetching SHA1 using " + url)
-        api_response = requests.get(
-            url,
-            headers=Repository.get_requests_headers(self.url.netloc))
-        api_response.raise_for_status()
-        data = api_response.json()
-        return data['id']
-
-    def branch_to_sha1_bitbucket(self, branch):
+        if self.commitish is None:
+            return None
+        return self._api.commit(self.commitish)
+
+    def branch_to_sha1_bitbucket(self, _):
         """Convert a branch id to the full SHA1 of its latest commit using
         the REST API
         """
-        path = self.url.path.split('/')
-        url = "https://%s/rest/api/1.0/projects/%s/repos/%s/branches" % \
-            (self.url.netloc, path[5], path[7])
-        logging.debug("Fetching branches using " + url)
-        api_response = requests.get(
-            url,
-            headers=Repository.get_requests_headers(self.url.netloc))
-        api_response.raise_for_status()
-        data = api_response.json()
-        commit = [value['latestCommit'] for value in data['values']
-                  if value['displayId'] == branch]
-        return commit[0] if commit else None
-
-    def tag_to_sha1_bitbucket(self, tag):
+        if self.branch is None:
+            return None
+        return self._api.branch(self.branch)
+
+    def tag_to_sha1_bitbucket(self, _):
         """Convert a tag id to the full SHA1 of its latest commit using
         the REST API
         """
-        path = self.url.path.split('/')
-        url = "https://%s/rest/api/1.0/projects/%s/repos/%s/tags/%s" % \
-            (self.url.netloc, path[5], path[7], tag)
-        logging.debug("Fetching tags using " + url)
-        api_response = requests.get(
-            url,
-            headers=Repository.get_requests_headers(self.url.netloc))
-        api_response.raise_for_status()
-        data = api_response.json()
-        return data['latestCommit']
+        if self.tag is None:
+            return None
+        return self._api.tag(self.tag)
 
     def parse_gitweb(self):
         """Parse GitWeb source URL"""
@@ -239,12 +395,16 @@ class Repository(object):
     }
     # Maps repository managers to things-which-turn-branches-to-sha1
     branch_to_sha1s = {
-        'bitbucket': branch_to_sha1_bitbucket
+        'bitbucket': branch_to_sha1_bitbucket,
+        'github': ls_remote_to_sha1
     }
     # Maps repository managers to things-which-turn-tags-to-sha1
     tag_to_sha1s = {
-        'bitbucket': tag_to_sha1_bitbucket
+        'bitbucket': tag_to_sha1_bitbucket,
+        'github': ls_remote_to_sha1
     }
+    # Repository managers whose refs are resolved with git ls-remote
+    ls_remote_managers = ('github',)
 
     def repository_url(self):
         """
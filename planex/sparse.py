@@ -0,0 +1,81 @@
+"""
+Sparse checkouts of large repositories.
+
+A git resource in a link or pin file may list the directories a package
+needs in a 'sparse' field.   New clones of its repository then only
+check out those directories, in git's cone mode, along with the files
+at the top level.   With planex-clone --sparse, patchqueue and patch
+repositories with no 'sparse' field only check out their prefix.
+"""
+
+import logging
+
+from planex.blobs import GitArchive, GitPatchqueue
+from planex.patchqueue import patched_directories
+
+
+class SparseCheckout(object):
+    """
+    Whether the prefix of patchqueue and patch repositories is taken as
+    the directory to check out when their link gives no sparse paths
+    """
+
+    # pylint: disable=R0903
+
+    use_prefix = False
+
+
+def sparse_paths(resource):
+    """
+    Return the directories of resource's repository to check out, or
+    None to check out all of them
+    """
+    if resource.sparse:
+        return [path.strip('/') for path in resource.sparse]
+    if SparseCheckout.use_prefix and \
+            isinstance(resource, (GitArchive, GitPatchqueue)):
+        return [resource.prefix.strip('/')]
+    return None
+
+
+def is_sparse(repo):
+    """Return True if repo has a sparse working tree"""
+    # git sparse-checkout sets this in the per-worktree configuration,
+    # which GitPython's configuration reader does not read
+    return repo.git.config('--bool', 'core.sparseCheckout',
+                           with_exceptions=False) == 'true'
+
+
+def set_sparse_checkout(repo, paths, new_clone):
+    """
+    Limit the working tree of repo to the directories in paths, plus the
+    files at the top level, or widen it to everything if paths is None.
+    Directories already in a sparse working tree stay there, and an
+    existing full working tree stays full, as other packages sharing the
+    repository may need them.
+    """
+    if paths is None:
+        if is_sparse(repo):
+            repo.git.sparse_checkout('disable')
+    elif is_sparse(repo):
+        repo.git.sparse_checkout('add', *paths)
+    elif new_clone:
+        logging.debug("Checking out only %s in %s", ", ".join(paths),
+                      repo.working_dir)
+        repo.git.sparse_checkout('init', '--cone')
+        repo.git.sparse_checkout('set', *paths)
+
+
+def widen_for_patches(repo, patch_dir, patches):
+    """
+    Add the directories changed by patches, in patch_dir, to the sparse
+    working tree of repo, as patches can only be applied to files which
+    are checked out
+    """
+    if not is_sparse(repo):
+        return
+    directories = patched_directories(patch_dir, patches)
+    if directories:
+        logging.debug("Checking out %s in %s for the patchqueue",
+                      ", ".join(directories), repo.working_dir)
+        repo.git.sparse_checkout('add', *directories)
@@ -109,9 +109,10 @@ def update_with_schema_version_3(spec, link):
         if url.startswith("ssh://"):
             source = GitBlob(spec, url, link.path,
                              os.path.basename(spec.source_path(idx)),
-                             value.get("prefix"), value.get("commitish"))
+                             value.get("prefix"), value.get("commitish"),
+                             value.get("sparse"))
         else:
-            source = Blob(spec, url, link.path)
+            source = Blob(spec, url, link.path, value.get("sha256"))
         spec.add_source(idx, source)
 
     for name, value in link.archives.items():
@@ -119,9 +120,11 @@ def update_with_schema_version_3(spec, link):
         url = value["URL"]
         if url.startswith("ssh://"):
             archive = GitArchive(spec, url, link.path,
-                                 value.get("prefix"), value.get("commitish"))
+                                 value.get("prefix"), value.get("commitish"),
+                                 value.get("sparse"))
         else:
-            archive = Archive(spec, url, link.path, value.get("prefix"))
+            archive = Archive(spec, url, link.path, value.get("prefix"),
+                              value.get("sha256"))
         spec.add_archive(idx, archive)
 
     for name, value in link.patchqueue_sources.items():
@@ -130,9 +133,11 @@ def update_with_schema_version_3(spec, link):
         if url.startswith("ssh://"):
             patchqueue = GitPatchqueue(spec, url, link.path,
                                        value.get("prefix"),
-                                       value.get("commitish"))
+                                       value.get("commitish"),
+                                       value.get("sparse"))
         else:
-            patchqueue = Patchqueue(spec, url, link.path, value.get("prefix"))
+            patchqueue = Patchqueue(spec, url, link.path, value.get("prefix"),
+                                    value.get("sha256"))
         spec.add_patchqueue(idx, patchqueue)
 
 
@@ -2,18 +2,353 @@
 tarball: Utilities for tar archives
 """
 
+import base64
+import copy
+import errno
+import hashlib
+import io
+import json
+import logging
 import os
 import tarfile
+import tempfile
+import threading
+import zlib
+
+from planex.pgzip import ParallelGzipWriter
+import planex.zran
+
+
+# Version of the format of index files; older indexes are rebuilt
+INDEX_VERSION = 2
+
+# Number of bytes at the start of a tarball hashed to tell it apart from
+# another file with the same size and modification time
+INDEX_HEAD_SIZE = 64 * 1024
+
+# Magic numbers of the compressed formats tarfile reads
+GZIP_MAGIC = b'\x1f\x8b'
+COMPRESSED_MAGIC = (GZIP_MAGIC, b'BZh', b'\xfd7zXZ\x00')
+
+# Size of the blocks copied when extracting members
+COPY_SIZE = 1024 * 1024
+
+
+def _type_name(kind):
+    """Return the tar member type kind as text, as it is in indexes"""
+    return kind.decode('ascii') if isinstance(kind, bytes) else kind
+
+
+# Types of the members listed as files, and of those whose data is held
+# contiguously and can be read directly from an uncompressed tarball
+FILE_TYPES = list(map(_type_name, tarfile.REGULAR_TYPES))
+CONTIGUOUS_TYPES = list(map(_type_name, (tarfile.REGTYPE, tarfile.AREGTYPE,
+                                         tarfile.CONTTYPE)))
+
+
+def index_path(filename):
+    """
+    Return the path of the index file of the tarball at filename
+    """
+    return filename + ".index"
+
+
+def _index_key(filename):
+    """
+    Return the values which must match for an index to describe the
+    tarball at filename: its size, modification time and a hash of its
+    first bytes
+    """
+    stat = os.stat(filename)
+    with open(filename, 'rb') as fileh:
+        head = fileh.read(INDEX_HEAD_SIZE)
+    return {
+        "version": INDEX_VERSION,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "head": hashlib.sha256(head).hexdigest(),
+        "compressed": head.startswith(COMPRESSED_MAGIC),
+        "gzip": head.startswith(GZIP_MAGIC)
+    }
+
+
+def build_index(filename, tar=None):
+    """
+    Return the index of the tarball at filename, listing the name, type,
+    mode, size and data offset of each member, and the archive root.
+    Offsets are in the uncompressed stream.   The open TarFile tar is
+    read if it is given.   The index of a gzipped tarball also holds
+    checkpoints for random access to it, if they are enabled.
+    """
+    index = _index_key(filename)
+    close = tar is None
+    if close:
+        tar = tarfile.open(filename)
+    try:
+        index["members"] = [
+            [member.name, _type_name(member.type), member.mode, member.size,
+             member.offset_data]
+            for member in tar.getmembers()]
+        index["archive_root"] = archive_root(tar)
+    finally:
+        if close:
+            tar.close()
+    span = planex.zran.checkpoint_span()
+    if index["gzip"] and span > 0 and planex.zran.available():
+        _add_checkpoints(index, filename, span)
+    return index
+
+
+def _add_checkpoints(index, filename, span):
+    """
+    Add checkpoints of the gzipped tarball at filename, span bytes of
+    uncompressed data apart, to its index
+    """
+    try:
+        with open(filename, 'rb') as fileh:
+            checkpoints, end = planex.zran.build_checkpoints(fileh, span)
+    except zlib.error as exn:
+        logging.debug("Could not add checkpoints of %s: %s", filename, exn)
+        return
+    # Windows are kept compressed, as zran does
+    index["checkpoints"] = [
+        [out, compressed, bits,
+         base64.b64encode(zlib.compress(window)).decode('ascii')]
+        for out, compressed, bits, window in checkpoints]
+    index["checkpoints_end"] = end
+
+
+def write_index(filename, index=None):
+    """
+    Write the index of the tarball at filename beside it, building it if
+    it is not given.   Returns the index.   Failing to write the file is
+    not an error, as the index can always be rebuilt.
+    """
+    if index is None:
+        index = build_index(filename)
+    path = index_path(filename)
+    try:
+        # Write beside the final location, so that readers never see a
+        # partly written index
+        fileh = tempfile.NamedTemporaryFile(
+            mode='w', dir=os.path.dirname(os.path.abspath(path)),
+            prefix='.index-', delete=False)
+    except (IOError, OSError) as exn:
+        logging.debug("Could not write index of %s: %s", filename, exn)
+        return index
+    try:
+        with fileh:
+            json.dump(index, fileh, separators=(',', ':'))
+        os.chmod(fileh.name, 0o644)
+        os.rename(fileh.name, path)
+    except (IOError, OSError, UnicodeError) as exn:
+        logging.debug("Could not write index of %s: %s", filename, exn)
+        os.remove(fileh.name)
+    return index
+
+
+def read_index(filename):
+    """
+    Return the index of the tarball at filename from its index file, or
+    None if there is no index file or it describes another version of
+    the tarball
+    """
+    try:
+        with open(index_path(filename)) as fileh:
+            index = json.load(fileh)
+    except IOError as exn:
+        if exn.errno != errno.ENOENT:
+            raise
+        return None
+    except ValueError:
+        return None
+    key = _index_key(filename)
+    if any(index.get(name) != value for name, value in key.items()):
+        return None
+    return index
+
+
+def load_index(filename):
+    """
+    Return the index of the tarball at filename, writing the index file
+    if it is missing or out of date
+    """
+    index = read_index(filename)
+    if index is None:
+        index = write_index(filename)
+    return index
+
+
+class _Archive(object):
+    """
+    The contents of a tarball, shared by the Tarball objects opened on
+    it while a TarballCache is in use
+    """
+
+    # pylint: disable=R0902
+
+    def __init__(self, filename=None, fileobj=None):
+        self.filename = filename
+        self.fileobj = fileobj
+        self._tarfile = None
+        self._members = None
+        self._checkpoints = None
+        self._names = {}
+        if filename is not None and fileobj is None:
+            self.index = load_index(filename)
+            self.root = self.index["archive_root"]
+        else:
+            self.index = None
+            self.root = archive_root(self.tarfile)
+
+    @property
+    def tarfile(self):
+        """The archive opened with tarfile, opening it if need be"""
+        if self._tarfile is None:
+            self._tarfile = tarfile.open(name=self.filename,
+                                         fileobj=self.fileobj)
+        return self._tarfile
+
+    def close(self):
+        """Close the archive"""
+        if self._tarfile is not None:
+            self._tarfile.close()
+
+    def names(self, source_path):
+        """
+        Return the names of the files in the archive under source_path,
+        relative to it
+        """
+        if source_path not in self._names:
+            if self.index is not None:
+                names = [name for name, kind, _, _, _ in self.index["members"]
+                         if kind in FILE_TYPES and
+                         name.startswith(source_path)]
+            else:
+                names = [mem.name for mem in self.tarfile.getmembers()
+                         if mem.isfile() and mem.path.startswith(source_path)]
+            self._names[source_path] = [os.path.relpath(name, source_path)
+                                        for name in names]
+        return self._names[source_path]
+
+    def member(self, path):
+        """
+        Return the index entry of the regular file at path if its data
+        can be read directly from the tarball, or None if tarfile must
+        read it.   Raises KeyError if there is no such member.
+        """
+        if self.index is None:
+            return None
+        if self._members is None:
+            # Later members with the same name replace earlier ones
+            self._members = {entry[0]: entry
+                             for entry in self.index["members"]}
+        entry = self._members.get(path,
+                                  self._members.get(os.path.normpath(path)))
+        if entry is None:
+            raise KeyError("filename %r not found" % path)
+        if entry[1] not in CONTIGUOUS_TYPES:
+            return None
+        if self.index["compressed"] and (
+                "checkpoints" not in self.index or
+                not planex.zran.available() or
+                entry[4] + entry[3] > self.index["checkpoints_end"]):
+            return None
+        return entry
+
+    def member_chunks(self, entry, fileh):
+        """
+        Generate the data of the member with index entry from fileh.
+        Gzipped tarballs are inflated from the checkpoint before it.
+        """
+        _, _, _, size, offset = entry
+        if self.index["compressed"]:
+            if self._checkpoints is None:
+                self._checkpoints = [
+                    (out, compressed, bits,
+                     zlib.decompress(base64.b64decode(window)))
+                    for out, compressed, bits, window
+                    in self.index["checkpoints"]]
+            for chunk in planex.zran.read_chunks(fileh, self._checkpoints,
+                                                 offset, size):
+                yield chunk
+            return
+
+        fileh.seek(offset)
+        while size:
+            chunk = fileh.read(min(size, COPY_SIZE))
+            if not chunk:
+                raise tarfile.ReadError("unexpected end of data in %s" %
+                                        self.filename)
+            size -= len(chunk)
+            yield chunk
+
+
+class TarballCache(object):
+    """
+    Keeps the tarballs opened by filename open until the cache is
+    closed, so that each is listed at most once however many times it
+    is opened.   Only one cache is in use at a time in a process, and
+    the tarballs must not change while it is.   Use as a context
+    manager around a run of a command.
+    """
+
+    # pylint: disable=R0903
+
+    _archives = None
+    _lock = threading.Lock()
+
+    def __enter__(self):
+        with TarballCache._lock:
+            TarballCache._archives = {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with TarballCache._lock:
+            archives, TarballCache._archives = TarballCache._archives, None
+        for archive in archives.values():
+            archive.close()
+
+    @classmethod
+    def lookup(cls, filename):
+        """
+        Return the archive at filename, opening it if need be, or None
+        if no cache is in use
+        """
+        with cls._lock:
+            if cls._archives is None:
+                return None
+            key = os.path.realpath(filename)
+            if key not in cls._archives:
+                cls._archives[key] = _Archive(filename)
+            return cls._archives[key]
 
 
 class Tarball(object):
-    """Represents a source archive tarball"""
+    """
+    Represents a source archive tarball.   Tarballs opened by filename
+    are listed from their index file, and members of uncompressed ones
+    are read directly from their offsets, as are those of gzipped ones
+    with checkpoints.   The archive itself is only opened with tarfile
+    when that is not enough.   While a TarballCache is in use, tarballs
+    opened by filename share the archive it keeps open.
+    """
 
     def __init__(self, filename=None, fileobj=None, prefix=""):
         self.filename = filename
-        self.tarfile = tarfile.open(name=filename, fileobj=fileobj)
-        self.archive_root = archive_root(self.tarfile)
         self.prefix = prefix
+        self._archive = None
+        if filename is not None and fileobj is None:
+            self._archive = TarballCache.lookup(filename)
+        self._owned = self._archive is None
+        if self._owned:
+            self._archive = _Archive(filename, fileobj)
+        self.archive_root = self._archive.root
+
+    @property
+    def tarfile(self):
+        """The archive opened with tarfile, opening it if need be"""
+        return self._archive.tarfile
 
     def __enter__(self):
         return self
@@ -23,35 +358,35 @@ class Tarball(object):
 
     def close(self):
         """
-        Close the tarball
+        Close the tarball, unless a TarballCache keeps it open
         """
-        self.tarfile.close()
+        if self._owned:
+            self._archive.close()
 
     def getnames(self):
         """
         Return a list of the names of the files in the tarball
         """
-        source_path = os.path.join(self.archive_root, self.prefix)
-        names = [mem.name for mem in self.tarfile.getmembers()
-                 if mem.isfile() and mem.path.startswith(source_path)]
-        return [os.path.relpath(name, source_path) for name in names]
+        return list(self._archive.names(
+            os.path.join(self.archive_root, self.prefix)))
 
     def extractfile(self, source):
         """
         Extract a file from the tarball, returning a file-like object
         """
-        # Get the TarInfo object representing the file and re-set its
-        # name.   Otherwise the file will be written to its full path.
         source_path = os.path.join(self.archive_root, self.prefix, source)
-        return self.tarfile.extractfile(source_path)
+        entry = self._archive.member(source_path)
+        if entry is None:
+            return self.tarfile.extractfile(source_path)
+        with open(self.filename, 'rb') as fileh:
+            return io.BytesIO(b''.join(self._archive.member_chunks(entry,
+                                                                   fileh)))
 
     def extract(self, sources, destdir):
         """
         Extract the files listed in [sources] from the tarball,
         saving them to destdir.
         """
-        # Get the TarInfo object representing the file and re-set its
-        # name.   Otherwise the file will be written to its full path.
         if not sources:
             raise ValueError("Empty source list")
 
@@ -59,8 +394,17 @@ class Tarball(object):
             os.path.join(self.archive_root, self.prefix, source)
             for source in sources
         ]
+        entries = [self._archive.member(source_path)
+                   for source_path in source_paths]
+        if None not in entries:
+            self._extract_entries(entries, destdir)
+            return
+
+        # Copy the TarInfo object representing the file and re-set its
+        # name.   Otherwise the file will be written to its full path.
+        # The original may be shared with other users of the archive.
         mems = [
-            self.tarfile.getmember(source_path)
+            copy.copy(self.tarfile.getmember(source_path))
             for source_path in source_paths
         ]
         for mem in mems:
@@ -69,6 +413,22 @@ class Tarball(object):
         for mem in mems:
             os.utime(os.path.join(destdir, mem.name), None)
 
+    def _extract_entries(self, entries, destdir):
+        """
+        Write the regular files with index entries to destdir, reading
+        only their data from the tarball
+        """
+        with open(self.filename, 'rb') as fileh:
+            # Read in archive order, so the file is read sequentially
+            for entry in sorted(entries, key=lambda entry: entry[4]):
+                path = os.path.join(destdir, os.path.basename(entry[0]))
+                if os.path.lexists(path):
+                    os.remove(path)
+                with open(path, 'wb') as output:
+                    for chunk in self._archive.member_chunks(entry, fileh):
+                        output.write(chunk)
+                os.chmod(path, entry[2] & 0o777)
+
 
 def archive_root(tar):
     """
@@ -104,5 +464,12 @@ def make(inputdir, outputfile, mode=None):
         tarinfo.name = os.path.relpath(tarinfo.name, inputdir[1:])
         return tarinfo
 
+    if mode == "gz":
+        # Compress on all cores; the writer is a stream, not a file
+        with ParallelGzipWriter(outputfile) as gzfile:
+            with tarfile.open(fileobj=gzfile, mode="w|") as tar:
+                tar.add(inputdir, filter=reset)
+        return
+
     with tarfile.open(fileobj=outputfile, mode=tarmode) as tar:
         tar.add(inputdir, filter=reset)
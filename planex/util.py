@@ -11,6 +11,9 @@ import signal
 import subprocess
 import sys
 
+# pylint: disable=relative-import
+from six.moves.urllib.parse import urlparse, urlunparse
+
 from planex.config import Configuration
 
 import __main__
@@ -59,6 +62,25 @@ def add_custom_headers_for_url(netloc, headers):
             headers.update({key: header_parts[key]})
 
 
+def mirrors_for_url(url):
+    """
+    Looks up mirrors for the host of the supplied url from rc files and
+    returns the list of candidate urls to fetch it from: the url rewritten
+    for each mirror, in the configured order, followed by the url itself
+    """
+    parsed = urlparse(url)
+    mirrors = Configuration.get(parsed.netloc, 'Mirrors', '').split()
+    candidates = []
+    for mirror in mirrors:
+        base = urlparse(mirror)
+        candidates.append(urlunparse((base.scheme, base.netloc,
+                                      base.path.rstrip('/') + parsed.path,
+                                      parsed.params, parsed.query,
+                                      parsed.fragment)))
+    candidates.append(url)
+    return candidates
+
+
 def setup_sigint_handler():
     """
     Exit with 130 upon CTRL-C (http://tldp.org/LDP/abs/html/exitcodes.html
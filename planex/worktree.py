@@ -0,0 +1,150 @@
+"""
+Shared object stores and worktrees of git repositories.
+
+With --worktrees, planex-clone keeps one bare store of each repository
+it clones, under .stores in the repos directory, and checks out every
+commitish which packages need as a worktree of that store, so objects
+are only fetched and kept once.   Otherwise each checkout is a separate
+clone.
+"""
+
+import re
+import threading
+
+# pylint: disable=relative-import
+from six.moves.urllib.parse import urlparse
+
+try:
+    from pathlib2 import Path
+except ImportError:
+    from pathlib import Path
+
+import planex.git
+from planex.mirror import url_path
+
+
+# git worktree first appeared in git 2.5
+WORKTREE_GIT_VERSION = (2, 5)
+
+
+class SharedStores(object):
+    """
+    Whether new checkouts are worktrees of shared stores, which needs
+    git WORKTREE_GIT_VERSION or later, rather than separate clones
+    """
+
+    # pylint: disable=R0903
+
+    enabled = False
+
+
+def worktrees_supported():
+    """Return True if the installed git can add worktrees"""
+    return planex.git.version() >= WORKTREE_GIT_VERSION
+
+
+def store_path(repos, url):
+    """
+    Return the path of the bare repository holding the objects of url
+    for all its checkouts in the repos directory.   Each scheme has its
+    own store, as checkouts are only reused for the same origin URL.
+    """
+    return Path(repos, '.stores', urlparse(url).scheme or 'file',
+                url_path(url))
+
+
+def origin_url(path):
+    """
+    Return the URL of the origin of the checkout at path, or None if
+    there is no checkout there or it has no origin
+    """
+    if not Path(path, '.git').exists():
+        return None
+    try:
+        return planex.git.origin_url(str(path))
+    except AttributeError:
+        return None
+
+
+def add_worktree(store, destination, commit):
+    """
+    Add a worktree of store at destination, with commit as its HEAD but
+    nothing checked out
+    """
+    # Forget the worktrees whose directories have been removed
+    store.git.worktree('prune')
+    store.git.worktree('add', '--no-checkout', '--detach', str(destination),
+                       commit.hexsha)
+
+
+class Destinations(object):
+    """
+    The directories, in the repos directory, into which git resources
+    are checked out.   Each repository is checked out into a directory
+    named after it, unless the packages being cloned need it at several
+    commitishes, or need other repositories with the same name.   Then
+    the second and later are checked out into directories named
+    <name>@<commitish>.
+    """
+
+    _names = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _key(resource):
+        """Return what distinguishes the checkouts of resource"""
+        return (resource.url, resource.commitish)
+
+    @classmethod
+    def assign(cls, resources):
+        """Name the directories of the git resources, in order"""
+        with cls._lock:
+            for resource in resources:
+                if not resource.is_repo or cls._key(resource) in cls._names:
+                    continue
+                base = re.sub(r'\.git$', '', resource.basename)
+                name = base
+                taken = set(cls._names.values())
+                suffix = 1
+                while name in taken:
+                    suffix += 1
+                    name = "%s@%s" % (base, resource.commitish.replace(
+                        '/', '-'))
+                    if suffix > 2:
+                        name += "-%d" % (suffix - 1)
+                cls._names[cls._key(resource)] = name
+
+    @classmethod
+    def path_of(cls, repos, resource):
+        """Return the path of the checkout of resource in repos"""
+        with cls._lock:
+            name = cls._names.get(cls._key(resource))
+        if name is None:
+            name = re.sub(r'\.git$', '', resource.basename)
+        return Path(repos, name)
+
+    @classmethod
+    def find(cls, repos, resource):
+        """
+        Return the path of a checkout of resource in repos, whether it
+        was named by this process or by an earlier planex-clone, or None
+        if there is none.   Checkouts named after resource's commitish
+        are preferred.   Those of other repositories are ignored.
+        """
+        base = re.sub(r'\.git$', '', resource.basename)
+        at_commitish = "%s@%s" % (base,
+                                  str(resource.commitish).replace('/', '-'))
+        # pylint: disable=no-member
+        candidates = [cls.path_of(repos, resource), Path(repos, at_commitish)]
+        candidates += sorted(Path(repos).glob(at_commitish + '-*'))
+        candidates.append(Path(repos, base))
+        for path in candidates:
+            if origin_url(path) == resource.url:
+                return path
+        return None
+
+    @classmethod
+    def reset(cls):
+        """Forget the names assigned"""
+        with cls._lock:
+            cls._names = {}
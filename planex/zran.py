@@ -0,0 +1,225 @@
+"""
+Random access to gzip files.
+
+As in zlib's zran example, the deflate stream is read once to record
+checkpoints at deflate block boundaries every few MiB of uncompressed
+data, if the checkpoint-span option of the [gzip] config section asks
+for them.   Each checkpoint holds the offsets at which it falls in the
+compressed and uncompressed streams and the last 32 KiB of uncompressed
+data, which later blocks may refer back to.   Reading from an offset
+then only inflates from the checkpoint before it.
+
+Python's zlib module can neither stop at block boundaries nor resume
+from one which is not byte aligned, so zlib itself is called through
+ctypes.   Random access is unavailable if it cannot be loaded.
+"""
+
+import ctypes
+import ctypes.util
+import zlib
+
+from planex.config import Configuration
+
+
+# Checkpoints are only recorded if the checkpoint-span option sets a span
+DEFAULT_SPAN = 0
+
+# Amount of uncompressed data later deflate blocks may refer back to
+WINDOW_SIZE = 32 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+# inflateInit2 window bits: a gzip or zlib stream, or a raw deflate stream
+AUTO_HEADER_WBITS = 32 + 15
+RAW_WBITS = -15
+
+
+class ZStream(ctypes.Structure):
+    """zlib's z_stream structure"""
+
+    # pylint: disable=R0903
+
+    _fields_ = [
+        ("next_in", ctypes.c_void_p),
+        ("avail_in", ctypes.c_uint),
+        ("total_in", ctypes.c_ulong),
+        ("next_out", ctypes.c_void_p),
+        ("avail_out", ctypes.c_uint),
+        ("total_out", ctypes.c_ulong),
+        ("msg", ctypes.c_char_p),
+        ("state", ctypes.c_void_p),
+        ("zalloc", ctypes.c_void_p),
+        ("zfree", ctypes.c_void_p),
+        ("opaque", ctypes.c_void_p),
+        ("data_type", ctypes.c_int),
+        ("adler", ctypes.c_ulong),
+        ("reserved", ctypes.c_ulong),
+    ]
+
+
+def _load_libz():
+    """Return the zlib shared library, or None if it cannot be loaded"""
+    name = ctypes.util.find_library("z")
+    if name is None:
+        return None
+    try:
+        libz = ctypes.CDLL(name)
+    except OSError:
+        return None
+    libz.zlibVersion.restype = ctypes.c_char_p
+    return libz
+
+
+LIBZ = _load_libz()
+
+
+def available():
+    """Return True if gzip files can be read from checkpoints"""
+    return LIBZ is not None
+
+
+def checkpoint_span():
+    """
+    Return the number of uncompressed bytes between checkpoints, set in
+    MiB by the checkpoint-span option of the [gzip] config section.
+    Zero, the default, disables checkpoints.
+    """
+    return int(float(Configuration.get('gzip', 'checkpoint-span',
+                                       DEFAULT_SPAN)) * 1024 * 1024)
+
+
+class Inflater(object):
+    """An inflate stream in zlib, fed from a file"""
+
+    # The fields of the z_stream are set as it is used
+    # pylint: disable=attribute-defined-outside-init
+
+    def __init__(self, fileobj, wbits):
+        self.fileobj = fileobj
+        self.stream = ZStream()
+        self.inbuf = ctypes.create_string_buffer(CHUNK_SIZE)
+        ret = LIBZ.inflateInit2_(ctypes.byref(self.stream), wbits,
+                                 LIBZ.zlibVersion(),
+                                 ctypes.sizeof(self.stream))
+        self.check(ret)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        LIBZ.inflateEnd(ctypes.byref(self.stream))
+
+    def check(self, ret):
+        """Raise zlib.error if ret is a zlib error code"""
+        if ret < 0 or ret == Z_NEED_DICT:
+            raise zlib.error("inflate failed (%d): %s" %
+                             (ret, self.stream.msg or "invalid data"))
+
+    def fill(self):
+        """Read more compressed data if it has all been consumed"""
+        if self.stream.avail_in:
+            return
+        data = self.fileobj.read(CHUNK_SIZE)
+        if not data:
+            raise zlib.error("unexpected end of compressed data")
+        ctypes.memmove(self.inbuf, data, len(data))
+        self.stream.next_in = ctypes.addressof(self.inbuf)
+        self.stream.avail_in = len(data)
+
+    def inflate(self, outbuf, offset, size, flush=Z_NO_FLUSH):
+        """
+        Inflate up to size bytes into outbuf at offset.   Returns the
+        number of bytes written and whether the stream ended.
+        """
+        self.fill()
+        self.stream.next_out = ctypes.addressof(outbuf) + offset
+        self.stream.avail_out = size
+        ret = LIBZ.inflate(ctypes.byref(self.stream), flush)
+        if ret != Z_BUF_ERROR:
+            self.check(ret)
+        return size - self.stream.avail_out, ret == Z_STREAM_END
+
+
+def build_checkpoints(fileobj, span):
+    """
+    Return the checkpoints of the gzip file fileobj, about span bytes of
+    uncompressed data apart, as a list of (uncompressed offset,
+    compressed offset, bits, window) tuples, and the length of the
+    uncompressed data they cover.   Only the first member of a
+    multi-member gzip file is covered.
+    """
+    fileobj.seek(0)
+    window = ctypes.create_string_buffer(WINDOW_SIZE)
+    checkpoints = []
+    total_in = total_out = 0
+    last = None
+    with Inflater(fileobj, AUTO_HEADER_WBITS) as inflater:
+        stream = inflater.stream
+        pos = 0
+        while True:
+            inflater.fill()
+            before_in = stream.avail_in
+            written, ended = inflater.inflate(window, pos, WINDOW_SIZE - pos,
+                                              Z_BLOCK)
+            total_in += before_in - stream.avail_in
+            total_out += written
+            pos = (pos + written) % WINDOW_SIZE
+            if ended:
+                break
+            # Only block boundaries which are not the end of the stream
+            if stream.data_type & 128 and not stream.data_type & 64 and \
+                    (last is None or total_out - last > span):
+                # The window is circular: its oldest data starts at pos
+                data = window.raw[pos:] + window.raw[:pos] \
+                    if total_out >= WINDOW_SIZE else window.raw[:pos]
+                checkpoints.append((total_out, total_in,
+                                    stream.data_type & 7, data))
+                last = total_out
+    return checkpoints, total_out
+
+
+def read_chunks(fileobj, checkpoints, offset, size):
+    """
+    Generate the size bytes at offset in the uncompressed data of the
+    gzip file fileobj, inflating from the last of checkpoints before
+    offset
+    """
+    # pylint: disable=too-many-locals
+    point = max((point for point in checkpoints if point[0] <= offset),
+                key=lambda point: point[0])
+    out, compressed, bits, window = point
+    skip = offset - out
+
+    with Inflater(fileobj, RAW_WBITS) as inflater:
+        if bits:
+            # The checkpoint falls within a byte: feed its last bits
+            fileobj.seek(compressed - 1)
+            byte = bytearray(fileobj.read(1))[0]
+            inflater.check(LIBZ.inflatePrime(ctypes.byref(inflater.stream),
+                                             bits, byte >> (8 - bits)))
+        else:
+            fileobj.seek(compressed)
+        if window:
+            inflater.check(LIBZ.inflateSetDictionary(
+                ctypes.byref(inflater.stream), window, len(window)))
+
+        outbuf = ctypes.create_string_buffer(CHUNK_SIZE)
+        while size > 0:
+            written, ended = inflater.inflate(outbuf, 0, CHUNK_SIZE)
+            data = outbuf.raw[:written]
+            if skip:
+                data = data[skip:]
+                skip -= written - len(data)
+            if data:
+                data = data[:size]
+                size -= len(data)
+                yield data
+            if ended and size > 0:
+                raise zlib.error("unexpected end of compressed data")
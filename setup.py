@@ -28,6 +28,8 @@ setup(name='planex',
               'planex-fetch = planex.cmd.fetch:main',
               'planex-init = planex.cmd.init:main',
               'planex-make-srpm = planex.cmd.makesrpm:main',
+              'planex-mirror = planex.cmd.mirror:main',
+              'planex-patchqueue-check = planex.cmd.patchqueuecheck:main',
               'planex-pin = planex.cmd.pin:main'
           ]
       })
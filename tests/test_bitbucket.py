@@ -0,0 +1,93 @@
+"""Tests for the Bitbucket Server REST API client"""
+
+import unittest
+
+import mock
+
+import planex.bitbucket
+
+
+BASE = "https://bb.example.com/rest/api/1.0/projects/XS/repos/planex"
+
+
+def response(status, data=None):
+    """Return a mock response with the given status code and JSON body"""
+    resp = mock.Mock(status_code=status)
+    resp.json.return_value = data
+    return resp
+
+
+def branch(name, sha1):
+    """Return a branch as listed by the /branches endpoint"""
+    return {'id': 'refs/heads/' + name, 'displayId': name,
+            'latestCommit': sha1}
+
+
+class BitbucketRepoTests(unittest.TestCase):
+    """Tests for BitbucketRepo"""
+
+    def setUp(self):
+        patcher = mock.patch('planex.bitbucket.session_for')
+        self.session = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.repo = planex.bitbucket.BitbucketRepo(
+            'bb.example.com', 'XS', 'planex')
+
+    def test_branch_filtered(self):
+        """A single branch is looked up with filterText"""
+        self.session.get.return_value = response(200, {
+            'values': [branch('feature/master', 'a' * 40),
+                       branch('master', 'b' * 40)],
+            'isLastPage': True})
+
+        self.assertEqual(self.repo.branch('master'), 'b' * 40)
+        self.session.get.assert_called_once_with(
+            BASE + "/branches",
+            params={'filterText': 'master', 'limit': 100, 'start': 0})
+
+    def test_branches_paged(self):
+        """Pages are followed until every branch has been found"""
+        pages = [
+            response(200, {'values': [branch('one', '1' * 40)],
+                           'isLastPage': False, 'nextPageStart': 1}),
+            response(200, {'values': [branch('two', '2' * 40)],
+                           'isLastPage': False, 'nextPageStart': 2}),
+            response(200, {'values': [branch('three', '3' * 40)],
+                           'isLastPage': True})]
+        self.session.get.side_effect = pages
+
+        self.assertEqual(self.repo.branches(['one', 'two']),
+                         {'one': '1' * 40, 'two': '2' * 40})
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_missing(self):
+        """Missing refs resolve to None"""
+        self.session.get.return_value = response(404)
+        self.assertIsNone(self.repo.tag('v1'))
+        self.assertIsNone(self.repo.commit('abc123'))
+
+    def test_resolve(self):
+        """Tags, branches and commits are resolved together"""
+        def get(url, params=None):
+            """Fake Bitbucket server"""
+            if url == BASE + "/tags/v1.0":
+                return response(200, {'latestCommit': 't' * 40})
+            if url == BASE + "/commits/abc123":
+                return response(200, {'id': 'c' * 40})
+            if url == BASE + "/branches":
+                self.assertNotIn('filterText', params)
+                return response(200, {
+                    'values': [branch('master', 'm' * 40),
+                               branch('stable', 's' * 40)],
+                    'isLastPage': True})
+            return response(404)
+        self.session.get.side_effect = get
+
+        self.assertEqual(
+            self.repo.resolve(['refs/tags/v1.0', 'refs/heads/master',
+                               'refs/heads/stable', 'abc123',
+                               'refs/tags/missing']),
+            {'refs/tags/v1.0': 't' * 40,
+             'refs/heads/master': 'm' * 40,
+             'refs/heads/stable': 's' * 40,
+             'abc123': 'c' * 40})
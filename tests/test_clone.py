@@ -0,0 +1,539 @@
+"""Tests for planex-clone"""
+
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+import git
+import mock
+
+try:
+    from pathlib2 import Path
+except ImportError:
+    from pathlib import Path
+
+import planex.cmd.clone
+import planex.git
+import planex.worktree
+
+
+class ParallelCloneTests(unittest.TestCase):
+    """Tests for cloning several packages at once"""
+
+    def tearDown(self):
+        planex.cmd.clone.CloneSlots.set_limit(1)
+        planex.worktree.Destinations.reset()
+
+    @mock.patch('planex.cmd.clone.clone')
+    def test_jobs_limit(self, mock_clone):
+        """No more than the requested number of clones run at once"""
+        running = []
+        peak = []
+        started = []
+        lock = threading.Lock()
+
+        def fake_clone(*_, **__):
+            """Record how many clones are running"""
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+                started.append(1)
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+        mock_clone.side_effect = fake_clone
+
+        args = mock.Mock(jobs=3, clone=True, repos="repos")
+        packages = []
+        for i in range(8):
+            resource = mock.Mock(is_repo=True, basename="repo%d.git" % i,
+                                 sparse=None)
+            spec = mock.Mock()
+            spec.resources.return_value = [resource]
+            packages.append(("package%d" % i, "SPECS/p.spec", spec))
+
+        planex.cmd.clone.clone_packages(args, packages)
+        self.assertEqual(len(started), 8)
+        self.assertLessEqual(max(peak), 3)
+        self.assertGreater(max(peak), 1)
+
+    @mock.patch('planex.cmd.clone.apply_patchqueue')
+    @mock.patch('planex.cmd.clone.clone_resource')
+    def test_patchqueue_after_clones(self, mock_clone_resource,
+                                     mock_apply_patchqueue):
+        """The patchqueue is applied once both repositories are cloned"""
+        # Mock call counts are not thread safe, so record calls here
+        cloned = []
+        mock_clone_resource.side_effect = \
+            lambda res, dest: cloned.append(res.repo) or res.repo
+        base_res = mock.Mock(repo="base")
+        pq_res = mock.Mock(repo="pq", basename="repo.pg.git", prefix="p")
+
+        planex.cmd.clone.clone_with_patchq("repos", "repos/repo",
+                                           base_res, pq_res)
+        self.assertItemsEqual(cloned, ["base", "pq"])
+        mock_apply_patchqueue.assert_called_once_with("base", "pq", "p")
+
+    def test_failure(self):
+        """A failing package is reported to the caller"""
+        args = mock.Mock(jobs=2)
+        spec = mock.Mock(**{'resources.return_value': []})
+        with mock.patch('planex.cmd.clone.clone_package',
+                        side_effect=RuntimeError("boom")):
+            self.assertRaises(RuntimeError, planex.cmd.clone.clone_packages,
+                              args, [("p", "p.spec", spec)])
+
+
+class RecloneTests(unittest.TestCase):
+    """Tests for updating existing clones"""
+
+    def setUp(self):
+        # Create an upstream repository in a temporary directory
+        self.tmpdir = tempfile.mkdtemp()
+        self.upstream = git.Repo.init(os.path.join(self.tmpdir, "upstream"))
+        self.url = "file://" + self.upstream.working_dir
+        self.destination = Path(self.tmpdir, "repos", "clone")
+        self.first = self.commit("one")
+
+    def tearDown(self):
+        # Remove the directory after the test
+        shutil.rmtree(self.tmpdir)
+
+    def commit(self, content):
+        """Commit a change upstream and return its SHA1"""
+        path = os.path.join(self.upstream.working_dir, "file")
+        with open(path, "w") as fileh:
+            fileh.write(content)
+        self.upstream.index.add([path])
+        return self.upstream.index.commit(content).hexsha
+
+    def test_update_in_place(self):
+        """An existing clone is fetched into rather than replaced"""
+        repo = planex.cmd.clone.clone(self.url, self.destination, "master")
+        marker = os.path.join(repo.git_dir, "marker")
+        open(marker, "w").close()
+        second = self.commit("two")
+        self.upstream.create_tag("v2")
+
+        repo = planex.cmd.clone.clone(self.url, self.destination, "master")
+        self.assertTrue(os.path.exists(marker))
+        self.assertEqual(repo.head.commit.hexsha, second)
+        self.assertEqual(repo.active_branch.name, "master")
+
+        repo = planex.cmd.clone.clone(self.url, self.destination, "v2")
+        self.assertEqual(repo.active_branch.name, "planex/v2")
+
+        repo = planex.cmd.clone.clone(self.url, self.destination, self.first)
+        self.assertEqual(repo.head.commit.hexsha, self.first)
+        self.assertEqual(repo.active_branch.name,
+                         "planex/%s" % self.first[:8])
+        self.assertTrue(os.path.exists(marker))
+
+    def test_local_changes(self):
+        """Uncommitted changes are not thrown away"""
+        planex.cmd.clone.clone(self.url, self.destination, "master")
+        with open(str(Path(self.destination, "file")), "w") as fileh:
+            fileh.write("local work")
+        self.assertRaises(planex.cmd.clone.LocalChangesError,
+                          planex.cmd.clone.clone, self.url, self.destination,
+                          "master")
+
+    def test_local_commits(self):
+        """Commits only on the local branch are not thrown away"""
+        repo = planex.cmd.clone.clone(self.url, self.destination, "master")
+        repo.index.commit("local work")
+        self.commit("two")
+        self.assertRaises(planex.cmd.clone.LocalChangesError,
+                          planex.cmd.clone.clone, self.url, self.destination,
+                          "master")
+
+    def test_other_origin(self):
+        """A clone of a different repository is replaced"""
+        self.destination.mkdir(parents=True)
+        git.Repo.init(str(self.destination)).create_remote(
+            "origin", "file:///elsewhere")
+        repo = planex.cmd.clone.clone(self.url, self.destination, "master")
+        self.assertEqual(repo.remotes.origin.url, self.url)
+        self.assertEqual(repo.head.commit.hexsha, self.first)
+
+    def test_shallow(self):
+        """Shallow clones fetch only the commitish and deepen on demand"""
+        second = self.commit("two")
+        self.upstream.create_head("other")
+        mode = planex.cmd.clone.FetchMode(depth=1)
+
+        repo = planex.cmd.clone.clone(self.url, self.destination, "master",
+                                      mode)
+        self.assertEqual(repo.head.commit.hexsha, second)
+        self.assertEqual(repo.git.rev_list("--count", "HEAD"), "1")
+        self.assertEqual([ref.name for ref in repo.remotes.origin.refs],
+                         ["origin/master"])
+
+        planex.git.ensure_history(repo.working_dir)
+        self.assertEqual(repo.git.rev_list("--count", "HEAD"), "2")
+        self.assertFalse(planex.git.is_shallow(repo.working_dir))
+
+    def test_full_clone_stays_full(self):
+        """Updating a full clone in a shallow mode does not truncate it"""
+        planex.cmd.clone.clone(self.url, self.destination, "master")
+        self.commit("two")
+        repo = planex.cmd.clone.clone(
+            self.url, self.destination, "master",
+            planex.cmd.clone.FetchMode(depth=1))
+        self.assertEqual(repo.git.rev_list("--count", "HEAD"), "2")
+
+    def test_separate_clones(self):
+        """Without shared stores, each checkout is a separate clone"""
+        repo = planex.cmd.clone.clone(self.url, self.destination, "master")
+        self.assertTrue(os.path.isdir(os.path.join(repo.working_dir, ".git")))
+        self.assertEqual(repo.head.commit.hexsha, self.first)
+        self.assertFalse(os.path.exists(
+            str(Path(self.tmpdir, "repos", ".stores"))))
+
+    @mock.patch('planex.worktree.SharedStores.enabled', True)
+    def test_shared_store(self):
+        """Checkouts of one repository share a single object store"""
+        second = self.commit("two")
+        repos = Path(self.tmpdir, "repos")
+        first_repo = planex.cmd.clone.clone(self.url, Path(repos, "a"),
+                                            self.first)
+        second_repo = planex.cmd.clone.clone(self.url, Path(repos, "b"),
+                                             "master")
+
+        self.assertEqual(first_repo.head.commit.hexsha, self.first)
+        self.assertEqual(second_repo.head.commit.hexsha, second)
+        with open(str(Path(repos, "a", "file"))) as fileh:
+            self.assertEqual(fileh.read(), "one")
+        with open(str(Path(repos, "b", "file"))) as fileh:
+            self.assertEqual(fileh.read(), "two")
+        self.assertEqual(planex.git.common_dir(first_repo.working_dir),
+                         planex.git.common_dir(second_repo.working_dir))
+        self.assertEqual(os.listdir(str(Path(repos, ".stores", "file"))),
+                         ["localhost"])
+
+    def test_destinations(self):
+        """Repositories needed at several commitishes get their own names"""
+        def resource(url, commitish):
+            """Return a git resource of url at commitish"""
+            return mock.Mock(is_repo=True, url=url, commitish=commitish,
+                             basename=os.path.basename(url))
+        resources = [resource("https://host/repo.git", "master"),
+                     resource("https://host/repo.git", "release/1"),
+                     resource("https://host/repo.git", "master"),
+                     resource("https://other/repo.git", "release/1"),
+                     resource("https://host/tool", "master")]
+        destinations = planex.worktree.Destinations
+        try:
+            destinations.assign(resources)
+            self.assertEqual(
+                [str(destinations.path_of("repos", res)) for res in resources],
+                ["repos/repo", "repos/repo@release-1", "repos/repo",
+                 "repos/repo@release-1-2", "repos/tool"])
+        finally:
+            destinations.reset()
+
+
+class ArchiveResourceTests(unittest.TestCase):
+    """Tests for archiving git resources"""
+
+    def setUp(self):
+        # Create an upstream repository in a temporary directory
+        self.tmpdir = tempfile.mkdtemp()
+        self.upstream = git.Repo.init(os.path.join(self.tmpdir, "upstream"))
+        path = os.path.join(self.upstream.working_dir, "file")
+        with open(path, "w") as fileh:
+            fileh.write("one")
+        self.upstream.index.add([path])
+        self.upstream.index.commit("one")
+        self.upstream.create_tag("v1")
+        self.url = "file://" + self.upstream.working_dir
+        self.destination = Path(self.tmpdir, "SOURCES")
+        self.destination.mkdir()
+
+    def tearDown(self):
+        # Remove the directory after the test
+        planex.cmd.clone.TransientClones.cleanup()
+        shutil.rmtree(self.tmpdir)
+
+    def resource(self, commitish, basename="upstream.git"):
+        """Return a git resource for the upstream repository"""
+        return mock.Mock(is_repo=True, url=self.url, commitish=commitish,
+                         prefix="upstream/", basename=basename)
+
+    def archived_file(self, path):
+        """Return the content of the file in the archive at path"""
+        with tarfile.open(str(path)) as tar:
+            return tar.extractfile("upstream/file").read()
+
+    def test_remote(self):
+        """Archives are made with git archive --remote where possible"""
+        with mock.patch('planex.cmd.clone.TransientClones.archive') as clone:
+            path = planex.cmd.clone.archive_resource(self.resource("v1"),
+                                                     self.destination)
+        self.assertFalse(clone.called)
+        self.assertEqual(self.archived_file(path), b"one")
+
+    def test_local_repo(self):
+        """Archives are made from a checkout of the repository in repos"""
+        repos = Path(self.tmpdir, "repos")
+        git.Repo.clone_from(self.url, str(Path(repos, "upstream")))
+        with mock.patch('planex.git.archive_remote') as remote:
+            path = planex.cmd.clone.archive_resource(
+                self.resource("v1"), self.destination, repos)
+        self.assertFalse(remote.called)
+        self.assertEqual(self.archived_file(path), b"one")
+
+    def test_local_worktree(self):
+        """Checkouts named after their commitish are found and archived"""
+        repos = Path(self.tmpdir, "repos")
+        git.Repo.clone_from(self.url, str(Path(repos, "upstream@v1")))
+        # A checkout of another repository with the same name is ignored
+        other = git.Repo.init(str(Path(repos, "upstream")))
+        other.create_remote("origin", "file:///elsewhere/upstream")
+        self.assertEqual(
+            planex.worktree.Destinations.find(repos, self.resource("v1")),
+            Path(repos, "upstream@v1"))
+        with mock.patch('planex.git.archive_remote') as remote:
+            path = planex.cmd.clone.archive_resource(
+                self.resource("v1"), self.destination, repos)
+        self.assertFalse(remote.called)
+        self.assertEqual(self.archived_file(path), b"one")
+
+    def test_local_branch_not_used(self):
+        """Branches are not archived from a checkout, which may be stale"""
+        repos = Path(self.tmpdir, "repos")
+        local = git.Repo.clone_from(self.url, str(Path(repos, "upstream")))
+        local.index.commit("unpushed")
+        output = io.BytesIO()
+        self.assertFalse(planex.cmd.clone.archive_local_repo(
+            self.resource("master"), repos, output))
+        self.assertEqual(output.getvalue(), b"")
+
+    @mock.patch('planex.git.archive_remote', return_value=False)
+    def test_transient_clone_shared(self, _):
+        """Resources from one repository share a transient clone"""
+        clone_dir = tempfile.mkdtemp()
+        with mock.patch('planex.cmd.clone.tempfile.mkdtemp',
+                        return_value=clone_dir) as mkdtemp:
+            paths = planex.cmd.clone.in_parallel(
+                lambda args: planex.cmd.clone.archive_resource(
+                    self.resource(*args), self.destination),
+                [("v1", "a.tar"), ("master", "b.tar")])
+        self.assertEqual(mkdtemp.call_count, 1)
+        self.assertEqual([self.archived_file(path) for path in paths],
+                         [b"one", b"one"])
+
+        planex.cmd.clone.TransientClones.cleanup()
+        self.assertFalse(os.path.exists(mkdtemp.return_value))
+
+
+class ExtractTests(unittest.TestCase):
+    """Tests for creating repositories from tarballs"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.destination = Path(self.tmpdir, "repos", "upstream")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add(self, tar, name, data=b"", mode=0o644, **kwargs):
+        """Add a member to tar"""
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = mode
+        for key, value in kwargs.items():
+            setattr(info, key, value)
+        tar.addfile(info, io.BytesIO(data))
+
+    def test_extract(self):
+        """The tarball is committed and checked out"""
+        path = os.path.join(self.tmpdir, "upstream.tar.gz")
+        with tarfile.open(path, "w:gz") as tar:
+            self.add(tar, "upstream-1.0", type=tarfile.DIRTYPE, mode=0o755)
+            self.add(tar, "upstream-1.0/file", b"content")
+            self.add(tar, "upstream-1.0/run.sh", b"#!/bin/sh\n", 0o755)
+            self.add(tar, "upstream-1.0/.github/workflow", b"ci")
+            self.add(tar, "upstream-1.0/sub/.git/config", b"junk")
+            self.add(tar, "upstream-1.0/link", type=tarfile.SYMTYPE,
+                     linkname="file")
+            self.add(tar, "upstream-1.0/hard", type=tarfile.LNKTYPE,
+                     linkname="upstream-1.0/file")
+
+        repo = planex.cmd.clone.extract(path, self.destination)
+
+        commit = repo.head.commit
+        self.assertEqual(commit.message, "Repo generated by planex-clone")
+        tree = commit.tree["upstream-1.0"]
+        self.assertEqual(
+            sorted((blob.path, blob.mode) for blob in tree.traverse()
+                   if blob.type == "blob"),
+            [("upstream-1.0/.github/workflow", 0o100644),
+             ("upstream-1.0/file", 0o100644),
+             ("upstream-1.0/hard", 0o100644),
+             ("upstream-1.0/link", 0o120000),
+             ("upstream-1.0/run.sh", 0o100755)])
+        self.assertEqual(tree["hard"].data_stream.read(), b"content")
+        self.assertFalse(repo.is_dirty(untracked_files=True))
+        checkout = self.destination / "upstream-1.0"
+        self.assertEqual(os.readlink(str(checkout / "link")), "file")
+        self.assertTrue(os.access(str(checkout / "run.sh"), os.X_OK))
+
+
+class GitAmTests(unittest.TestCase):
+    """Tests for applying patchqueues with git am"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base = git.Repo.init(os.path.join(self.tmpdir, "base"))
+        self.write("file", "one\ntwo\n")
+        self.base.index.add(["file"])
+        self.base.index.commit("Base")
+        self.pq_repo = git.Repo.init(os.path.join(self.tmpdir, "pq"))
+        self.patch_dir = os.path.join(self.pq_repo.working_dir, "master")
+        os.makedirs(self.patch_dir)
+
+    def tearDown(self):
+        planex.cmd.clone.PatchEngine.default = 'guilt'
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, content):
+        """Write content to path in the base repository"""
+        with open(os.path.join(self.base.working_dir, path), "w") as fileh:
+            fileh.write(content)
+
+    def add_patch(self, name, content):
+        """Add a patch to the patchqueue directory"""
+        with open(os.path.join(self.patch_dir, name), "w") as fileh:
+            fileh.write(content)
+
+    def test_apply(self):
+        """Patches are applied in order and recorded in the status file"""
+        self.add_patch("plain.patch",
+                       "Change the first line\n\nSome detail\n\n"
+                       "--- a/file\n+++ b/file\n"
+                       "@@ -1,2 +1,2 @@\n-one\n+ONE\n two\n")
+        self.add_patch("mail.patch",
+                       "From 0123456789012345678901234567890123456789 "
+                       "Mon Sep 17 00:00:00 2001\n"
+                       "From: Someone <someone@example.com>\n"
+                       "Subject: [PATCH] Change the second line\n\n"
+                       "---\n"
+                       "diff --git a/file b/file\n--- a/file\n+++ b/file\n"
+                       "@@ -1,2 +1,2 @@\n ONE\n-two\n+TWO\n")
+        self.add_patch("guarded.patch", "not a patch\n")
+        with open(os.path.join(self.patch_dir, "series"), "w") as series:
+            series.write("plain.patch\nguarded.patch #+aguard\n"
+                         "mail.patch\n")
+
+        planex.cmd.clone.PatchEngine.default = 'am'
+        planex.cmd.clone.apply_patchqueue(self.base, self.pq_repo, "master")
+
+        with open(os.path.join(self.base.working_dir, "file")) as fileh:
+            self.assertEqual(fileh.read(), "ONE\nTWO\n")
+        commits = list(self.base.iter_commits("HEAD~2..HEAD"))[::-1]
+        self.assertEqual([commit.message for commit in commits],
+                         ["Change the first line\n\nSome detail\n",
+                          "Change the second line\n"])
+        self.assertEqual(commits[1].author.email, "someone@example.com")
+        with open(os.path.join(self.patch_dir, "status")) as status:
+            self.assertEqual(status.read(),
+                             "%s:plain.patch\n%s:mail.patch\n" %
+                             (commits[0].hexsha, commits[1].hexsha))
+
+    def test_failure(self):
+        """A patch which does not apply leaves the repository unchanged"""
+        self.add_patch("bad.patch", "--- a/file\n+++ b/file\n"
+                                    "@@ -1,2 +1,2 @@\n-three\n+THREE\n four\n")
+        with open(os.path.join(self.patch_dir, "series"), "w") as series:
+            series.write("bad.patch\n")
+        head = self.base.head.commit
+
+        planex.cmd.clone.PatchEngine.default = 'am'
+        with self.assertRaises(subprocess.CalledProcessError):
+            planex.cmd.clone.apply_patchqueue(self.base, self.pq_repo,
+                                              "master")
+        self.assertEqual(self.base.head.commit, head)
+        self.assertFalse(self.base.is_dirty())
+
+
+class SparseTests(unittest.TestCase):
+    """Tests for sparse checkouts"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.upstream = git.Repo.init(os.path.join(self.tmpdir, "upstream"))
+        for path in ("top", "a/file", "b/file", "c/d/file"):
+            full_path = os.path.join(self.upstream.working_dir, path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, "w") as fileh:
+                fileh.write("%s\n" % path)
+        self.upstream.index.add(["top", "a/file", "b/file", "c/d/file"])
+        self.upstream.index.commit("Initial")
+        self.url = "file://" + self.upstream.working_dir
+        self.destination = Path(self.tmpdir, "repos", "clone")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def checked_out(self):
+        """Return the files in the working tree of the clone"""
+        found = []
+        for root, dirs, files in os.walk(str(self.destination)):
+            dirs[:] = [name for name in dirs if name != ".git"]
+            found.extend(os.path.relpath(os.path.join(root, name),
+                                         str(self.destination))
+                         for name in files if name != ".git")
+        return sorted(found)
+
+    def test_sparse_clone(self):
+        """Only the requested directories and top level files are checked
+        out, and later packages can add to them"""
+        planex.cmd.clone.clone(self.url, self.destination, "master",
+                               sparse=["a"])
+        self.assertEqual(self.checked_out(), ["a/file", "top"])
+
+        planex.cmd.clone.clone(self.url, self.destination, "master",
+                               sparse=["b"])
+        self.assertEqual(self.checked_out(), ["a/file", "b/file", "top"])
+
+        planex.cmd.clone.clone(self.url, self.destination, "master")
+        self.assertEqual(self.checked_out(),
+                         ["a/file", "b/file", "c/d/file", "top"])
+
+    def test_full_clone_stays_full(self):
+        """An existing full clone is not made sparse"""
+        planex.cmd.clone.clone(self.url, self.destination, "master")
+        planex.cmd.clone.clone(self.url, self.destination, "master",
+                               sparse=["a"])
+        self.assertEqual(self.checked_out(),
+                         ["a/file", "b/file", "c/d/file", "top"])
+
+    def test_patchqueue(self):
+        """Directories changed by the patchqueue are checked out"""
+        base = planex.cmd.clone.clone(self.url, self.destination, "master",
+                                      sparse=["a"])
+        pq_repo = git.Repo.init(os.path.join(self.tmpdir, "pq"))
+        patch_dir = os.path.join(pq_repo.working_dir, "master")
+        os.makedirs(patch_dir)
+        with open(os.path.join(patch_dir, "fix.patch"), "w") as fileh:
+            fileh.write("Fix\n\n--- a/c/d/file\n+++ b/c/d/file\n"
+                        "@@ -1 +1 @@\n-c/d/file\n+fixed\n")
+        with open(os.path.join(patch_dir, "series"), "w") as fileh:
+            fileh.write("fix.patch\n")
+
+        planex.cmd.clone.PatchEngine.default = 'am'
+        try:
+            planex.cmd.clone.apply_patchqueue(base, pq_repo, "master")
+        finally:
+            planex.cmd.clone.PatchEngine.default = 'guilt'
+        self.assertEqual(self.checked_out(), ["a/file", "c/d/file", "top"])
+        with open(str(self.destination / "c" / "d" / "file")) as fileh:
+            self.assertEqual(fileh.read(), "fixed\n")
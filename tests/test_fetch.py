@@ -0,0 +1,436 @@
+"""Tests for planex-fetch"""
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import git
+import mock
+import requests
+from six.moves.urllib.parse import urlparse
+
+import planex.cmd.fetch
+import planex.util
+
+
+class OriginFileTests(unittest.TestCase):
+    """Tests for the .origin tracking files"""
+
+    def setUp(self):
+        # Create a temporary directory
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "source.tar.gz")
+        self.url = "https://example.com/source.tar.gz"
+        with open(self.filename, "w") as fileh:
+            fileh.write("content")
+
+    def tearDown(self):
+        # Remove the directory after the test
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        """Validators written to the origin file can be read back"""
+        validators = {"etag": '"abc"', "size": 7, "last-modified": None}
+        planex.cmd.fetch.write_originfile(self.filename, self.url, "123",
+                                          validators)
+        url, sha, read_validators = \
+            planex.cmd.fetch.read_originfile(self.filename)
+        self.assertEqual(url, self.url)
+        self.assertEqual(sha, "123")
+        self.assertEqual(read_validators, {"etag": '"abc"', "size": "7"})
+
+    def test_legacy_format(self):
+        """Origin files without validators can still be read"""
+        planex.cmd.fetch.write_originfile(self.filename, self.url)
+        self.assertEqual(planex.cmd.fetch.read_originfile(self.filename),
+                         (self.url, "", {}))
+
+    def test_missing(self):
+        """A missing origin file has no validators"""
+        self.assertEqual(planex.cmd.fetch.read_originfile(self.filename),
+                         (None, None, {}))
+
+    def test_conditional_headers(self):
+        """Conditional headers are generated from the stored validators"""
+        planex.cmd.fetch.write_originfile(
+            self.filename, self.url, None,
+            {"etag": '"abc"', "last-modified": "yesterday", "size": 7})
+        self.assertEqual(
+            planex.cmd.fetch.conditional_headers(self.url, self.filename),
+            {"If-None-Match": '"abc"', "If-Modified-Since": "yesterday"})
+
+    def test_conditional_headers_modified_file(self):
+        """Validators are ignored if the file was changed locally"""
+        planex.cmd.fetch.write_originfile(
+            self.filename, self.url, None, {"etag": '"abc"', "size": 3})
+        self.assertEqual(
+            planex.cmd.fetch.conditional_headers(self.url, self.filename),
+            {})
+
+    def test_conditional_headers_other_url(self):
+        """Validators are ignored if the file came from another URL"""
+        planex.cmd.fetch.write_originfile(
+            self.filename, "https://example.com/other.tar.gz", None,
+            {"etag": '"abc"', "size": 7})
+        self.assertEqual(
+            planex.cmd.fetch.conditional_headers(self.url, self.filename),
+            {})
+
+    @mock.patch('planex.cmd.fetch.requests_retry_session')
+    def test_not_modified(self, mock_session):
+        """The file and its mtime are preserved on 304 Not Modified"""
+        planex.cmd.fetch.write_originfile(
+            self.filename, self.url, None, {"etag": '"abc"', "size": 7})
+        os.utime(self.filename, (1000000000, 1000000000))
+        response = mock.Mock(status_code=304)
+        mock_session.return_value.get.return_value = response
+
+        planex.cmd.fetch.fetch_http(urlparse(self.url), self.filename, 1)
+
+        headers = mock_session.return_value.get.call_args[1]["headers"]
+        self.assertEqual(headers["If-None-Match"], '"abc"')
+        self.assertEqual(os.path.getmtime(self.filename), 1000000000)
+        with open(self.filename) as fileh:
+            self.assertEqual(fileh.read(), "content")
+
+    @mock.patch('planex.cmd.fetch.requests_retry_session')
+    def test_resume(self, mock_session):
+        """Partial downloads are resumed with a range request"""
+        filename = os.path.join(self.tmpdir, "source.bin")
+        with open(filename + ".part", "wb") as fileh:
+            fileh.write(b"conte")
+        planex.cmd.fetch.write_originfile(filename + ".part", self.url, None,
+                                          {"etag": '"abc"'})
+        response = mock.Mock(status_code=206,
+                             headers={"Content-Range": "bytes 5-6/7"},
+                             raw=io.BytesIO(b"nt"))
+        mock_session.return_value.get.return_value = response
+
+        planex.cmd.fetch.fetch_http(urlparse(self.url), filename, 1)
+
+        headers = mock_session.return_value.get.call_args[1]["headers"]
+        self.assertEqual(headers["Range"], "bytes=5-")
+        self.assertEqual(headers["If-Range"], '"abc"')
+        with open(filename, "rb") as fileh:
+            self.assertEqual(fileh.read(), b"content")
+        self.assertFalse(os.path.exists(filename + ".part"))
+        _, _, validators = planex.cmd.fetch.read_originfile(filename)
+        self.assertEqual(validators["size"], "7")
+        self.assertEqual(validators["etag"], '"abc"')
+
+
+class ChecksumTests(unittest.TestCase):
+    """Tests for checksummed downloads and the download cache"""
+
+    # SHA256 of "content"
+    sha256 = "ed7002b439e9ac845f22357d822bac1444730fbdb6016d3ec9432297b9ec9f73"
+
+    def setUp(self):
+        # Create a temporary directory
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+        self.filename = os.path.join(self.tmpdir, "source.bin")
+        self.url = "https://example.com/source.bin"
+        patcher = mock.patch('planex.cmd.fetch.download_cache_path',
+                             lambda sha: os.path.join(self.cachedir, sha))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        # Remove the directory after the test
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('planex.cmd.fetch.requests_retry_session')
+    def fetch(self, mock_session, sha256=None, body=b"content"):
+        """Run fetch_http with a mocked server returning body"""
+        response = mock.Mock(status_code=200, headers={},
+                             raw=io.BytesIO(body))
+        mock_session.return_value.get.return_value = response
+        planex.cmd.fetch.fetch_http(urlparse(self.url), self.filename, 1,
+                                    sha256 or self.sha256)
+        return mock_session.return_value.get.called
+
+    def test_download_and_cache(self):
+        """Checksummed downloads are added to the download cache"""
+        self.assertTrue(self.fetch())
+        with open(os.path.join(self.cachedir, self.sha256)) as fileh:
+            self.assertEqual(fileh.read(), "content")
+
+    def test_skip_up_to_date(self):
+        """The network is not used if the target has the right checksum"""
+        self.fetch()
+        os.utime(self.filename, (1000000000, 1000000000))
+        self.assertFalse(self.fetch())
+        self.assertEqual(os.path.getmtime(self.filename), 1000000000)
+
+    def test_target_changed(self):
+        """A target changed in place since it was fetched is replaced"""
+        self.fetch()
+        with open(self.filename, "r+") as fileh:
+            fileh.write("changed")
+        self.assertFalse(self.fetch())
+        with open(self.filename) as fileh:
+            self.assertEqual(fileh.read(), "content")
+
+    def test_cache_hit(self):
+        """The network is not used if the download cache has the content"""
+        self.fetch()
+        os.remove(self.filename)
+        self.assertFalse(self.fetch())
+        with open(self.filename) as fileh:
+            self.assertEqual(fileh.read(), "content")
+
+    def test_cache_not_shared(self):
+        """Changing a fetched file does not change the cached copy"""
+        self.fetch()
+        with open(self.filename, "r+") as fileh:
+            fileh.write("changed")
+        with open(os.path.join(self.cachedir, self.sha256)) as fileh:
+            self.assertEqual(fileh.read(), "content")
+
+    def test_corrupt_cache(self):
+        """Cached copies which no longer match their checksum are dropped"""
+        self.fetch()
+        os.remove(self.filename)
+        with open(os.path.join(self.cachedir, self.sha256), "w") as fileh:
+            fileh.write("corrupt")
+        self.assertTrue(self.fetch())
+        with open(self.filename) as fileh:
+            self.assertEqual(fileh.read(), "content")
+        with open(os.path.join(self.cachedir, self.sha256)) as fileh:
+            self.assertEqual(fileh.read(), "content")
+
+    def test_mismatch(self):
+        """Downloads which do not match the checksum are rejected"""
+        with self.assertRaises(planex.cmd.fetch.FetchVerifyError):
+            self.fetch(body=b"other content")
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+class MirrorTests(unittest.TestCase):
+    """Tests for fetching from mirrors"""
+
+    def setUp(self):
+        # Create a temporary directory with a configuration file
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, '.planexrc'), 'w') as fileh:
+            fileh.write("[example.com]\n")
+            fileh.write("Mirrors = https://mirror1.example.org/example\n")
+            fileh.write("          http://mirror2.example.org/\n")
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        # Remove the directory after the test
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_mirrors_for_url(self):
+        """URLs are rewritten for each mirror, in order"""
+        self.assertEqual(
+            planex.util.mirrors_for_url("https://example.com/a/b.tar?x=1"),
+            ["https://mirror1.example.org/example/a/b.tar?x=1",
+             "http://mirror2.example.org/a/b.tar?x=1",
+             "https://example.com/a/b.tar?x=1"])
+
+    def test_no_mirrors(self):
+        """URLs for hosts without mirrors are not rewritten"""
+        self.assertEqual(
+            planex.util.mirrors_for_url("https://example.net/b.tar"),
+            ["https://example.net/b.tar"])
+
+    @mock.patch('planex.cmd.fetch.probe')
+    def test_rank_mirrors(self, mock_probe):
+        """Healthy mirrors are preferred, fastest first"""
+        latencies = {"a": None, "b": 0.5, "c": 0.1, "d": None}
+        mock_probe.side_effect = latencies.get
+        self.assertEqual(planex.cmd.fetch.rank_mirrors(["a", "b", "c", "d"]),
+                         ["c", "b", "a", "d"])
+
+    @mock.patch('planex.cmd.fetch.rank_mirrors', lambda urls: urls)
+    @mock.patch('planex.cmd.fetch.requests_retry_session')
+    def test_fall_back(self, mock_session):
+        """Failed mirrors fall back to the next one, which is recorded"""
+        filename = os.path.join(self.tmpdir, "b.bin")
+        response = mock.Mock(status_code=200, headers={},
+                             raw=io.BytesIO(b"content"))
+        mock_session.return_value.get.side_effect = [
+            requests.ConnectionError("mirror down"), response]
+
+        planex.cmd.fetch.fetch_http(urlparse("https://example.com/b.bin"),
+                                    filename, 1)
+
+        urls = [call[0][0]
+                for call in mock_session.return_value.get.call_args_list]
+        self.assertEqual(urls, ["https://mirror1.example.org/example/b.bin",
+                                "http://mirror2.example.org/b.bin"])
+        url, _, validators = planex.cmd.fetch.read_originfile(filename)
+        self.assertEqual(url, "https://example.com/b.bin")
+        self.assertEqual(validators["mirror"],
+                         "http://mirror2.example.org/b.bin")
+
+
+class FormatTests(unittest.TestCase):
+    """Tests for identifying the format of downloaded files"""
+
+    def test_sniff_archives(self):
+        """Archive formats are identified from their magic numbers"""
+        for path, mime_type in (
+                ("tests/data/patchqueue.tar", "application/x-tar"),
+                ("tests/data/test-git.tar.gz", "application/x-gzip")):
+            with open(path, "rb") as fileh:
+                head = fileh.read(planex.cmd.fetch.SNIFF_SIZE)
+            self.assertEqual(planex.cmd.fetch.sniff_mime_type(head),
+                             mime_type)
+
+    def test_sniff_patch(self):
+        """Patches are identified as diffs"""
+        head = (b"From 1234 Mon Sep 17 00:00:00 2001\n"
+                b"Subject: [PATCH] Fix things\n\n"
+                b"---\n foo.c | 2 +-\n\n"
+                b"diff --git a/foo.c b/foo.c\n")
+        self.assertEqual(planex.cmd.fetch.sniff_mime_type(head),
+                         "text/x-diff")
+
+    def test_sniff_long_message(self):
+        """Patches whose description fills the head are identified"""
+        patch = (b"From 0123456789abcdef0123456789abcdef01234567 "
+                 b"Mon Sep 17 00:00:00 2001\n"
+                 b"Subject: [PATCH] Fix things\n\n" +
+                 b"A long description.\n" * 50 +
+                 b"---\ndiff --git a/foo.c b/foo.c\n")
+        head = patch[:planex.cmd.fetch.SNIFF_SIZE]
+        self.assertEqual(planex.cmd.fetch.sniff_mime_type(head),
+                         "text/x-diff")
+
+        # Without mail headers, the diff is looked for further in
+        verifier = planex.cmd.fetch.FormatVerifier("fix.patch")
+        verifier.update(b"A long description.\n" * 50)
+        verifier.update(b"--- a/foo.c\n+++ b/foo.c\n")
+        verifier.finish()
+
+    def test_sniff_html_patch(self):
+        """Patches changing HTML files are identified as diffs"""
+        head = (b"diff --git a/index.html b/index.html\n"
+                b"--- a/index.html\n+++ b/index.html\n"
+                b"@@ -1 +1 @@\n-<html>\n+<html lang=\"en\">\n")
+        self.assertEqual(planex.cmd.fetch.sniff_mime_type(head),
+                         "text/x-diff")
+
+    def test_sniff_html(self):
+        """HTML error pages are identified"""
+        head = b"\n<!DOCTYPE html>\n<html><body>Not Found</body></html>"
+        self.assertEqual(planex.cmd.fetch.sniff_mime_type(head), "text/html")
+
+    def test_verify_mismatch(self):
+        """Files which do not match their extension are rejected"""
+        with self.assertRaises(planex.cmd.fetch.FetchVerifyError):
+            planex.cmd.fetch.best_effort_file_verify("foo.tar.gz",
+                                                     b"<html></html>")
+
+    def test_verify_unknown_extension(self):
+        """Files with unknown extensions are not checked"""
+        planex.cmd.fetch.best_effort_file_verify("foo.spec", b"<html></html>")
+
+    @mock.patch('planex.cmd.fetch.requests_retry_session')
+    def test_abort_html(self, mock_session):
+        """Downloads of error pages are abandoned after the first chunk"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "source.tar.gz")
+            body = io.BytesIO(b"<html>" +
+                              b" " * 10 * planex.cmd.fetch.CHUNK_SIZE)
+            response = mock.Mock(status_code=200, headers={}, raw=body)
+            mock_session.return_value.get.return_value = response
+
+            with self.assertRaises(planex.cmd.fetch.FetchVerifyError):
+                planex.cmd.fetch.fetch_http(
+                    urlparse("https://example.com/source.tar.gz"),
+                    filename, 1)
+
+            self.assertEqual(body.tell(), planex.cmd.fetch.CHUNK_SIZE)
+            self.assertTrue(response.close.called)
+            self.assertEqual(os.listdir(tmpdir), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class RepoArchiveTests(unittest.TestCase):
+    """Tests for archiving sources from local repositories"""
+
+    def setUp(self):
+        # Create a repository with one commit in a temporary directory
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.repo = git.Repo.init(os.path.join("repos", "project"))
+        self.repo.create_remote("origin", "ssh://git@example.com/project.git")
+        self.commit("one")
+        self.resource = mock.Mock(commitish="master", prefix="project-1.0",
+                                  path=os.path.join(self.tmpdir, "p.tar"),
+                                  url="ssh://git@example.com/project.git",
+                                  basename="project.git")
+        self.url = urlparse("ssh://git@example.com/project.git")
+
+    def tearDown(self):
+        # Remove the directory after the test
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def commit(self, content):
+        """Commit a change to the repository"""
+        path = os.path.join(self.repo.working_dir, "file")
+        with open(path, "w") as fileh:
+            fileh.write(content)
+        self.repo.index.add([path])
+        self.repo.index.commit(content)
+
+    def test_unchanged_tree(self):
+        """The archive is only remade when the tree or prefix changes"""
+        planex.cmd.fetch.fetch_repo(self.url, self.resource)
+        os.utime(self.resource.path, (0, 0))
+
+        planex.cmd.fetch.fetch_repo(self.url, self.resource)
+        self.assertEqual(os.path.getmtime(self.resource.path), 0)
+
+        self.resource.prefix = "project-1.1"
+        planex.cmd.fetch.fetch_repo(self.url, self.resource)
+        self.assertNotEqual(os.path.getmtime(self.resource.path), 0)
+
+        os.utime(self.resource.path, (0, 0))
+        self.commit("two")
+        planex.cmd.fetch.fetch_repo(self.url, self.resource)
+        self.assertNotEqual(os.path.getmtime(self.resource.path), 0)
+
+    def test_unchanged_tree_new_commit(self):
+        """A new commit with the same tree is recorded in the origin file"""
+        planex.cmd.fetch.fetch_repo(self.url, self.resource)
+        os.utime(self.resource.path, (0, 0))
+
+        self.repo.index.commit("empty")
+        planex.cmd.fetch.fetch_repo(self.url, self.resource)
+        self.assertEqual(os.path.getmtime(self.resource.path), 0)
+        _, sha, _ = planex.cmd.fetch.read_originfile(self.resource.path)
+        self.assertEqual(sha, self.repo.head.commit.hexsha)
+
+    def test_export_subst(self):
+        """Archives expanding commit details are remade for each commit"""
+        path = os.path.join(self.repo.working_dir, ".gitattributes")
+        with open(path, "w") as fileh:
+            fileh.write("file export-subst\n")
+        self.repo.index.add([path])
+        self.commit("$Format:%H$")
+        self.resource.prefix = "project-1.0/"
+        planex.cmd.fetch.fetch_repo(self.url, self.resource)
+        os.utime(self.resource.path, (0, 0))
+
+        self.repo.index.commit("empty")
+        planex.cmd.fetch.fetch_repo(self.url, self.resource)
+        self.assertNotEqual(os.path.getmtime(self.resource.path), 0)
+        with tarfile.open(self.resource.path) as tar:
+            member = tar.extractfile("project-1.0/file")
+            self.assertEqual(member.read().decode(),
+                             self.repo.head.commit.hexsha)
@@ -0,0 +1,119 @@
+"""Tests for the local mirror store"""
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import git
+import mock
+
+import planex.mirror
+import planex.repository
+
+
+class MirrorTests(unittest.TestCase):
+    """Tests for creating, updating and using mirrors"""
+
+    def setUp(self):
+        # Create an upstream repository and a configuration pointing the
+        # mirror store into a temporary directory
+        self.tmpdir = tempfile.mkdtemp()
+        self.upstream = git.Repo.init(os.path.join(self.tmpdir, "upstream"))
+        self.url = "file://" + self.upstream.working_dir
+        with open(os.path.join(self.tmpdir, '.planexrc'), 'w') as fileh:
+            fileh.write("[mirror]\n")
+            fileh.write("path = %s/mirrors\n" % self.tmpdir)
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        # Remove the directory after the test
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def commit(self, content):
+        """Commit a change upstream and return its SHA1"""
+        path = os.path.join(self.upstream.working_dir, "file")
+        with open(path, "w") as fileh:
+            fileh.write(content)
+        self.upstream.index.add([path])
+        return self.upstream.index.commit(content).hexsha
+
+    def test_mirror_path(self):
+        """Mirrors of the same repository over any protocol are shared"""
+        paths = set(planex.mirror.mirror_path(url) for url in (
+            "ssh://git@github.com/xenserver/planex.git",
+            "https://github.com/xenserver/planex",
+            "git://github.com/xenserver/planex.git/"))
+        self.assertEqual(
+            paths, set([os.path.join(self.tmpdir, "mirrors", "github.com",
+                                     "xenserver", "planex.git")]))
+
+    def test_update_and_resolve(self):
+        """Mirrors are created, updated incrementally and resolve refs"""
+        first = self.commit("one")
+        self.upstream.create_tag("v1")
+        self.assertIsNone(planex.mirror.find_mirror(self.url))
+        self.assertIsNone(planex.mirror.resolve(self.url, "v1"))
+
+        path = planex.mirror.update_mirror(self.url)
+        self.assertEqual(planex.mirror.find_mirror(self.url), path)
+        self.assertEqual(planex.mirror.resolve(self.url, "refs/tags/v1"),
+                         first)
+
+        second = self.commit("two")
+        self.assertIsNone(planex.mirror.resolve(self.url, second))
+        planex.mirror.update_mirror(self.url)
+        self.assertEqual(planex.mirror.resolve(self.url, "master"), second)
+
+    def test_archive(self):
+        """Archives of tags and SHA1s are made from the mirror"""
+        first = self.commit("one")
+        self.upstream.create_tag("v1")
+        output = io.BytesIO()
+        self.assertFalse(planex.mirror.archive(self.url, "v1", output))
+
+        planex.mirror.update_mirror(self.url)
+        # Branches may have moved on since the mirror was updated
+        self.assertFalse(planex.mirror.archive(self.url, "master", output))
+        self.assertEqual(output.getvalue(), b"")
+        archive_path = os.path.join(self.tmpdir, "out.tar")
+        with open(archive_path, "wb") as output:
+            self.assertTrue(planex.mirror.archive(self.url, first, output))
+        with open(archive_path, "wb") as output:
+            self.assertTrue(planex.mirror.archive(self.url, "v1", output,
+                                                  prefix="project/"))
+        with tarfile.open(archive_path) as tar:
+            self.assertEqual(tar.extractfile("project/file").read(), b"one")
+
+    def test_deleted_branches_kept(self):
+        """Branches deleted upstream stay in the mirror for its borrowers"""
+        self.commit("one")
+        self.upstream.create_head("topic")
+        path = planex.mirror.update_mirror(self.url)
+        self.upstream.delete_head("topic")
+        planex.mirror.update_mirror(self.url)
+        mirror = git.Repo(path)
+        self.assertIn("topic", [head.name for head in mirror.heads])
+        self.assertEqual(mirror.git.config("gc.pruneExpire"), "never")
+
+    @mock.patch('planex.repository.subprocess.check_call')
+    def test_repository_clone_reference(self, mock_check_call):
+        """Repository clones borrow objects from the mirror"""
+        with open(os.path.join(self.tmpdir, '.planexrc'), 'a') as fileh:
+            fileh.write("[github.com]\n")
+            fileh.write("server-type = github\n")
+        repo = planex.repository.Repository(
+            "https://github.com/xenserver/planex/archive/v1/p.tar.gz",
+            resolve=False)
+        path = planex.mirror.mirror_path(repo.clone_url)
+        os.makedirs(path)
+        with open(os.path.join(path, "HEAD"), "w") as fileh:
+            fileh.write("ref: refs/heads/master\n")
+
+        repo.clone(self.tmpdir)
+        cmd = mock_check_call.call_args[0][0]
+        self.assertEqual(cmd[:4], ["git", "clone", "--reference", path])
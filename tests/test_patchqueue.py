@@ -39,6 +39,27 @@ class BasicTests(unittest.TestCase):
         self.assertNotIn("patch_with_a_positive_guard", applied)
         self.assertIn("patch_with_a_negative_guard", applied)
 
+    def test_as_mail(self):
+        """Patches without mail headers are given them for git am"""
+        patch = (b"Fix the frobnicator\n\nIt was broken.\n\n"
+                 b"--- a/file\n+++ b/file\n@@ -1 +1 @@\n-a\n+b\n")
+        mail = planex.patchqueue.as_mail(patch, "fix.patch",
+                                         "A U Thor <author@example.com>")
+        self.assertEqual(mail,
+                         b"From: A U Thor <author@example.com>\n"
+                         b"Subject: Fix the frobnicator\n\n"
+                         b"It was broken.\n---\n"
+                         b"--- a/file\n+++ b/file\n@@ -1 +1 @@\n-a\n+b\n")
+
+        self.assertIn(b"Subject: patch bare.patch\n",
+                      planex.patchqueue.as_mail(b"--- a/file\n", "bare.patch",
+                                                "A <a@example.com>"))
+
+        formatted = b"From 0123 Mon Sep 17 00:00:00 2001\nFrom: A\n"
+        self.assertEqual(
+            planex.patchqueue.as_mail(formatted, "x.patch", "B <b@b>"),
+            formatted)
+
     def test_rewrite_spec(self):
         """Patches are inserted into rewritten spec file"""
         spec = Spec("tests/data/branding-xenserver.spec",
@@ -0,0 +1,129 @@
+"""Tests for checking that patches apply to their sources"""
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import mock
+
+import planex.cmd.patchqueuecheck as pqcheck
+
+
+PATCH = b"""--- a/file
++++ b/file
+@@ -1,3 +1,3 @@
+ one
+-two
++TWO
+ three
+"""
+
+BROKEN_PATCH = b"""--- a/file
++++ b/file
+@@ -1,3 +1,3 @@
+ one
+-deux
++DEUX
+ three
+"""
+
+
+class PackageCheckTests(unittest.TestCase):
+    """Tests for applying the patches of a package"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, "package-1.0.tar.gz")
+        with tarfile.open(self.source, "w:gz") as tar:
+            root = tarfile.TarInfo("package-1.0")
+            root.type = tarfile.DIRTYPE
+            tar.addfile(root)
+            self.add(tar, "package-1.0/file", b"one\ntwo\nthree\n")
+        self.patches = {"good.patch": PATCH, "bad.patch": BROKEN_PATCH}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def add(tar, name, content):
+        """Add a file called name holding content to tar"""
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+
+    def spec(self, series, prep="%autosetup -p1\n", patches=()):
+        """
+        Return a spec whose patchqueue has series, with the Patch lines
+        patches, which prep applies
+        """
+        def extract_sources(names, destdir):
+            """Write the patches called names to destdir"""
+            for name in names:
+                with open(os.path.join(destdir, name), "wb") as fileh:
+                    fileh.write(self.patches[name])
+
+        resources = {
+            "Source0": mock.Mock(path=self.source),
+            "PatchQueue0": mock.Mock(**{"series.return_value": series})}
+        for index, patch in enumerate(patches):
+            resources["Patch%d" % index] = mock.Mock(path="SOURCES/" + patch)
+        return mock.Mock(**{
+            "name.return_value": "package",
+            "spectext": (["%prep\n"] + prep.splitlines(True) +
+                         ["\n", "%build\n", "make\n"]),
+            "resources_dict.return_value": resources,
+            "extract_sources.side_effect": extract_sources})
+
+    def check(self, series, **kwargs):
+        """Return the result of checking a package with series"""
+        workdir = tempfile.mkdtemp(dir=self.tmpdir)
+        return pqcheck.PackageCheck(self.spec(series, **kwargs),
+                                    workdir).run()
+
+    def test_patches_apply(self):
+        """A patchqueue which applies passes"""
+        self.assertIsNone(self.check(["good.patch"]))
+
+    def test_first_failure(self):
+        """The first patch which does not apply is reported"""
+        failure = self.check(["good.patch", "bad.patch"])
+        self.assertTrue(failure.startswith(
+            "package: patch bad.patch (2 of 2) does not apply"))
+
+    def test_unapplied_patches(self):
+        """Patches which %prep does not apply are not checked"""
+        self.assertIsNone(self.check([], prep="%setup -q\n",
+                                     patches=["bad.patch"]))
+
+    def test_strip_level(self):
+        """Patches are applied with the -p level %prep gives them"""
+        self.patches["p0.patch"] = PATCH.replace(b"a/file", b"file") \
+            .replace(b"b/file", b"file")
+        self.assertIsNone(self.check(
+            [], prep="%setup -q\n%patch0 -p0\n", patches=["p0.patch"]))
+        self.assertIsNotNone(self.check(
+            [], prep="%setup -q\n%patch0 -p1\n", patches=["p0.patch"]))
+
+    def test_applied_patches(self):
+        """The patch macros of %prep are understood"""
+        self.assertEqual(
+            list(pqcheck.applied_patches([
+                "%setup -q", "%autosetup -N -n foo", "%patch0 -p1",
+                "%patch -P 2 -p2 -F 2", "%patch", "%autopatch -p1 -M 3",
+                "%autosetup -p1 -n %{name}-%{version}"])),
+            [([0], None, None, 1, 0), ([2], None, None, 2, 2),
+             ([0], None, None, 0, 0), (None, 0, 3, 1, 0),
+             (None, None, None, 1, 0)])
+
+    def test_specs_and_links(self):
+        """Spec files are paired with their link or pin files"""
+        self.assertEqual(
+            pqcheck.specs_and_links(
+                ["SPECS/a.spec", "SPECS/a.lnk", "PINS/a.pin",
+                 "SPECS/b.spec", "SPECS/b.lnk", "SPECS/c.spec",
+                 "_build/SOURCES/c/c.tar.gz"]),
+            [("SPECS/a.spec", "PINS/a.pin"), ("SPECS/b.spec", "SPECS/b.lnk"),
+             ("SPECS/c.spec", None)])
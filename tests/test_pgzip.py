@@ -0,0 +1,82 @@
+"""Tests for parallel gzip compression"""
+
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import planex.pgzip
+import planex.tarball
+
+
+class ParallelGzipTests(unittest.TestCase):
+    """Tests for ParallelGzipWriter"""
+
+    def compress(self, data, **kwargs):
+        """Return data compressed by compress_stream"""
+        out = io.BytesIO()
+        planex.pgzip.compress_stream(io.BytesIO(data), out, **kwargs)
+        return out.getvalue()
+
+    def decompress(self, data):
+        """Return data decompressed by the standard gzip module"""
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as gzfile:
+            return gzfile.read()
+
+    def test_empty(self):
+        """Empty input produces a valid gzip file"""
+        self.assertEqual(self.decompress(self.compress(b'')), b'')
+
+    def test_multiple_blocks(self):
+        """Input spanning several blocks round trips"""
+        data = os.urandom(1000) * 700 + b'tail'
+        self.assertGreater(len(data), 4 * planex.pgzip.BLOCK_SIZE)
+        for threads in (1, 4):
+            self.assertEqual(
+                self.decompress(self.compress(data, threads=threads)), data)
+
+    def test_reproducible(self):
+        """Output does not depend on the thread count or the time"""
+        data = b'planex ' * 100000
+        self.assertEqual(self.compress(data, level=9, threads=1),
+                         self.compress(data, level=9, threads=3))
+
+    def test_small_writes(self):
+        """Writes smaller than a block are buffered"""
+        out = io.BytesIO()
+        with planex.pgzip.ParallelGzipWriter(out, threads=2) as writer:
+            for i in range(50000):
+                writer.write(b'%d\n' % i)
+        self.assertEqual(self.decompress(out.getvalue()),
+                         b''.join(b'%d\n' % i for i in range(50000)))
+
+
+class MakeTarballTests(unittest.TestCase):
+    """Tests for tarball.make"""
+
+    def setUp(self):
+        # Create a temporary directory
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # Remove the directory after the test
+        shutil.rmtree(self.tmpdir)
+
+    def test_make_gz(self):
+        """Compressed tarballs can be read by tarfile"""
+        inputdir = os.path.join(self.tmpdir, "input")
+        os.makedirs(inputdir)
+        with open(os.path.join(inputdir, "file"), "w") as fileh:
+            fileh.write("content")
+        tarname = os.path.join(self.tmpdir, "out.tar.gz")
+
+        with open(tarname, "wb") as out:
+            planex.tarball.make(inputdir, out, "gz")
+
+        with tarfile.open(tarname) as tar:
+            self.assertEqual(tar.extractfile(
+                [m for m in tar.getmembers() if m.isfile()][0]).read(),
+                             b"content")
@@ -0,0 +1,95 @@
+"""Tests for generating pin files"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import git
+import mock
+
+import planex.cmd.pin
+from planex.worktree import Destinations
+
+
+def resource(url, commitish=None, is_repo=True, sha256=None):
+    """Return a resource of a spec file"""
+    return mock.Mock(url=url, commitish=commitish, is_repo=is_repo,
+                     basename=os.path.basename(url), prefix=None,
+                     sparse=None, sha256=sha256)
+
+
+class PinAllTests(unittest.TestCase):
+    """Tests for pinning every package checked out in repos"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, "SPECS"))
+        for package in ("checked-out", "detached", "remote"):
+            open(os.path.join(self.tmpdir, "SPECS", package + ".spec"),
+                 "w").close()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        Destinations.reset()
+
+    def checkout(self, name, branch, url=None):
+        """Create a clone of url in repos with a commit on branch"""
+        repo = git.Repo.init(os.path.join(self.tmpdir, "repos", name))
+        repo.create_remote("origin", url or "https://host/%s.git" % name)
+        repo.index.commit("initial")
+        repo.git.checkout("-b", branch)
+        return repo.head.commit.hexsha
+
+    def read_pin(self, package):
+        """Return the content of the pin file of package"""
+        with open(os.path.join(self.tmpdir, "PINS", package + ".pin")) as pin:
+            return json.load(pin)
+
+    def test_pin_all(self):
+        """Packages are pinned to their local checkouts"""
+        self.checkout("first", "feature")
+        sha1 = self.checkout("second@v1.0", "planex/v1.0",
+                             "https://host/second.git")
+        # Checkouts of other repositories with the same name are ignored
+        self.checkout("second", "other", "https://elsewhere/second.git")
+        self.checkout("third", "other", "https://elsewhere/third.git")
+        specs = {
+            "checked-out": {
+                "Source0": resource("https://host/first.git", "master")},
+            "detached": {
+                "Source0": resource("https://host/tarball.tar.gz",
+                                    is_repo=False, sha256="ab" * 32),
+                "PatchQueue0": resource("https://host/second.git", "v1.0")},
+            "remote": {
+                "Source0": resource("https://host/third.git", "master")}}
+
+        def load(_, package):
+            """Return a spec with the resources of package"""
+            return mock.Mock(**{
+                'resources_dict.return_value': specs[package],
+                'resources.return_value': list(specs[package].values())})
+
+        with mock.patch('planex.cmd.pin.load_spec_and_lnk', load), \
+                mock.patch('planex.cmd.pin.Repository') as mock_repository:
+            written = planex.cmd.pin.pin_all("repos")
+
+        mock_repository.resolve_all.assert_not_called()
+        self.assertEqual(written, ["PINS/checked-out.pin",
+                                   "PINS/detached.pin"])
+        self.assertEqual(self.read_pin("checked-out")["Source0"],
+                         {"URL": "https://host/first.git",
+                          "commitish": "feature"})
+        pin = self.read_pin("detached")
+        self.assertEqual(pin["PatchQueue0"],
+                         {"URL": "https://host/second.git",
+                          "commitish": sha1})
+        self.assertEqual(pin["Source0"],
+                         {"URL": "https://host/tarball.tar.gz",
+                          "sha256": "ab" * 32})
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, "PINS", "remote.pin")))
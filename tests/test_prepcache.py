@@ -0,0 +1,113 @@
+"""Tests for the cache of prepared source trees"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import git
+import mock
+
+import planex.prepcache
+
+
+class PrepCacheTests(unittest.TestCase):
+    """Tests for storing and restoring prepared source trees"""
+
+    def setUp(self):
+        # Create rpmbuild top directory and a configuration pointing the
+        # cache into a temporary directory
+        self.tmpdir = tempfile.mkdtemp()
+        self.top_dir = os.path.join(self.tmpdir, "top")
+        os.makedirs(os.path.join(self.top_dir, "SOURCES"))
+        self.spec_path = os.path.join(self.top_dir, "test.spec")
+        self.write(self.spec_path, "Name: test\n")
+        self.write(os.path.join(self.top_dir, "SOURCES", "a.patch"), "a")
+        self.resources = {
+            "Patch0": mock.Mock(path="%_sourcedir/a.patch"),
+            "PatchQueue0": mock.Mock(path="%_sourcedir/pq.tar.gz")}
+        with open(os.path.join(self.tmpdir, '.planexrc'), 'w') as fileh:
+            fileh.write("[clone]\n")
+            fileh.write("prep-cache = %s/prep\n" % self.tmpdir)
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        # Remove the directory after the test
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def write(path, content):
+        """Write content to the file at path"""
+        with open(path, "w") as fileh:
+            fileh.write(content)
+
+    def prepared_repo(self, name, files):
+        """Return a repository committing files, as made after %prep"""
+        repo = git.Repo.init(os.path.join(self.tmpdir, name))
+        for path, content in files.items():
+            self.write(os.path.join(repo.working_dir, path), content)
+        repo.index.add(list(files))
+        repo.index.commit("Repo generated by planex-clone")
+        return repo
+
+    def key(self):
+        """Return the cache key of the spec file and its sources"""
+        return planex.prepcache.cache_key(self.spec_path, self.top_dir,
+                                          self.resources)
+
+    def test_key(self):
+        """Keys change when the spec file or any source changes"""
+        key = self.key()
+        self.assertEqual(self.key(), key)
+
+        self.write(os.path.join(self.top_dir, "SOURCES", "a.patch"), "b")
+        patched = self.key()
+        self.assertNotEqual(patched, key)
+
+        self.write(self.spec_path, "Name: other\n")
+        self.assertNotEqual(self.key(), patched)
+
+    def test_key_unlisted_files(self):
+        """Files which the spec file does not list do not change keys"""
+        key = self.key()
+        for name in ("a.patch.origin", "a.patch.part", "pq.tar.gz",
+                     "other.patch"):
+            self.write(os.path.join(self.top_dir, "SOURCES", name), "x")
+        self.assertEqual(self.key(), key)
+
+    def test_store_and_restore(self):
+        """Stored trees are cloned into new repositories"""
+        key = self.key()
+        destination = os.path.join(self.tmpdir, "restored")
+        self.assertFalse(planex.prepcache.restore(key, destination))
+        self.assertFalse(os.path.exists(destination))
+
+        prepared = self.prepared_repo("prepared", {"file": "content"})
+        planex.prepcache.store(key, prepared.working_dir)
+
+        self.assertTrue(planex.prepcache.restore(key, destination))
+        restored = git.Repo(destination)
+        self.assertEqual(restored.head.commit, prepared.head.commit)
+        self.assertEqual(restored.remotes, [])
+        with open(os.path.join(destination, "file")) as fileh:
+            self.assertEqual(fileh.read(), "content")
+
+    def test_ignored_files_not_cached(self):
+        """Trees with files which are not committed are not cached"""
+        prepared = self.prepared_repo("prepared",
+                                      {".gitignore": "configure\n"})
+        self.write(os.path.join(prepared.working_dir, "configure"), "")
+        planex.prepcache.store("0123", prepared.working_dir)
+        self.assertFalse(planex.prepcache.restore(
+            "0123", os.path.join(self.tmpdir, "restored")))
+
+    def test_disabled(self):
+        """An empty prep-cache option disables the cache"""
+        self.write(os.path.join(self.tmpdir, '.planexrc'),
+                   "[clone]\nprep-cache =\n")
+        self.assertIsNone(planex.prepcache.cache_root())
+        prepared = self.prepared_repo("prepared", {"file": "content"})
+        planex.prepcache.store("0123", prepared.working_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "prep")))
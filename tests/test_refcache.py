@@ -0,0 +1,124 @@
+"""Tests for the persistent ref cache"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from planex.refcache import RefCache
+from planex.repository import Repository
+
+
+SHA1 = '4f3e1d1d2f6b8a04a4d3c9a8e1f9f5b3a2c1d0e9'
+TAG_SHA1 = '0123456789abcdef0123456789abcdef01234567'
+
+
+class RefCacheTests(unittest.TestCase):
+    """Tests for the RefCache class"""
+
+    def setUp(self):
+        # Point the cache at a file in a temporary directory
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, '.planexrc'), 'w') as fileh:
+            fileh.write("[repository]\n")
+            fileh.write("ref-cache = %s/refs.json\n" % self.tmpdir)
+            fileh.write("ref-cache-ttl = 60\n")
+            fileh.write("[github.com]\n")
+            fileh.write("server-type = github\n")
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        # Remove the directory after the test
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        RefCache.bypass = False
+
+    def test_roundtrip(self):
+        """Resolutions are returned until they expire"""
+        RefCache.set('host', 'repo', 'refs/heads/master', SHA1)
+        self.assertEqual(
+            RefCache.get('host', 'repo', 'refs/heads/master'), SHA1)
+        self.assertIsNone(RefCache.get('host', 'repo', 'refs/heads/other'))
+
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(
+                RefCache.get('host', 'repo', 'refs/heads/master'))
+
+    def test_immutable(self):
+        """Tags and full SHA1s do not expire"""
+        RefCache.set('host', 'repo', 'refs/tags/v1', TAG_SHA1,
+                     immutable=True)
+        RefCache.set('host', 'repo', SHA1, SHA1)
+
+        with mock.patch('time.time', return_value=time.time() + 3600):
+            self.assertEqual(
+                RefCache.get('host', 'repo', 'refs/tags/v1'), TAG_SHA1)
+            self.assertEqual(RefCache.get('host', 'repo', SHA1), SHA1)
+
+    def test_bypass(self):
+        """Cached entries are ignored when bypassed"""
+        RefCache.set('host', 'repo', 'refs/heads/master', SHA1)
+        RefCache.bypass = True
+        self.assertIsNone(RefCache.get('host', 'repo', 'refs/heads/master'))
+
+    def test_corrupt(self):
+        """A corrupt cache file is treated as empty and replaced"""
+        with open(os.path.join(self.tmpdir, 'refs.json'), 'w') as fileh:
+            fileh.write("{not json")
+        self.assertIsNone(RefCache.get('host', 'repo', 'refs/heads/master'))
+        RefCache.set('host', 'repo', 'refs/heads/master', SHA1)
+        self.assertEqual(
+            RefCache.get('host', 'repo', 'refs/heads/master'), SHA1)
+
+    @mock.patch('planex.git.ls_remote')
+    def test_github_resolution_is_cached(self, ls_remote):
+        """A second Repository for the same tag does not query the remote"""
+        ls_remote.return_value = (
+            "%s\trefs/tags/v1\n%s\trefs/tags/v1^{}\n" % (SHA1, TAG_SHA1))
+        url = "https://github.com/xenserver/planex/archive/v1/planex.tar.gz"
+
+        repo = Repository(url)
+        self.assertEqual(repo.tag, 'v1')
+        self.assertEqual(repo.sha1, TAG_SHA1)
+        self.assertEqual(ls_remote.call_count, 1)
+
+        repo = Repository(url)
+        self.assertEqual(repo.tag, 'v1')
+        self.assertEqual(repo.sha1, TAG_SHA1)
+        self.assertEqual(ls_remote.call_count, 1)
+
+    @mock.patch('planex.git.ls_remote')
+    def test_github_branch_is_cached(self, ls_remote):
+        """A second Repository for the same branch does not query the remote"""
+        ls_remote.return_value = "%s\trefs/heads/master\n" % SHA1
+        url = "https://github.com/xenserver/planex/archive/master/p.tar.gz"
+
+        repo = Repository(url)
+        self.assertEqual(repo.branch, 'master')
+        self.assertEqual(repo.sha1, SHA1)
+        self.assertEqual(ls_remote.call_count, 1)
+
+        repo = Repository(url)
+        self.assertEqual(repo.branch, 'master')
+        self.assertIsNone(repo.tag)
+        self.assertEqual(repo.sha1, SHA1)
+        self.assertEqual(ls_remote.call_count, 1)
+
+    @mock.patch('planex.git.ls_remote')
+    def test_resolve_all_cached(self, ls_remote):
+        """Batches of cached refs are resolved without querying remotes"""
+        ls_remote.return_value = "%s\trefs/heads/master\n" % SHA1
+        url = "https://github.com/xenserver/planex/archive/master/p.tar.gz"
+
+        repos = Repository.resolve_all([url, url])
+        self.assertEqual(ls_remote.call_count, 1)
+        self.assertEqual([repo.sha1 for repo in repos], [SHA1, SHA1])
+
+        repos = Repository.resolve_all([url, url])
+        self.assertEqual(ls_remote.call_count, 1)
+        self.assertEqual([(repo.branch, repo.sha1) for repo in repos],
+                         [('master', SHA1), ('master', SHA1)])
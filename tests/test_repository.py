@@ -1,6 +1,9 @@
 """Tests for repository URL parsers"""
 
 import json
+import os
+import shutil
+import tempfile
 import unittest
 import mock
 
@@ -66,3 +69,72 @@ class GitWebTests(unittest.TestCase):
             self.assertEqual(repo.clone_url, tcase['clone_URL'])
             self.assertEqual(repo.branch, tcase['branch'])
             self.assertEqual(repo.tag, tcase['tag'])
+
+
+class ResolveAllTests(unittest.TestCase):
+    """Tests for batch resolution of repositories"""
+
+    def setUp(self):
+        # Create a configuration with GitHub hosts and no ref cache
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, '.planexrc'), 'w') as fileh:
+            fileh.write("[repository]\n")
+            fileh.write("ref-cache =\n")
+            fileh.write("[github.com]\n")
+            fileh.write("server-type = github\n")
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        # Remove the directory after the test
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('planex.git.ls_remote')
+    def test_one_query_per_remote(self, mock_git_ls_remote):
+        """Each remote is listed once and serves all its lookups"""
+        advertisements = {
+            "https://github.com/xapi-project/xen-api/":
+                "1" * 40 + "\trefs/heads/master\n" +
+                "2" * 40 + "\trefs/tags/v1.0\n" +
+                "3" * 40 + "\trefs/tags/v1.0^{}\n",
+            "https://github.com/xenserver/planex/":
+                "4" * 40 + "\trefs/tags/v2.0\n"}
+        mock_git_ls_remote.side_effect = \
+            lambda url, refs: advertisements[url]
+
+        repos = planex.repository.Repository.resolve_all([
+            "https://github.com/xapi-project/xen-api/archive/master/x.tar.gz",
+            "https://github.com/xapi-project/xen-api/archive/v1.0/x.tar.gz",
+            "https://github.com/xenserver/planex/archive/v2.0/p.tar.gz"])
+
+        self.assertEqual(mock_git_ls_remote.call_count, 2)
+        self.assertEqual([(repo.branch, repo.tag, repo.sha1)
+                          for repo in repos],
+                         [("master", None, "1" * 40),
+                          (None, "v1.0", "3" * 40),
+                          (None, "v2.0", "4" * 40)])
+
+        # Only the refs wanted from each remote are listed
+        patterns = dict(call[0] for call in mock_git_ls_remote.call_args_list)
+        self.assertEqual(
+            patterns["https://github.com/xapi-project/xen-api/"],
+            ["refs/heads/master", "refs/heads/v1.0", "refs/tags/master",
+             "refs/tags/master^{}", "refs/tags/v1.0", "refs/tags/v1.0^{}"])
+
+    @mock.patch('planex.bitbucket.BitbucketRepo.resolve')
+    def test_bitbucket(self, mock_resolve):
+        """Refs of each Bitbucket repository are resolved in one call"""
+        mock_resolve.return_value = {"refs/heads/master": "1" * 40,
+                                     "refs/tags/v1.0": "2" * 40}
+        url = ("https://code.example.com/rest/archive/latest/projects/P/"
+               "repos/r/archive?at=%s&format=tar.gz#/r.tar.gz")
+
+        repos = planex.repository.Repository.resolve_all([
+            url % "refs/heads/master", url % "refs/tags/v1.0",
+            url % "refs/heads/master"])
+
+        mock_resolve.assert_called_once_with(
+            set(["refs/heads/master", "refs/tags/v1.0"]))
+        self.assertEqual([repo.sha1 for repo in repos],
+                         ["1" * 40, "2" * 40, "1" * 40])
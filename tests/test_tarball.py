@@ -1,25 +1,34 @@
 """Test tarball handling"""
 
+import gzip
 import os
 import os.path
 import shutil
 import tempfile
 import unittest
 
+import mock
+
 import planex.tarball
+import planex.zran
 
 
 class BasicTests(unittest.TestCase):
     """Basic tarball tests"""
 
     def setUp(self):
-        # Create a temporary directory
+        # Create a temporary directory and copy the tarball into it, so
+        # that its index is not written beside the test data
         self.tmpdir = tempfile.mkdtemp()
-        self.tarball = planex.tarball.Tarball("tests/data/patchqueue.tar")
+        shutil.copy("tests/data/patchqueue.tar", self.tmpdir)
+        self.tarball = planex.tarball.Tarball(
+            os.path.join(self.tmpdir, "patchqueue.tar"))
+        self.tmpdir = os.path.join(self.tmpdir, "output")
+        os.mkdir(self.tmpdir)
 
     def tearDown(self):
         # Remove the directory after the test
-        shutil.rmtree(self.tmpdir)
+        shutil.rmtree(os.path.dirname(self.tmpdir))
         self.tarball.close()
 
     def test_archive_root(self):
@@ -85,3 +94,129 @@ class BasicTests(unittest.TestCase):
                 True,
                 msg="{} not found in {}".format(source, self.tmpdir)
             )
+
+
+class IndexTests(unittest.TestCase):
+    """Tests for the index files of tarballs"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "patchqueue.tar")
+        shutil.copy("tests/data/patchqueue.tar", self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_member(self, path, destdir):
+        """Extract SOURCES/test1.source from the tarball at path"""
+        with planex.tarball.Tarball(path, prefix="SOURCES") as tarball:
+            tarball.extract(("test1.source",), destdir)
+            self.assertEqual(tarball.archive_root, "patchqueue")
+            self.assertItemsEqual(tarball.getnames(),
+                                  ["test1.source", "test2.source"])
+        with open(os.path.join(destdir, "test1.source")) as output:
+            self.assertEqual(output.read(), "test1.source contents\n")
+
+    def test_index_reused(self):
+        """Indexed uncompressed tarballs are not opened with tarfile"""
+        self.read_member(self.path, self.tmpdir)
+        self.assertTrue(
+            os.path.exists(planex.tarball.index_path(self.path)))
+        with mock.patch("tarfile.open") as mock_open:
+            self.read_member(self.path, self.tmpdir)
+        mock_open.assert_not_called()
+
+    def test_stale_index(self):
+        """An index of an earlier version of the tarball is rebuilt"""
+        planex.tarball.load_index(self.path)
+        with open(self.path, "r+b") as fileh:
+            fileh.seek(0, os.SEEK_END)
+            fileh.write(b"\0" * 512)
+        self.assertIsNone(planex.tarball.read_index(self.path))
+        self.read_member(self.path, self.tmpdir)
+        self.assertIsNotNone(planex.tarball.read_index(self.path))
+
+    def gzip(self):
+        """Return the path of a gzipped copy of the tarball"""
+        compressed = self.path + ".gz"
+        with open(self.path, "rb") as src:
+            with gzip.open(compressed, "wb") as dst:
+                dst.write(src.read())
+        return compressed
+
+    def test_compressed(self):
+        """Members of compressed tarballs are extracted with tarfile"""
+        compressed = self.gzip()
+        with mock.patch("planex.zran.available", return_value=False):
+            self.read_member(compressed, self.tmpdir)
+        index = planex.tarball.read_index(compressed)
+        self.assertTrue(index["compressed"])
+        self.assertNotIn("checkpoints", index)
+
+    def test_no_checkpoints_by_default(self):
+        """Checkpoints are only recorded if a span is configured"""
+        compressed = self.gzip()
+        self.read_member(compressed, self.tmpdir)
+        self.assertNotIn("checkpoints",
+                         planex.tarball.read_index(compressed))
+
+    @unittest.skipUnless(planex.zran.available(), "zlib cannot be loaded")
+    @mock.patch("planex.zran.checkpoint_span", return_value=1024 * 1024)
+    def test_checkpoints(self, _):
+        """Members of gzipped tarballs are read from checkpoints"""
+        compressed = self.gzip()
+        self.read_member(compressed, self.tmpdir)
+        self.assertIn("checkpoints",
+                      planex.tarball.read_index(compressed))
+        with mock.patch("tarfile.open") as mock_open:
+            self.read_member(compressed, self.tmpdir)
+        mock_open.assert_not_called()
+
+
+class CacheTests(unittest.TestCase):
+    """Tests for sharing tarballs within a TarballCache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "patchqueue.tar")
+        shutil.copy("tests/data/patchqueue.tar", self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_listed_once(self):
+        """A tarball opened repeatedly in a cache is only listed once"""
+        load_index = planex.tarball.load_index
+        with mock.patch("planex.tarball.load_index",
+                        side_effect=load_index) as mock_load:
+            with planex.tarball.TarballCache():
+                for _ in range(3):
+                    with planex.tarball.Tarball(self.path,
+                                                prefix="SOURCES") as tarball:
+                        tarball.extract(("test1.source",), self.tmpdir)
+                        self.assertItemsEqual(tarball.getnames(),
+                                              ["test1.source",
+                                               "test2.source"])
+            # Without a cache, each open reads the index
+            with planex.tarball.Tarball(self.path):
+                pass
+        self.assertEqual(mock_load.call_count, 2)
+
+    def test_closed_with_cache(self):
+        """Shared tarballs are closed when the cache is, not before"""
+        with planex.tarball.TarballCache():
+            with planex.tarball.Tarball(self.path, prefix="SOURCES") as first:
+                shared = first.tarfile
+                # Extract with tarfile, which must rename a copy of the
+                # member rather than the one other users share
+                with mock.patch("planex.tarball._Archive.member",
+                                return_value=None):
+                    first.extract(("test1.source",), self.tmpdir)
+            self.assertFalse(shared.closed)
+            with planex.tarball.Tarball(self.path) as second:
+                self.assertIs(second.tarfile, shared)
+                self.assertEqual(
+                    shared.getmember("patchqueue/SOURCES/test1.source").name,
+                    "patchqueue/SOURCES/test1.source")
+        self.assertTrue(shared.closed)
+        self.assertIsNone(planex.tarball.TarballCache.lookup(self.path))
@@ -0,0 +1,52 @@
+"""Tests for random access to gzip files"""
+
+import gzip
+import io
+import random
+import unittest
+
+import planex.zran
+
+
+@unittest.skipUnless(planex.zran.available(), "zlib cannot be loaded")
+class ReadChunksTests(unittest.TestCase):
+    """Tests for reading gzip files from checkpoints"""
+
+    def setUp(self):
+        # Compressible data with enough variety for many deflate blocks
+        rand = random.Random(0)
+        words = [b"alpha", b"beta", b"gamma", b"delta", b"epsilon", b"\n"]
+        self.data = b" ".join(rand.choice(words) for _ in range(400000))
+        out = io.BytesIO()
+        with gzip.GzipFile(fileobj=out, mode="wb") as gzfile:
+            gzfile.write(self.data)
+        self.gzipped = io.BytesIO(out.getvalue())
+
+    def read(self, checkpoints, offset, size):
+        """Return size bytes at offset, read from checkpoints"""
+        return b"".join(planex.zran.read_chunks(self.gzipped, checkpoints,
+                                                offset, size))
+
+    def test_checkpoints(self):
+        """Checkpoints are about span bytes apart and cover all the data"""
+        checkpoints, end = planex.zran.build_checkpoints(self.gzipped,
+                                                         256 * 1024)
+        self.assertEqual(end, len(self.data))
+        self.assertEqual(checkpoints[0][0], 0)
+        self.assertGreater(len(checkpoints), 4)
+        for previous, point in zip(checkpoints, checkpoints[1:]):
+            self.assertGreater(point[0] - previous[0], 256 * 1024)
+        # Most blocks do not end on a byte boundary
+        self.assertTrue(any(point[2] for point in checkpoints))
+
+    def test_read(self):
+        """Data read from any offset matches the uncompressed data"""
+        checkpoints, _ = planex.zran.build_checkpoints(self.gzipped,
+                                                       256 * 1024)
+        length = len(self.data)
+        for offset, size in [(0, 100), (length - 100, 100),
+                             (checkpoints[2][0], 5000),
+                             (checkpoints[2][0] - 10, 300000),
+                             (length // 2, 1)]:
+            self.assertEqual(self.read(checkpoints, offset, size),
+                             self.data[offset:offset + size])